@@ -0,0 +1,184 @@
+from common import OpenAIConfig, Stats, getRoot
+
+import base64
+import hashlib
+import os
+from collections import OrderedDict, deque
+from threading import Lock
+from typing import Deque, Dict
+
+from loguru import logger
+
+
+class BlobHandle:
+    # one reference to a blob, released when the conversation drops it or is dropped itself
+
+    def __init__(self, store: "BlobStore", key: str, mime: str) -> None:
+        self.store: BlobStore = store
+        self.key: str = key
+        self.mime: str = mime
+        self.released: bool = False
+
+    def getValue(self) -> bytes:
+        return self.store.get(self.key)
+
+    def dataUrl(self) -> str:
+        # built for each request, never kept
+        data = self.getValue()
+        if data is None:
+            return None
+        return f"data:{self.mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+    def release(self) -> None:
+        self.store.releaseHandle(self)
+
+    def __del__(self) -> None:
+        # the collector may run on a thread inside the store lock, so only queue the release
+        if not self.released:
+            self.released = True
+            self.store.dropped.append(self.key)
+
+
+class BlobStore:
+    # content addressed blobs shared by all conversations, each kept once however many refer to it.
+    # recently used blobs stay in memory, older ones are spilled to files, a blob goes when its last reference does
+
+    def __init__(self, memoryBytes: int, diskBytes: int = 0, path: str = None) -> None:
+        self.lock: Lock = Lock()
+        self.memoryBytes: int = memoryBytes
+        self.diskBytes: int = diskBytes if path is not None else 0
+        self.path: str = path
+        self.refs: Dict[str, int] = {}
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memorySize: int = 0
+        self.disk: Dict[str, int] = {} # key -> file size
+        self.diskSize: int = 0
+        self.stats: Stats = Stats()
+        self.dropped: Deque[str] = deque() # keys of handles collected without release, appending needs no lock
+        if self.diskBytes > 0:
+            os.makedirs(path, exist_ok=True)
+            self.clearSpilled()
+
+    def clearSpilled(self) -> None:
+        # references don't outlive the process, neither do spilled blobs
+        for name in os.listdir(self.path):
+            if len(name) == 64 and all(c in "0123456789abcdef" for c in name):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def put(self, data: bytes, mime: str) -> BlobHandle:
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.drain()
+            if key in self.refs:
+                self.refs[key] += 1
+                self.stats.incr("blob.shared")
+            else:
+                self.refs[key] = 1
+                self.putMemory(key, data)
+            self.gauges()
+        return BlobHandle(self, key, mime)
+
+    def get(self, key: str) -> bytes:
+        with self.lock:
+            self.drain()
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                return data
+            if key not in self.disk:
+                return None
+
+        data = self.readFile(key)
+        with self.lock:
+            if data is not None and key in self.refs and key not in self.memory:
+                self.dropFile(key)
+                self.putMemory(key, data)
+                self.stats.incr("blob.diskHit")
+                self.gauges()
+        return data
+
+    def releaseHandle(self, handle: BlobHandle) -> None:
+        with self.lock:
+            if handle.released:
+                return
+            handle.released = True
+            self.drain()
+            self.release(handle.key)
+            self.gauges()
+
+    def drain(self) -> None:
+        # caller holds the lock
+        if len(self.dropped) == 0:
+            return
+        while len(self.dropped) > 0:
+            self.release(self.dropped.popleft())
+        self.gauges()
+
+    def release(self, key: str) -> None:
+        # caller holds the lock
+        refs = self.refs.get(key, 0) - 1
+        if refs > 0:
+            self.refs[key] = refs
+            return
+        self.refs.pop(key, None)
+        data = self.memory.pop(key, None)
+        if data is not None:
+            self.memorySize -= len(data)
+        self.dropFile(key)
+
+    def putMemory(self, key: str, data: bytes) -> None:
+        # caller holds the lock
+        self.memory[key] = data
+        self.memorySize += len(data)
+        while self.memorySize > self.memoryBytes and len(self.memory) > 1:
+            oldKey, oldData = next(iter(self.memory.items()))
+            if not self.spill(oldKey, oldData):
+                # nowhere to go, a referenced blob can't be dropped
+                break
+            del self.memory[oldKey]
+            self.memorySize -= len(oldData)
+
+    def spill(self, key: str, data: bytes) -> bool:
+        # caller holds the lock
+        if self.diskSize + len(data) > self.diskBytes:
+            return False
+        try:
+            with open(os.path.join(self.path, key), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error("failed to spill blob {}, {}", key, str(e))
+            return False
+        self.disk[key] = len(data)
+        self.diskSize += len(data)
+        return True
+
+    def dropFile(self, key: str) -> None:
+        # caller holds the lock
+        size = self.disk.pop(key, None)
+        if size is None:
+            return
+        self.diskSize -= size
+        try:
+            os.remove(os.path.join(self.path, key))
+        except OSError:
+            pass
+
+    def readFile(self, key: str) -> bytes:
+        try:
+            with open(os.path.join(self.path, key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def gauges(self) -> None:
+        self.stats.gauge("blob.count", len(self.refs))
+        self.stats.gauge("blob.memory", self.memorySize)
+        self.stats.gauge("blob.disk", self.diskSize)
+
+
+def getBlobStore(config: OpenAIConfig) -> BlobStore:
+    path = config.visionBlobPath if os.path.isabs(config.visionBlobPath) else os.path.join(getRoot(), config.visionBlobPath)
+    return BlobStore(config.visionBlobBytes, config.visionBlobDiskBytes, path)
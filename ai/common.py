@@ -1,44 +1,98 @@
+import asyncio
 import os
-import subprocess
-from typing import Tuple
+from typing import List, Tuple
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
-from definition import CleanFunc
-from common import rmHandle
+from definition import MediaBuffer
+from ai.transcoder import Transcoder, getTranscoder, canConvertInProcess, convertWav
 
 from loguru import logger
 
+# retries are left to the call policy of the provider
 def getOpenAIClient(apiKey: str) -> OpenAI:
-    return OpenAI(api_key=apiKey)
-
-def convertToMp3(audioFile: str) -> Tuple[str, CleanFunc]:
-    name, ext = os.path.splitext(audioFile)
-    mp3file = name + ".mp3"
-
-    command = [
-		"ffmpeg",
-		"-i",
-		audioFile,
-		"-vn",
-		"-ar",
-		"44100",
-		"-ac",
-		"2",
-		"-ab",
-		"192k",
-		"-f",
-		"mp3",
-		mp3file
-	]
-
-    with open(os.devnull, 'w') as devnull:
-        result = subprocess.run(command, stdout=devnull, stderr=devnull)
-
-    if result.returncode != 0 or not os.path.exists(mp3file):
-        logger.error("failed to convert {} to mp3, error code {}", audioFile, result.returncode)
-        return None, None
-    
-    return mp3file, rmHandle(mp3file)
-    
+    return OpenAI(api_key=apiKey, max_retries=0)
 
+def getAsyncOpenAIClient(apiKey: str) -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=apiKey, max_retries=0)
+
+# formats the transcription endpoint takes as they are, and its upload limit
+whisperFormats = [".flac", ".m4a", ".mp3", ".mp4", ".mpeg", ".mpga", ".oga", ".ogg", ".wav", ".webm"]
+whisperMaxBytes = 25 * 1024 * 1024
+transcodePolicies = ["auto", "slim", "mp3"]
+seekingFormats = [".m4a", ".mp4", ".mov", ".3gp"]
+
+# drop leading silence, then the trailing one by running the same filter on the reversed audio
+trimFilter = "silenceremove=start_periods=1:start_threshold=-50dB,areverse,silenceremove=start_periods=1:start_threshold=-50dB,areverse"
+
+def prepareForTranscription(audio: MediaBuffer, policy: str = "auto", trimSilence: bool = False, transcoder: Transcoder = None) -> MediaBuffer:
+    # auto: pass accepted formats through, slim: always 16 kHz mono, mp3: the old 44.1 kHz stereo mp3
+    if policy == "mp3":
+        return convertToMp3(audio, transcoder)
+    if canPassThrough(audio, policy, trimSilence):
+        return audio
+    return convertToSpeech(audio, trimSilence, transcoder)
+
+async def prepareForTranscriptionAsync(audio: MediaBuffer, policy: str = "auto", trimSilence: bool = False, transcoder: Transcoder = None) -> MediaBuffer:
+    if policy == "mp3":
+        return await convertAsync(audio, mp3Args, ".mp3", transcoder)
+    if canPassThrough(audio, policy, trimSilence):
+        return audio
+    if canConvertInProcess(audio):
+        wav = await asyncio.to_thread(convertWav, audio, trimSilence)
+        if wav is not None:
+            return audible(wav)
+    return await convertAsync(audio, speechArgs(trimSilence), ".ogg", transcoder)
+
+def canPassThrough(audio: MediaBuffer, policy: str, trimSilence: bool) -> bool:
+    return policy == "auto" and not trimSilence and audio.ext() in whisperFormats and audio.size <= whisperMaxBytes
+
+mp3Args = ["-vn", "-ar", "44100", "-ac", "2", "-ab", "192k", "-f", "mp3"]
+
+def speechArgs(trimSilence: bool) -> List[str]:
+    # 16 kHz mono is all speech recognition needs, a fraction of the mp3 size
+    args = ["-vn", "-ar", "16000", "-ac", "1"]
+    if trimSilence:
+        args += ["-af", trimFilter]
+    return args + ["-c:a", "libopus", "-b:a", "24k", "-application", "voip", "-f", "ogg"]
+
+def convertToMp3(audio: MediaBuffer, transcoder: Transcoder = None) -> MediaBuffer:
+    return convert(audio, mp3Args, ".mp3", transcoder)
+
+def convertToSpeech(audio: MediaBuffer, trimSilence: bool = False, transcoder: Transcoder = None) -> MediaBuffer:
+    if canConvertInProcess(audio):
+        wav = convertWav(audio, trimSilence)
+        if wav is not None:
+            return audible(wav)
+    return convert(audio, speechArgs(trimSilence), ".ogg", transcoder)
+
+def audible(audio: MediaBuffer) -> MediaBuffer:
+    # an all silent clip leaves nothing to transcribe, the request is skipped
+    if audio.size == 0:
+        logger.info("{} is silent, not transcribed", audio.name)
+        return None
+    return audio
+
+def ffmpegCommand(audio: MediaBuffer, args: List[str]) -> Tuple[List[str], bytes]:
+    # fed over pipes, except containers that need seeking (mp4 with the index at the end)
+    if audio.ext() in seekingFormats:
+        return ["ffmpeg", "-i", audio.path()] + args + ["pipe:1"], None
+    return ["ffmpeg", "-i", "pipe:0"] + args + ["pipe:1"], audio.getValue()
+
+def convert(audio: MediaBuffer, args: List[str], ext: str, transcoder: Transcoder = None) -> MediaBuffer:
+    transcoder = transcoder or getTranscoder()
+    command, input = ffmpegCommand(audio, args)
+    return converted(audio, transcoder.run(command, input), ext)
+
+async def convertAsync(audio: MediaBuffer, args: List[str], ext: str, transcoder: Transcoder = None) -> MediaBuffer:
+    transcoder = transcoder or getTranscoder()
+    command, input = ffmpegCommand(audio, args)
+    return converted(audio, await transcoder.runAsync(command, input), ext)
+
+def converted(audio: MediaBuffer, output: bytes, ext: str) -> MediaBuffer:
+    if output is None:
+        logger.error("failed to convert {} to {}", audio.name, ext)
+        return None
+
+    name, _ = os.path.splitext(audio.name)
+    return MediaBuffer(name + ext, output)
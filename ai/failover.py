@@ -0,0 +1,106 @@
+from definition import Talk, MediaBuffer, Turn
+from ai.resilience import shouldFailOver
+
+from threading import Lock
+from typing import AsyncIterator, Callable, Iterable, List
+
+from loguru import logger
+
+
+class FailoverTalk(Talk):
+    # asks the primary provider, and the other one when the primary is out of capacity.
+    # the backup gets the text context of the primary and its answer is written back
+
+    def __init__(self, primary: Talk, createBackup: Callable[[], Talk]) -> None:
+        self.primary: Talk = primary
+        self.createBackup: Callable[[], Talk] = createBackup
+        self.backup: Talk = None
+        self.lock: Lock = Lock()
+
+    def getBackup(self) -> Talk:
+        with self.lock:
+            if self.backup is None:
+                self.backup = self.createBackup()
+            return self.backup
+
+    def handOver(self) -> Talk:
+        turns: List[Turn] = self.primary.history()
+        # the question the primary failed on is asked again
+        if len(turns) > 0 and turns[-1].role == "user":
+            turns = turns[:-1]
+        backup = self.getBackup()
+        backup.adopt(turns)
+        logger.info("primary provider is out of capacity, fail over, {}", str(self.primary.lastError()))
+        return backup
+
+    def ask(self, q: str) -> str:
+        answer = self.primary.ask(q)
+        if not shouldFailOver(self.primary.lastError()):
+            return answer
+        backup = self.handOver()
+        answer = backup.ask(q)
+        if backup.lastError() is None:
+            self.primary.takeAnswer(answer)
+        return answer
+
+    async def askAsync(self, q: str) -> str:
+        answer = await self.primary.askAsync(q)
+        if not shouldFailOver(self.primary.lastError()):
+            return answer
+        backup = self.handOver()
+        answer = await backup.askAsync(q)
+        if backup.lastError() is None:
+            self.primary.takeAnswer(answer)
+        return answer
+
+    def askStream(self, q: str) -> Iterable[str]:
+        # a failed primary yields nothing but its apology, so the first delta tells which way it went
+        first = True
+        for delta in self.primary.askStream(q):
+            if first and shouldFailOver(self.primary.lastError()):
+                break
+            first = False
+            yield delta
+        if not first or not shouldFailOver(self.primary.lastError()):
+            return
+
+        backup = self.handOver()
+        answer = []
+        for delta in backup.askStream(q):
+            answer.append(delta)
+            yield delta
+        if backup.lastError() is None:
+            self.primary.takeAnswer("".join(answer))
+
+    async def askStreamAsync(self, q: str) -> AsyncIterator[str]:
+        first = True
+        async for delta in self.primary.askStreamAsync(q):
+            if first and shouldFailOver(self.primary.lastError()):
+                break
+            first = False
+            yield delta
+        if not first or not shouldFailOver(self.primary.lastError()):
+            return
+
+        backup = self.handOver()
+        answer = []
+        async for delta in backup.askStreamAsync(q):
+            answer.append(delta)
+            yield delta
+        if backup.lastError() is None:
+            self.primary.takeAnswer("".join(answer))
+
+    def prepareImages(self, images: List[MediaBuffer] = None) -> None:
+        self.primary.prepareImages(images)
+
+    async def prepareImagesAsync(self, images: List[MediaBuffer] = None) -> None:
+        await self.primary.prepareImagesAsync(images)
+
+    def lastError(self) -> Exception:
+        return self.primary.lastError()
+
+    def getMemoryUsage(self) -> int:
+        size = self.primary.getMemoryUsage()
+        if self.backup is not None:
+            size += self.backup.getMemoryUsage()
+        return size
@@ -1,13 +1,18 @@
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Iterable, AsyncIterator, Tuple
+import asyncio
+import math
 import time
+from threading import Lock
 
 import google.generativeai as genai
 from google.generativeai import caching
 import PIL.Image
 
 from common import GeminiConfig
-from definition import Talk
+from definition import Talk, ChatID, ConversationStore, MediaBuffer, Turn
+from ai.geminiupload import GeminiUploads
+from ai.resilience import CallPolicy, EmptyResponse, getPolicy
 
 from loguru import logger
 
@@ -30,6 +35,47 @@ safety_settings = [
     }
 ]
 
+contentOverhead = 256 # rough bytes of a content dict or an uploaded file handle
+imageTokens = 258 # what gemini bills for a picture
+bytesPerToken = 4 # first guess of the local estimate, calibrated by the token counts gemini reports
+apologyMessage = "I apologize, but the Gemini API is currently unavailable. Kindly try again at a later time."
+
+class TokenScale:
+    # ratio of reported to locally estimated tokens, shared by all talks
+
+    def __init__(self) -> None:
+        self.lock: Lock = Lock()
+        self.scale: float = 1.0
+        self.samples: int = 0
+
+    def get(self) -> float:
+        return self.scale
+
+    def calibrate(self, estimate: int, reported: int) -> None:
+        if estimate <= 0 or reported <= 0:
+            return
+        with self.lock:
+            ratio = reported / estimate
+            # average the first few samples evenly, then follow slowly
+            weight = max(1 / (self.samples + 1), 0.1)
+            self.scale += (ratio - self.scale) * weight
+            self.samples += 1
+
+
+tokenScale = TokenScale()
+
+
+def estimateTokens(content: dict) -> int:
+    # cheap local estimate, utf-8 bytes are closer than characters for non latin text
+    tokens = 0
+    for part in content['parts']:
+        if isinstance(part, str):
+            tokens += math.ceil(len(part.encode("utf-8")) / bytesPerToken)
+        else:
+            tokens += imageTokens
+    return tokens
+
+
 configuredKey = None
 def configureGemini(apiKey: str):
     global configuredKey
@@ -39,15 +85,30 @@ def configureGemini(apiKey: str):
         
 class GeminiTalk(Talk):
 
-    def __init__(self, botName: str, config: GeminiConfig) -> None:
+    def __init__(self, botName: str, config: GeminiConfig, store: ConversationStore = None, cid: ChatID = None, uploads: GeminiUploads = None) -> None:
         self.apiKey: str = config.apiKey
+        self.store: ConversationStore = store
+        self.cid: ChatID = cid
+        self.hydrated: bool = store is None
         configureGemini(self.apiKey)
         
         self.initModel(config.model)
         self.lastMessage = datetime.now()
         self.ctxTimeout = timedelta(seconds=config.contextTimeout)
         self.visionModel = genai.GenerativeModel(config.visionModel)
+        self.uploads: GeminiUploads = uploads or getGeminiUploads(config)
+        self.policy: CallPolicy = getPolicy("gemini")
+        self.error: Exception = None # why the last question got no answer
+        self.maxContextTokens: int = config.maxContextTokens
+        # stable head of the context kept on the server, requests only send what follows it
+        self.cacheTokens: int = config.contextCacheTokens
+        self.cache: caching.CachedContent = None
+        self.cachedModel: genai.GenerativeModel = None
+        self.cachedCount: int = 0 # entries of pendingContent in the cache
+        self.cacheExpires: float = 0
         self.pendingContent = []
+        self.contentTokens: List[int] = [] # local estimate of each entry of pendingContent
+        self.contextTokens: int = 0 # sum of contentTokens
         self.greeting = [
             {
                 'role': 'user',
@@ -58,7 +119,7 @@ class GeminiTalk(Talk):
                 'parts': [f'You can call me {botName}.']
             },
         ]
-        self.pendingContent.extend(self.greeting)
+        self.expireContext()
     
     def initModel(self, model):
         self.model = genai.GenerativeModel(
@@ -67,66 +128,356 @@ class GeminiTalk(Talk):
         )
         
     def expireContext(self):
+        self.dropCache()
         self.pendingContent = []
-        self.pendingContent.extend(self.greeting)
+        self.contentTokens = []
+        self.contextTokens = 0
+        for content in self.greeting:
+            self.appendContent(content)
 
-    def ask(self, q: str) -> str:
+    def appendContent(self, content: dict) -> None:
+        tokens = estimateTokens(content)
+        self.pendingContent.append(content)
+        self.contentTokens.append(tokens)
+        self.contextTokens += tokens
+        # answers are trimmed with the next question, right before the request, not right after the cache was made
+        if content['role'] == 'user':
+            self.trimContext()
+
+    def trimContext(self) -> None:
+        # drop the oldest turns after the greeting until the estimate fits, the latest one is always kept
+        scale = tokenScale.get()
+        if self.contextTokens * scale <= self.maxContextTokens:
+            return
+        # with a cache, drop a cache's worth at once, the cache made after it then lasts until the budget is full again
+        target = self.maxContextTokens - self.cacheTokens if self.cacheTokens > 0 else self.maxContextTokens
+        keep = len(self.greeting)
+        while self.contextTokens * scale > target and len(self.pendingContent) > keep + 1:
+            self.dropContent(keep)
+            # the history after the greeting starts with a user turn
+            while len(self.pendingContent) > keep + 1 and self.pendingContent[keep]['role'] != 'user':
+                self.dropContent(keep)
+
+    def dropContent(self, i: int) -> None:
+        if i < self.cachedCount:
+            self.dropCache()
+        self.pendingContent.pop(i)
+        self.contextTokens -= self.contentTokens.pop(i)
+
+    def prepareCache(self) -> None:
+        # cache everything before the pending question once the part not cached yet is worth it
+        if self.cacheTokens <= 0:
+            return
+        now = time.monotonic()
+        if self.cache is not None and now > self.cacheExpires:
+            # gone on the server already
+            self.cache, self.cachedModel, self.cachedCount = None, None, 0
+
+        end = len(self.pendingContent)
+        while end > 0 and self.pendingContent[end - 1]['role'] == 'user':
+            end -= 1
+        scale = tokenScale.get()
+        fresh = sum(self.contentTokens[self.cachedCount:end]) * scale
+        # a new cache made this close to the budget would go with the next trim, keep the one there is until then
+        closeToTrim = self.cache is not None and self.contextTokens * scale + self.cacheTokens > self.maxContextTokens
+        if fresh < self.cacheTokens or closeToTrim:
+            if self.cache is not None and self.cacheExpires - now < self.ctxTimeout.total_seconds() / 2:
+                self.extendCache(now)
+            return
+
+        self.dropCache()
+        try:
+            cache = caching.CachedContent.create(model=self.model.model_name, contents=self.pendingContent[:end], ttl=self.ctxTimeout)
+        except Exception as e:
+            logger.warning("failed to cache context of chat {}, caching is off for it, {}", self.cid, str(e))
+            self.cacheTokens = 0
+            return
+        self.cache = cache
+        self.cachedModel = genai.GenerativeModel.from_cached_content(cached_content=cache, safety_settings=safety_settings)
+        self.cachedCount = end
+        self.cacheExpires = now + self.ctxTimeout.total_seconds()
+        logger.debug("cached {} entries of chat {} as {}", end, self.cid, cache.name)
+
+    def extendCache(self, now: float) -> None:
+        # the context lives on while the chat is active, so does its cache
+        try:
+            self.cache.update(ttl=self.ctxTimeout)
+            self.cacheExpires = now + self.ctxTimeout.total_seconds()
+        except Exception as e:
+            logger.warning("failed to extend context cache {}, {}", self.cache.name, str(e))
+
+    def dropCache(self) -> None:
+        if self.cache is None:
+            return
+        try:
+            self.cache.delete()
+        except Exception as e:
+            logger.debug("failed to delete context cache {}, {}", self.cache.name, str(e))
+        self.cache, self.cachedModel, self.cachedCount = None, None, 0
+
+    def requestContents(self) -> Tuple[genai.GenerativeModel, list]:
+        if self.cache is not None:
+            return self.cachedModel, self.pendingContent[self.cachedCount:]
+        return self.model, self.pendingContent
+
+    def lastError(self) -> Exception:
+        return self.error
+
+    def history(self) -> List[Turn]:
+        turns = []
+        for content in self.pendingContent[len(self.greeting):]:
+            text = "\n".join(p for p in content['parts'] if isinstance(p, str))
+            if len(text) > 0:
+                turns.append(Turn(role="assistant" if content['role'] == 'model' else "user", text=text))
+        return turns
+
+    def adopt(self, turns: List[Turn]) -> None:
+        self.hydrated = True
+        self.expireContext()
+        for turn in turns:
+            self.appendContent({
+                'role': 'model' if turn.role == "assistant" else 'user',
+                'parts': [turn.text]
+            })
+        self.lastMessage = datetime.now()
+
+    def takeAnswer(self, answer: str) -> None:
+        if len(self.pendingContent) > len(self.greeting) and self.pendingContent[-1]['role'] == 'user':
+            self.error = None
+            self.endTurn(answer)
+
+    def calibrate(self, resp) -> None:
+        usage = getattr(resp, 'usage_metadata', None)
+        reported = getattr(usage, 'prompt_token_count', 0) if usage is not None else 0
+        if reported > 0:
+            tokenScale.calibrate(self.contextTokens, reported)
+
+    def getMemoryUsage(self) -> int:
+        size = 0
+        for content in self.pendingContent:
+            size += contentOverhead
+            for part in content['parts']:
+                size += len(part) if isinstance(part, str) else contentOverhead
+        return size
+
+    def hydrate(self) -> None:
+        # rebuild the context from the store on the first message after a restart
+        if self.hydrated:
+            return
+        self.hydrated = True
+
+        try:
+            turns = self.store.load(self.cid, time.time() - self.ctxTimeout.total_seconds())
+        except Exception as e:
+            logger.error("failed to load conversation of chat {}, {}", self.cid, str(e))
+            return
+
+        for turn in turns:
+            parts = []
+            for ref in turn.images:
+                try:
+                    # uploaded files outlive the context timeout on the server
+                    parts.append(genai.get_file(ref))
+                except Exception as e:
+                    logger.warning("uploaded file {} is gone, {}", ref, str(e))
+            if turn.text is not None:
+                parts.append(turn.text)
+            if len(parts) > 0:
+                self.appendContent({
+                    'role': 'model' if turn.role == "assistant" else 'user',
+                    'parts': parts
+                })
+
+        if len(turns) > 0:
+            self.lastMessage = datetime.fromtimestamp(turns[-1].ts)
+            logger.debug("restored {} turns of chat {}", len(turns), self.cid)
+
+    def beginTurn(self, q: str) -> None:
+        self.hydrate()
         now = datetime.now()
         if now > self.lastMessage + self.ctxTimeout:
             self.expireContext()
         
-        self.pendingContent.append(
+        self.appendContent(
             {
                 'role': 'user',
                 'parts': [q]
             }
         )
-            
-        retry = 3
-        while retry > 0:
-            try:
-                resp = self.model.generate_content(self.pendingContent)
-                resp.resolve()
-
-                self.pendingContent.append({
-                    'role': 'model',
-                    'parts': [resp.text]
-                })
+        if self.store is not None:
+            self.store.append(self.cid, Turn(role="user", text=q))
+
+    def endTurn(self, answer: str) -> None:
+        self.appendContent({
+            'role': 'model',
+            'parts': [answer]
+        })
+        if self.store is not None:
+            self.store.append(self.cid, Turn(role="assistant", text=answer))
+
+    def ask(self, q: str) -> str:
+        self.beginTurn(q)
+        self.prepareCache()
+        model, contents = self.requestContents()
+
+        text = apologyMessage
+        self.error = None
+        try:
+            for attempt in self.policy.attempts():
+                try:
+                    resp = model.generate_content(contents, request_options={'timeout': attempt.timeout()})
+                    resp.resolve()
+                    answer = resp.text
+                    if answer is None or len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    attempt.success()
+                except Exception as e:
+                    attempt.failure(e)
+            self.calibrate(resp)
+            self.endTurn(answer)
+            text = answer
+        except Exception as e:
+            logger.error("request failed, {}", str(e))
+            self.error = e
 
-                text = resp.text
-                
-                break
-            except Exception as e:
-                logger.exception(str(e))
-                retry -= 1
-            
         self.lastMessage = datetime.now()
         return text
 
-    def prepareImages(self, images: List[str]=None) -> None:
+    async def askAsync(self, q: str) -> str:
+        # loading the stored conversation waits on the store and the file api, not on the event loop
+        await asyncio.to_thread(self.hydrate)
+        self.beginTurn(q)
+        await asyncio.to_thread(self.prepareCache)
+        model, contents = self.requestContents()
+
+        text = apologyMessage
+        self.error = None
+        try:
+            async for attempt in self.policy.attemptsAsync():
+                try:
+                    resp = await model.generate_content_async(contents, request_options={'timeout': attempt.timeout()})
+                    await resp.resolve()
+                    answer = resp.text
+                    if answer is None or len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    attempt.success()
+                except Exception as e:
+                    attempt.failure(e)
+            self.calibrate(resp)
+            self.endTurn(answer)
+            text = answer
+        except Exception as e:
+            logger.error("request failed, {}", str(e))
+            self.error = e
+
+        self.lastMessage = datetime.now()
+        return text
+
+    def askStream(self, q: str) -> Iterable[str]:
+        self.beginTurn(q)
+        self.prepareCache()
+        model, contents = self.requestContents()
+
+        answer: List[str] = []
+        self.error = None
+        try:
+            for attempt in self.policy.attempts():
+                try:
+                    for chunk in model.generate_content(contents, stream=True, request_options={'timeout': attempt.timeout()}):
+                        delta = chunk.text
+                        if delta is not None and len(delta) > 0:
+                            answer.append(delta)
+                            yield delta
+                    if len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    # the last chunk reports the prompt size
+                    self.calibrate(chunk)
+                    attempt.success()
+                except Exception as e:
+                    if len(answer) > 0:
+                        # part of the answer is already shown, keep it rather than start over
+                        logger.warning("stream broke off, {}", str(e))
+                        # the provider did answer, a probe that got this far counts as recovered
+                        attempt.success()
+                        break
+                    attempt.failure(e)
+        except Exception as e:
+            logger.error("stream request failed, {}", str(e))
+            self.error = e
+
+        if len(answer) > 0:
+            self.endTurn("".join(answer))
+        else:
+            yield apologyMessage
+
+        self.lastMessage = datetime.now()
+
+    async def askStreamAsync(self, q: str) -> AsyncIterator[str]:
+        await asyncio.to_thread(self.hydrate)
+        self.beginTurn(q)
+        await asyncio.to_thread(self.prepareCache)
+        model, contents = self.requestContents()
+
+        answer: List[str] = []
+        self.error = None
+        try:
+            async for attempt in self.policy.attemptsAsync():
+                try:
+                    async for chunk in await model.generate_content_async(contents, stream=True, request_options={'timeout': attempt.timeout()}):
+                        delta = chunk.text
+                        if delta is not None and len(delta) > 0:
+                            answer.append(delta)
+                            yield delta
+                    if len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    # the last chunk reports the prompt size
+                    self.calibrate(chunk)
+                    attempt.success()
+                except Exception as e:
+                    if len(answer) > 0:
+                        # part of the answer is already shown, keep it rather than start over
+                        logger.warning("stream broke off, {}", str(e))
+                        # the provider did answer, a probe that got this far counts as recovered
+                        attempt.success()
+                        break
+                    attempt.failure(e)
+        except Exception as e:
+            logger.error("stream request failed, {}", str(e))
+            self.error = e
+
+        if len(answer) > 0:
+            self.endTurn("".join(answer))
+        else:
+            yield apologyMessage
+
+        self.lastMessage = datetime.now()
+
+    def prepareImages(self, images: List[MediaBuffer]=None) -> None:
+        self.hydrate()
         now = datetime.now()
         if now > self.lastMessage + self.ctxTimeout:
             self.expireContext()
         
         parts = self.uploadFiles(images)
         if len(parts) > 0:
-            self.pendingContent.append(
+            self.appendContent(
                 {
                     'role': 'user',
                     'parts': parts
                 }
             )
+            if self.store is not None:
+                # the uploaded file name is the reference, the image itself stays on the server
+                self.store.append(self.cid, Turn(role="user", images=[p.name for p in parts]))
 
         self.lastMessage = datetime.now()
 
 
-    def uploadFiles(self, files: List[str]=None):
-        parts = []
-        for f in files:
-            upload = genai.upload_file(path=f)
-            while upload.state.name == 'PROCESSING':
-                time.sleep(2)
-                upload = genai.get_file(upload.name)
-            parts.append(upload)
-        return parts
+    def uploadFiles(self, files: List[MediaBuffer]=None):
+        return self.uploads.upload(files or [])
+
+
+def getGeminiUploads(config: GeminiConfig) -> GeminiUploads:
+    # an uploaded file is reused while it outlives the conversation referring to it
+    return GeminiUploads(config.uploadWorkers, config.uploadTimeout, config.contextTimeout)
  
\ No newline at end of file
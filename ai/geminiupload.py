@@ -0,0 +1,110 @@
+from definition import MediaBuffer
+from common import Stats
+
+import hashlib
+import mimetypes
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, List
+
+import google.generativeai as genai
+from google.generativeai.types import File
+from loguru import logger
+
+pollFirst = 0.25 # seconds before the first state check of a processing file
+pollMax = 4.0
+
+
+class GeminiUploads:
+    # uploads of all gemini talks, run concurrently and kept by content until the server expires them
+
+    def __init__(self, workers: int = 4, timeout: float = 60, keep: float = 600) -> None:
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemini-upload")
+        self.timeout: float = timeout # seconds an upload may take until the file is active
+        self.keep: float = keep # seconds an uploaded file must stay valid to be reused
+        self.lock: Lock = Lock()
+        self.files: Dict[str, File] = {}
+        self.inflight: Dict[str, Future] = {}
+        self.stats: Stats = Stats()
+
+    def upload(self, files: List[MediaBuffer]) -> List[File]:
+        futures = [self.submit(f) for f in files]
+        uploads = []
+        for f, future in zip(files, futures):
+            try:
+                upload = future.result()
+            except Exception as e:
+                logger.error("failed to upload {}, {}", f.name, str(e))
+                self.stats.incr("upload.failed")
+                continue
+            if upload is not None:
+                uploads.append(upload)
+        return uploads
+
+    def submit(self, f: MediaBuffer) -> Future:
+        key = hashlib.sha256(f.getValue()).hexdigest()
+        with self.lock:
+            upload = self.files.get(key)
+            if upload is not None and self.valid(upload):
+                self.stats.incr("upload.reused")
+                future = Future()
+                future.set_result(upload)
+                return future
+            self.files.pop(key, None)
+
+            # the same picture sent twice at once is uploaded once
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.pool.submit(self.uploadFile, key, f)
+                self.inflight[key] = future
+            return future
+
+    def valid(self, upload: File) -> bool:
+        expires = upload.expiration_time
+        if expires is None:
+            return True
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        return (expires - datetime.now(timezone.utc)).total_seconds() > self.keep
+
+    def uploadFile(self, key: str, f: MediaBuffer) -> File:
+        start = time.monotonic()
+        active = None
+        try:
+            mimeType = mimetypes.guess_type(f.name)[0] or "image/jpeg"
+            upload = genai.upload_file(path=f.reader(), mime_type=mimeType, display_name=f.name)
+            active = self.waitActive(upload, start + self.timeout)
+        finally:
+            with self.lock:
+                if active is not None:
+                    self.files[key] = active
+                    self.evict()
+                self.inflight.pop(key, None)
+
+        self.stats.observe("upload.latency", time.monotonic() - start)
+        return active
+
+    def waitActive(self, upload: File, deadline: float) -> File:
+        delay = pollFirst
+        while upload.state.name == "PROCESSING":
+            if time.monotonic() + delay > deadline:
+                logger.error("uploaded file {} still processing, give up", upload.name)
+                self.stats.incr("upload.timeout")
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, pollMax)
+            upload = genai.get_file(upload.name)
+
+        if upload.state.name != "ACTIVE":
+            logger.error("uploaded file {} is {}", upload.name, upload.state.name)
+            self.stats.incr("upload.failed")
+            return None
+        return upload
+
+    def evict(self) -> None:
+        # caller holds the lock
+        for key in [k for k, upload in self.files.items() if not self.valid(upload)]:
+            del self.files[key]
+        self.stats.gauge("upload.cached", len(self.files))
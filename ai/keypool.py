@@ -0,0 +1,109 @@
+from common import OpenAIConfig, Stats, TokenBucket
+from ai.common import getOpenAIClient, getAsyncOpenAIClient
+from ai.resilience import RateLimited, retryAfter, statusOf
+
+import re
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import List, Mapping
+
+from openai import OpenAI, AsyncOpenAI
+
+resetUnits = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parseReset(value: str) -> float:
+    # "1s", "6m0s", "59.789s", "20ms"
+    if value is None:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if len(parts) == 0:
+        return None
+    return sum(float(n) * resetUnits[unit] for n, unit in parts)
+
+
+@dataclass
+class KeySlot:
+    name: str # never the key itself, it is logged
+    client: OpenAI
+    asyncClient: AsyncOpenAI
+    requests: TokenBucket = None
+    tokens: TokenBucket = None
+    coolUntil: float = 0
+    inflight: int = 0
+
+
+class KeyPool:
+    # api keys of one provider, each request goes to the key with the most room left
+
+    def __init__(self, slots: List[KeySlot], rpm: int = 500, tpm: int = 60000) -> None:
+        self.lock: Lock = Lock()
+        self.slots: List[KeySlot] = slots
+        for slot in slots:
+            slot.requests = slot.requests or TokenBucket(rpm)
+            slot.tokens = slot.tokens or TokenBucket(tpm)
+        self.stats: Stats = Stats()
+
+    def acquire(self, tokens: int) -> KeySlot:
+        now = time.monotonic()
+        with self.lock:
+            best, bestRoom = None, -1.0
+            for slot in self.slots:
+                if slot.coolUntil > now or not slot.requests.canTake(1, now) or not slot.tokens.canTake(tokens, now):
+                    continue
+                room = min(slot.requests.fraction(now), slot.tokens.fraction(now)) / (slot.inflight + 1)
+                if room > bestRoom:
+                    best, bestRoom = slot, room
+            if best is None:
+                self.stats.incr("keys.exhausted")
+                raise RateLimited("all keys are at their rate limit", self.nextFree(tokens, now))
+            best.requests.take(1)
+            best.tokens.take(tokens)
+            best.inflight += 1
+            self.stats.incr("keys." + best.name)
+            return best
+
+    def nextFree(self, tokens: int, now: float) -> float:
+        # caller holds the lock
+        return min(max(s.coolUntil - now, s.requests.waitFor(1), s.tokens.waitFor(tokens)) for s in self.slots)
+
+    def release(self, slot: KeySlot, headers: Mapping[str, str] = None, error: Exception = None) -> None:
+        if error is not None:
+            headers = getattr(getattr(error, "response", None), "headers", None)
+        with self.lock:
+            slot.inflight -= 1
+            if headers is not None:
+                self.observe(slot, headers)
+            if error is not None and statusOf(error) == 429:
+                wait = retryAfter(error)
+                slot.coolUntil = time.monotonic() + (wait if wait is not None else 1)
+                self.stats.incr("keys.limited")
+
+    def observe(self, slot: KeySlot, headers: Mapping[str, str]) -> None:
+        # caller holds the lock
+        for kind, bucket in (("requests", slot.requests), ("tokens", slot.tokens)):
+            try:
+                limit = headers.get("x-ratelimit-limit-" + kind)
+                remaining = headers.get("x-ratelimit-remaining-" + kind)
+                if limit is None or remaining is None:
+                    continue
+                bucket.sync(float(limit), float(remaining), parseReset(headers.get("x-ratelimit-reset-" + kind)))
+            except ValueError:
+                continue
+
+    def available(self) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            return any(s.coolUntil <= now and s.requests.canTake(1, now) for s in self.slots)
+
+    def retryNow(self, error: Exception) -> bool:
+        # a 429 has put its key in cooldown by now, another free key can take the retry at once,
+        # every other error is the provider's and waits out the backoff
+        return statusOf(error) == 429 and self.available()
+
+
+def getKeyPool(config: OpenAIConfig) -> KeyPool:
+    keys = [config.apiKey] + [k for k in config.apiKeys if k != config.apiKey]
+    slots = [KeySlot(f"key{i}", getOpenAIClient(k), getAsyncOpenAIClient(k)) for i, k in enumerate(keys)]
+    return KeyPool(slots, config.rpm, config.tpm)
@@ -1,31 +1,47 @@
 from __future__ import annotations
-import base64
 from dataclasses import dataclass, field
 from datetime import time, datetime, timedelta
-from typing import List, Dict
+import asyncio
+import time as systime
+from typing import List, Dict, Iterable, Tuple, Deque, AsyncIterator
+from collections import deque
+from itertools import chain
 
-from definition import Talk
+from definition import Talk, ChatID, ConversationStore, MediaBuffer, Turn
 from common import Config, OpenAIConfig
-from ai.common import getOpenAIClient
+from ai.keypool import KeyPool, getKeyPool
+from ai.vision import ImagePipeline, VisionImage, getImagePipeline
+from ai.blobs import BlobStore, BlobHandle
+from ai.resilience import CallPolicy, EmptyResponse, getPolicy
 
 
-from openai import APIConnectionError, APITimeoutError
-from openai.types.chat import ChatCompletion, ChatCompletionMessage, ChatCompletionRole
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage, ChatCompletionRole
 from tiktoken import Encoding, encoding_for_model
 
 # const
 maxMessageQueueToken = 4096
 #maxMessageQueueToken = 1000
 CompletionTimeout    = timedelta(seconds=1)
+qaOverhead = 256 # rough bytes of a QA object besides its strings
+apologyMessage = "I apologize, but the OpenAI API is currently experiencing high traffic. Kindly try again at a later time."
 
 from loguru import logger
 
+def chunkDelta(chunk: ChatCompletionChunk) -> str:
+    if len(chunk.choices) == 0:
+        return None
+    delta = chunk.choices[0].delta.content
+    if delta is None or len(delta) == 0:
+        return None
+    return delta
+
 @dataclass
 class QA:
     q: str = field(default=None) # question
     a: str = field(default=None) # answer
     s: str = field(default=None) # system role
-    p: str = field(default=None) # picture
+    p: BlobHandle = field(default=None) # picture, kept in the shared blob store
+    t: int = field(default=0) # token count, counted once when the entry is created or answered
 
 
 
@@ -33,95 +49,162 @@ class QA:
     
 
 class OpenAITalk(Talk):
-    def __init__(self, botName: str, cfg: OpenAIConfig) -> None:
+    def __init__(self, botName: str, cfg: OpenAIConfig, store: ConversationStore = None, cid: ChatID = None, images: ImagePipeline = None, blobs: BlobStore = None,
+                 keys: KeyPool = None) -> None:
         self.botName: str = botName
+        self.store: ConversationStore = store
+        self.cid: ChatID = cid
+        self.hydrated: bool = store is None
         self.ctxTimeout: timedelta = timedelta(seconds=cfg.contextTimeout)
         self.lastMessage: datetime = None
+        self.model = cfg.model
+        self.encoding: Encoding = encoding_for_model(self.model)
         self.greeting = QA(
             s =  "You are a helpful assistant. Your name is %s." % self.botName
         )
-        self.messageQueue: List[QA] = []
-        self.model = cfg.model
-        self.encoding: Encoding = encoding_for_model(self.model)
-        self.client = getOpenAIClient(cfg.apiKey)
-        self.requestTimeout = 30
+        self.greeting.t = self.getTOkenCount(self.greeting.s)
+        # conversation history without greeting, oldest first
+        self.messageQueue: Deque[QA] = deque()
+        self.queueToken: int = self.greeting.t # token count of greeting plus messageQueue
+        self.queueImages: int = 0 # number of picture entries in messageQueue
+        self.keys: KeyPool = keys or getKeyPool(cfg)
+        self.error: Exception = None # why the last question got no answer
+        self.policy: CallPolicy = getPolicy("openai")
         
         # vision process
         self.visionModel: str = cfg.visionModel
         self.visionMaxToken: int = cfg.visionMaxToken
         self.visionTimeout: timedelta = timedelta(seconds=cfg.visionContextTimeout)
+        self.visionDetail: str = cfg.visionDetail
+        self.images: ImagePipeline = images or getImagePipeline(cfg)
+        self.blobs: BlobStore = blobs or BlobStore(cfg.visionBlobBytes)
     
-    def getImageTokenCount(self, image: str) -> int:
-        return 1024 if image is not None else 0 # I know it's not accurate
+    def getImageTokenCount(self, image: MediaBuffer) -> int:
+        return self.images.prepare(image).tokens if image is not None else 0
+
+    def imageMessage(self, prepared: VisionImage) -> QA:
+        return QA(p=self.blobs.put(prepared.data, prepared.mime), t=prepared.tokens)
         
-    def prepareNewImageMessage(self, image: str) -> None:
-        totalToken = self.getTOkenCount(self.greeting.s)
+    def prepareNewImageMessage(self, image: MediaBuffer) -> None:
+        self.hydrate()
         qa = QA()
         if image is not None:
-            totalToken += self.getImageTokenCount(image)
-            with open(image, 'rb') as img:
-                qa.p = base64.b64encode(img.read()).decode('utf-8')
+            prepared = self.images.prepare(image)
+            qa = self.imageMessage(prepared)
+            if self.store is not None:
+                # the prepared picture is stored, a restore finds it in the pipeline cache or passes it through
+                self.store.append(self.cid, Turn(role="user", images=[self.store.putBlob(prepared.data)]))
         
         now = datetime.now()
         isOld: bool = self.lastMessage is not None and now > (self.lastMessage + self.visionTimeout)
-        
-        newQ: List[QA] = [qa,]
 
-        self.messageQueue = self.appendHistoryMessage(newQ, totalToken, isOld)
+        self.appendHistoryMessage(qa, isOld)
         self.lastMessage = now
     
     def prepareNewMessage(self, msg: str) -> None:
-        totalToken = self.getTOkenCount(msg) + self.getTOkenCount(self.greeting.s)
+        self.hydrate()
         now = datetime.now()
         isOld: bool = self.lastMessage is not None and now > (self.lastMessage + self.ctxTimeout)
 
-        for qa in self.messageQueue:
-            if qa.p is not None:
-                # shorter context timeout for vision request
-                isOld = self.lastMessage is not None and now > (self.lastMessage + self.visionTimeout)
-                break
+        if self.queueImages > 0:
+            # shorter context timeout for vision request
+            isOld = self.lastMessage is not None and now > (self.lastMessage + self.visionTimeout)
 
-        newQ: List[QA] = [QA(q=msg),]
+        self.appendHistoryMessage(QA(q=msg, t=self.getTOkenCount(msg)), isOld)
+        if self.store is not None:
+            self.store.append(self.cid, Turn(role="user", text=msg))
 
-        self.messageQueue = self.appendHistoryMessage(newQ, totalToken, isOld)
-    
-    def appendHistoryMessage(self, ql: List[QA], totalToken: int, tooOld: bool) -> List[QA]:
-        # add conversation history
-        for i in range(len(self.messageQueue) -1, 0, -1): # skip 0 because it's always greeting
-            qa = self.messageQueue[i]
-            if totalToken >= maxMessageQueueToken or tooOld:
-                break
-            cnt = self.getTOkenCount(qa.q) + self.getTOkenCount(qa.a) + self.getImageTokenCount(qa.p)
-            if totalToken + cnt > maxMessageQueueToken:
-                break
-            
-            ql.append(qa)
-            totalToken += cnt
-        
-        ql.append(self.greeting)
+    def hydrate(self) -> None:
+        # rebuild the context from the store on the first message after a restart
+        if self.hydrated:
+            return
+        self.hydrated = True
 
-        # reverse new queue
-        for i in range(int(len(ql)/2)):
-            j = len(ql) -1 -i
-            ql[i], ql[j] = ql[j], ql[i] # swap
-        
-        return ql
-        
+        since = systime.time() - max(self.ctxTimeout, self.visionTimeout).total_seconds()
+        try:
+            turns = self.store.load(self.cid, since)
+        except Exception as e:
+            logger.error("failed to load conversation of chat {}, {}", self.cid, str(e))
+            return
+
+        for turn in turns:
+            if turn.role == "assistant":
+                if len(self.messageQueue) > 0 and self.messageQueue[-1].a is None:
+                    self.appendAnswer(turn.text)
+                continue
+            for ref in turn.images:
+                data = self.store.getBlob(ref)
+                if data is not None:
+                    self.appendHistoryMessage(self.imageMessage(self.images.prepare(MediaBuffer(ref, data))), False)
+            if turn.text is not None:
+                self.appendHistoryMessage(QA(q=turn.text, t=self.getTOkenCount(turn.text)), False)
 
+        if len(turns) > 0:
+            self.lastMessage = datetime.fromtimestamp(turns[-1].ts)
+            logger.debug("restored {} turns of chat {}", len(turns), self.cid)
     
+    def appendHistoryMessage(self, qa: QA, tooOld: bool) -> None:
+        if tooOld:
+            for old in self.messageQueue:
+                self.dropped(old)
+            self.messageQueue.clear()
+            self.queueToken = self.greeting.t
+            self.queueImages = 0
+
+        self.messageQueue.append(qa)
+        self.queueToken += qa.t
+        if qa.p is not None:
+            self.queueImages += 1
+        self.trimHistory()
+
+    def appendAnswer(self, answer: str) -> None:
+        qa = self.messageQueue[-1]
+        cnt = self.getTOkenCount(answer)
+        qa.a = answer
+        qa.t += cnt
+        self.queueToken += cnt
+        self.trimHistory()
+
+    def answered(self, answer: str) -> None:
+        self.appendAnswer(answer)
+        self.lastMessage = datetime.now()
+        if self.store is not None:
+            self.store.append(self.cid, Turn(role="assistant", text=answer))
+
+    def trimHistory(self) -> None:
+        # drop the oldest entries until the window fits, the latest one is always kept
+        while self.queueToken > maxMessageQueueToken and len(self.messageQueue) > 1:
+            qa = self.messageQueue.popleft()
+            self.queueToken -= qa.t
+            if qa.p is not None:
+                self.queueImages -= 1
+            self.dropped(qa)
+
+    def dropped(self, qa: QA) -> None:
+        if qa.p is not None:
+            qa.p.release()
+
+    def getMemoryUsage(self) -> int:
+        size = qaOverhead
+        for qa in self.messageQueue:
+            size += qaOverhead
+            # pictures live in the blob store, a handle is about the size of a QA
+            for v in (qa.q, qa.a):
+                if v is not None:
+                    size += len(v)
+        return size
+
     def getTOkenCount(self, msg: str) -> int:
         if msg is None or msg == "":
             return 0
         return len(self.encoding.encode(msg))
 
 
-    def ask(self, q: str) -> str:
-        self.prepareNewMessage(q)
-
+    def buildMessages(self) -> Tuple[List[Dict], bool]:
         messages = []
         
         hasImage = False
-        for msg in self.messageQueue:
+        for msg in chain((self.greeting,), self.messageQueue):
             if msg.s is not None and msg.s != "":
                 messages.append(
                     {
@@ -143,7 +226,9 @@ class OpenAITalk(Talk):
                         "content": msg.a
                     }
                 )
-            if msg.p is not None and msg.p != "":
+            # the data url is only built here, the conversation keeps a handle
+            url = msg.p.dataUrl() if msg.p is not None else None
+            if url is not None:
                 hasImage = True
                 if msg.q is not None and msg.q != "":
                     messages.append(
@@ -157,7 +242,8 @@ class OpenAITalk(Talk):
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{msg.p}"
+                                        "url": url,
+                                        "detail": self.visionDetail
                                     }
                                 }
                             ]
@@ -172,47 +258,211 @@ class OpenAITalk(Talk):
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{msg.p}"
+                                        "url": url,
+                                        "detail": self.visionDetail
                                     }
                                 }
                             ]
                         }
                     )
-                
-        
-        retry = 3
-        while retry > 0:
-            try:
-                if hasImage:
-                    resp: ChatCompletion = self.client.chat.completions.create(
-                        model=self.visionModel,
-                        messages=messages,
-                        timeout=self.requestTimeout,
-                        max_tokens=maxMessageQueueToken
-                    )
-                else:
-                    resp: ChatCompletion = self.client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        timeout=self.requestTimeout
-                    )
-                
-                answer = resp.choices[0].message.content
-                if answer is not None and len(answer) > 0:
-                    self.messageQueue[-1].a = answer
-                    self.lastMessage = datetime.now()
-                    return answer
-            except (APITimeoutError, APIConnectionError) as e:
-                logger.warn("request wass likely timed out, {}", str(e))
-                retry -= 1
-            except Exception as e:
-                logger.warn("request failed, {}", str(e))
-                retry -= 1
-                
-        logger.error("request failed, retry run out")
-        return "I apologize, but the OpenAI API is currently experiencing high traffic. Kindly try again at a later time."
-
-    def prepareImages(self, images: List[str]=None) -> None:
+
+        return messages, hasImage
+
+    def complete(self, args: Dict):
+        # through the key with the most room, its rate limit headers refill its buckets
+        slot = self.keys.acquire(self.queueToken)
+        try:
+            raw = slot.client.chat.completions.with_raw_response.create(**args)
+        except Exception as e:
+            self.keys.release(slot, error=e)
+            raise
+        self.keys.release(slot, raw.headers)
+        return raw.parse()
+
+    async def completeAsync(self, args: Dict):
+        slot = self.keys.acquire(self.queueToken)
+        try:
+            raw = await slot.asyncClient.chat.completions.with_raw_response.create(**args)
+        except Exception as e:
+            self.keys.release(slot, error=e)
+            raise
+        self.keys.release(slot, raw.headers)
+        return raw.parse()
+
+    def lastError(self) -> Exception:
+        return self.error
+
+    def history(self) -> List[Turn]:
+        turns = []
+        for qa in self.messageQueue:
+            if qa.q is not None:
+                turns.append(Turn(role="user", text=qa.q))
+            if qa.a is not None:
+                turns.append(Turn(role="assistant", text=qa.a))
+        return turns
+
+    def adopt(self, turns: List[Turn]) -> None:
+        self.hydrated = True
+        for qa in self.messageQueue:
+            self.dropped(qa)
+        self.messageQueue.clear()
+        self.queueToken = self.greeting.t
+        self.queueImages = 0
+        for turn in turns:
+            if turn.role == "assistant":
+                if len(self.messageQueue) > 0 and self.messageQueue[-1].a is None:
+                    self.appendAnswer(turn.text)
+            elif turn.text is not None:
+                self.appendHistoryMessage(QA(q=turn.text, t=self.getTOkenCount(turn.text)), False)
+        self.lastMessage = datetime.now()
+
+    def takeAnswer(self, answer: str) -> None:
+        if len(self.messageQueue) > 0 and self.messageQueue[-1].a is None:
+            self.error = None
+            self.answered(answer)
+
+    def completionArgs(self, messages: List[Dict], hasImage: bool, timeout: float, stream: bool = False) -> Dict:
+        if hasImage:
+            return dict(
+                model=self.visionModel,
+                messages=messages,
+                timeout=timeout,
+                max_tokens=maxMessageQueueToken,
+                stream=stream
+            )
+        return dict(
+            model=self.model,
+            messages=messages,
+            timeout=timeout,
+            stream=stream
+        )
+
+    def ask(self, q: str) -> str:
+        self.prepareNewMessage(q)
+        messages, hasImage = self.buildMessages()
+        self.error = None
+
+        try:
+            for attempt in self.policy.attempts():
+                try:
+                    resp: ChatCompletion = self.complete(self.completionArgs(messages, hasImage, attempt.timeout()))
+                    answer = resp.choices[0].message.content
+                    if answer is None or len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    attempt.success()
+                except Exception as e:
+                    # after a 429 another key may take the retry at once
+                    attempt.failure(e, self.keys.retryNow(e))
+        except Exception as e:
+            logger.error("request failed, {}", str(e))
+            self.error = e
+            return apologyMessage
+
+        self.answered(answer)
+        return answer
+
+    async def askAsync(self, q: str) -> str:
+        # loading the stored conversation may wait on the store, not on the event loop
+        await asyncio.to_thread(self.hydrate)
+        self.prepareNewMessage(q)
+        messages, hasImage = self.buildMessages()
+        self.error = None
+
+        try:
+            async for attempt in self.policy.attemptsAsync():
+                try:
+                    resp: ChatCompletion = await self.completeAsync(self.completionArgs(messages, hasImage, attempt.timeout()))
+                    answer = resp.choices[0].message.content
+                    if answer is None or len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    attempt.success()
+                except Exception as e:
+                    # after a 429 another key may take the retry at once
+                    attempt.failure(e, self.keys.retryNow(e))
+        except Exception as e:
+            logger.error("request failed, {}", str(e))
+            self.error = e
+            return apologyMessage
+
+        self.answered(answer)
+        return answer
+
+    def askStream(self, q: str) -> Iterable[str]:
+        self.prepareNewMessage(q)
+        messages, hasImage = self.buildMessages()
+        self.error = None
+
+        answer: List[str] = []
+        try:
+            for attempt in self.policy.attempts():
+                try:
+                    stream: Iterable[ChatCompletionChunk] = self.complete(self.completionArgs(messages, hasImage, attempt.timeout(), stream=True))
+                    for chunk in stream:
+                        delta = chunkDelta(chunk)
+                        if delta is not None:
+                            answer.append(delta)
+                            yield delta
+                    if len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    attempt.success()
+                except Exception as e:
+                    if len(answer) > 0:
+                        # part of the answer is already shown, keep it rather than start over
+                        logger.warning("stream broke off, {}", str(e))
+                        # the provider did answer, a probe that got this far counts as recovered
+                        attempt.success()
+                        break
+                    # after a 429 another key may take the retry at once
+                    attempt.failure(e, self.keys.retryNow(e))
+        except Exception as e:
+            logger.error("stream request failed, {}", str(e))
+            self.error = e
+
+        if len(answer) == 0:
+            yield apologyMessage
+            return
+
+        self.answered("".join(answer))
+
+    async def askStreamAsync(self, q: str) -> AsyncIterator[str]:
+        await asyncio.to_thread(self.hydrate)
+        self.prepareNewMessage(q)
+        messages, hasImage = self.buildMessages()
+        self.error = None
+
+        answer: List[str] = []
+        try:
+            async for attempt in self.policy.attemptsAsync():
+                try:
+                    stream: AsyncIterator[ChatCompletionChunk] = await self.completeAsync(self.completionArgs(messages, hasImage, attempt.timeout(), stream=True))
+                    async for chunk in stream:
+                        delta = chunkDelta(chunk)
+                        if delta is not None:
+                            answer.append(delta)
+                            yield delta
+                    if len(answer) == 0:
+                        raise EmptyResponse("empty answer")
+                    attempt.success()
+                except Exception as e:
+                    if len(answer) > 0:
+                        # part of the answer is already shown, keep it rather than start over
+                        logger.warning("stream broke off, {}", str(e))
+                        # the provider did answer, a probe that got this far counts as recovered
+                        attempt.success()
+                        break
+                    # after a 429 another key may take the retry at once
+                    attempt.failure(e, self.keys.retryNow(e))
+        except Exception as e:
+            logger.error("stream request failed, {}", str(e))
+            self.error = e
+
+        if len(answer) == 0:
+            yield apologyMessage
+            return
+
+        self.answered("".join(answer))
+
+    def prepareImages(self, images: List[MediaBuffer]=None) -> None:
         for img in images:
             self.prepareNewImageMessage(img)
 
@@ -0,0 +1,281 @@
+from common import Stats, SystemConfig
+
+import asyncio
+import email.utils
+import random
+import time
+from threading import Lock
+from typing import AsyncIterator, Callable, Dict, Iterator, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+
+retryStatus = [408, 409, 429]
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str) -> None:
+        super().__init__(f"{name} is failing, calls are paused")
+
+
+class RateLimited(Exception):
+    # a limit known on our side, nothing was sent
+    def __init__(self, message: str, wait: float) -> None:
+        super().__init__(message)
+        self.wait: float = wait
+
+
+class EmptyResponse(Exception):
+    # an answer without content, worth another try
+    pass
+
+
+def statusOf(e: Exception) -> int:
+    # openai errors carry status_code, google api errors an http code
+    for attr in ("status_code", "code"):
+        status = getattr(e, attr, None)
+        if isinstance(status, int) and 100 <= status < 600:
+            return status
+    return None
+
+
+def isRetryable(e: Exception) -> bool:
+    status = statusOf(e)
+    if status is not None:
+        return status in retryStatus or status >= 500
+    if isinstance(e, (EmptyResponse, RateLimited, TimeoutError, ConnectionError)):
+        return True
+    # client library network errors, httpx and openai alike
+    name = type(e).__name__
+    return "Timeout" in name or "Connect" in name
+
+
+def retryAfter(e: Exception) -> float:
+    # seconds the server asked to wait, None if it didn't
+    if isinstance(e, RateLimited):
+        return e.wait
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers is None:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms is not None:
+            return float(ms) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def shouldFailOver(e: Exception) -> bool:
+    # the provider is out of capacity for us, another one may still answer
+    return e is not None and (statusOf(e) == 429 or isinstance(e, (RateLimited, CircuitOpen)))
+
+
+class CircuitBreaker:
+    # opens after a run of failures, fails fast while open, then lets one probe through
+
+    def __init__(self, name: str, threshold: int = 5, reset: float = 30) -> None:
+        self.name: str = name
+        self.threshold: int = threshold
+        self.reset: float = reset
+        self.lock: Lock = Lock()
+        self.failures: int = 0
+        self.openedAt: float = None
+        self.probing: bool = False
+        self.probeStarted: float = 0
+
+    def check(self) -> bool:
+        # true when this call is let through as the probe
+        with self.lock:
+            if self.openedAt is None:
+                return False
+            now = time.monotonic()
+            # a probe that never reported back is given up after reset as well
+            if now - self.openedAt < self.reset or (self.probing and now - self.probeStarted < self.reset):
+                raise CircuitOpen(self.name)
+            self.probing = True
+            self.probeStarted = now
+            return True
+
+    def release(self) -> None:
+        # the probe ended without an outcome, the next call may probe again
+        with self.lock:
+            self.probing = False
+
+    def success(self) -> None:
+        with self.lock:
+            if self.openedAt is not None:
+                logger.info("{} recovered", self.name)
+            self.failures = 0
+            self.openedAt = None
+            self.probing = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.openedAt is None and self.failures >= self.threshold):
+                if not self.probing:
+                    logger.error("{} failed {} times in a row, pause calls for {} seconds", self.name, self.failures, self.reset)
+                self.openedAt = time.monotonic()
+                self.probing = False
+
+    def isOpen(self) -> bool:
+        return self.openedAt is not None
+
+
+class Attempt:
+    # one try of a call, the caller reports how it went
+
+    def __init__(self, policy: "CallPolicy", number: int, deadline: float, probe: bool = False) -> None:
+        self.policy: CallPolicy = policy
+        self.number: int = number
+        self.deadline: float = deadline
+        self.probe: bool = probe
+        self.done: bool = False
+        self.reported: bool = False
+        self.wait: float = 0
+
+    def timeout(self) -> float:
+        # request timeout of this try, never past the deadline
+        return max(0.1, min(self.policy.requestTimeout, self.deadline - time.monotonic()))
+
+    def success(self) -> None:
+        self.done = True
+        self.reported = True
+        self.policy.breaker.success()
+
+    def failure(self, e: Exception, immediate: bool = False) -> None:
+        # raises e when the call should give up, otherwise sets how long to wait before the next try.
+        # immediate retries at once, when the next try won't hit the same limit
+        policy = self.policy
+        self.reported = True
+        if not isRetryable(e):
+            # the provider answered, it is the request that is wrong
+            policy.breaker.success()
+            raise e
+        if not isinstance(e, RateLimited):
+            # our own limit says nothing about the provider
+            policy.breaker.failure()
+        if self.number + 1 >= policy.maxAttempts:
+            policy.stats.incr(policy.name + ".exhausted")
+            raise e
+
+        wait = 0 if immediate else retryAfter(e)
+        if wait is None:
+            # full jitter keeps clients that failed together from coming back together
+            wait = random.uniform(0, min(policy.maxDelay, policy.baseDelay * 2 ** self.number))
+        if time.monotonic() + wait >= self.deadline:
+            policy.stats.incr(policy.name + ".deadline")
+            raise e
+        logger.warning("{} call failed, retry in {:.2f} seconds, {}", policy.name, wait, str(e))
+        policy.stats.incr(policy.name + ".retry")
+        self.wait = wait
+
+
+class CallPolicy:
+    # how calls to one provider are retried, shared by everything calling it
+    #
+    #   for attempt in policy.attempts():
+    #       try:
+    #           result = request(timeout=attempt.timeout())
+    #           attempt.success()
+    #       except Exception as e:
+    #           attempt.failure(e)
+
+    def __init__(self, name: str, attempts: int = 3, baseDelay: float = 0.5, maxDelay: float = 8, deadline: float = 60,
+                 requestTimeout: float = 30, breaker: CircuitBreaker = None) -> None:
+        self.name: str = name
+        self.maxAttempts: int = attempts
+        self.baseDelay: float = baseDelay
+        self.maxDelay: float = maxDelay
+        self.deadline: float = deadline # seconds all tries of one call may take
+        self.requestTimeout: float = requestTimeout
+        self.breaker: CircuitBreaker = breaker or CircuitBreaker(name)
+        self.stats: Stats = Stats()
+
+    def attempts(self, deadline: float = None) -> Iterator[Attempt]:
+        deadline = deadline or time.monotonic() + self.deadline
+        for number in range(self.maxAttempts):
+            attempt = Attempt(self, number, deadline, self.check())
+            try:
+                yield attempt
+            finally:
+                # a break, a closed stream or a cancelled task leave the attempt unreported
+                if attempt.probe and not attempt.reported:
+                    self.breaker.release()
+            if attempt.done or not attempt.reported:
+                return
+            time.sleep(attempt.wait)
+
+    async def attemptsAsync(self, deadline: float = None) -> AsyncIterator[Attempt]:
+        deadline = deadline or time.monotonic() + self.deadline
+        for number in range(self.maxAttempts):
+            attempt = Attempt(self, number, deadline, self.check())
+            try:
+                yield attempt
+            finally:
+                if attempt.probe and not attempt.reported:
+                    self.breaker.release()
+            if attempt.done or not attempt.reported:
+                return
+            await asyncio.sleep(attempt.wait)
+
+    def check(self) -> bool:
+        try:
+            return self.breaker.check()
+        except CircuitOpen:
+            self.stats.incr(self.name + ".rejected")
+            raise
+
+    def call(self, request: Callable[[float], T]) -> T:
+        # request gets the timeout of its try
+        for attempt in self.attempts():
+            try:
+                result = request(attempt.timeout())
+                attempt.success()
+                return result
+            except Exception as e:
+                attempt.failure(e)
+
+    async def callAsync(self, request: Callable[[float], T]) -> T:
+        async for attempt in self.attemptsAsync():
+            try:
+                result = await request(attempt.timeout())
+                attempt.success()
+                return result
+            except Exception as e:
+                attempt.failure(e)
+
+
+policies: Dict[str, CallPolicy] = {}
+policyConfig: SystemConfig = None
+policyLock: Lock = Lock()
+
+
+def configurePolicies(config: SystemConfig) -> None:
+    global policyConfig
+    with policyLock:
+        policyConfig = config
+        policies.clear()
+
+
+def getPolicy(name: str) -> CallPolicy:
+    # one policy and circuit breaker per provider
+    with policyLock:
+        policy = policies.get(name)
+        if policy is None:
+            if policyConfig is None:
+                policy = CallPolicy(name)
+            else:
+                c = policyConfig
+                policy = CallPolicy(name, c.retryAttempts, c.retryBaseDelay, c.retryMaxDelay, c.requestDeadline,
+                                    breaker=CircuitBreaker(name, c.breakerThreshold, c.breakerReset))
+            policies[name] = policy
+        return policy
@@ -1,57 +1,217 @@
-from definition import SpeechToText, TextToSpeech, CleanFunc
-from common import rmHandle
-from ai.common import getOpenAIClient
+from definition import SpeechToText, TextToSpeech, MediaBuffer
+from ai.common import getOpenAIClient, getAsyncOpenAIClient, prepareForTranscription, prepareForTranscriptionAsync, transcodePolicies, whisperMaxBytes
+from ai.transcoder import Transcoder, decodePcm, decodePcmAsync, pcmToWav, splitPcm, trimPcm
+from ai.speechcache import SpeechCache, speechKey
+from ai.resilience import CallPolicy, getPolicy
 
-from typing import Tuple
-import os, uuid, tempfile
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 from loguru import logger
 
+speechFormat = "opus"
+speechFile = "speech.ogg"
+speechChunk = 64 * 1024
+
 class Wisper(SpeechToText):
-    def __init__(self, apiKey: str) -> None:
+    # long audio is cut at quiet spots into overlapping segments that are transcribed concurrently
+
+    def __init__(self, apiKey: str, transcodePolicy: str = "auto", trimSilence: bool = False, transcoder: Transcoder = None,
+                 segmentSeconds: float = 0, overlapSeconds: float = 1, workers: int = 4) -> None:
         self.client = getOpenAIClient(apiKey)
-        self.requestTimeout = 30
+        self.asyncClient = getAsyncOpenAIClient(apiKey)
+        self.policy: CallPolicy = getPolicy("openai")
+        if transcodePolicy not in transcodePolicies:
+            raise ValueError("unknown transcode policy: " + transcodePolicy)
+        self.transcodePolicy: str = transcodePolicy
+        self.trimSilence: bool = trimSilence
+        self.transcoder: Transcoder = transcoder
+        self.segmentSeconds: float = segmentSeconds
+        self.overlapSeconds: float = overlapSeconds
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+        self.slots: asyncio.Semaphore = asyncio.Semaphore(workers)
+
+    def prepare(self, audio: MediaBuffer) -> MediaBuffer:
+        return prepareForTranscription(audio, self.transcodePolicy, self.trimSilence, self.transcoder)
+
+    async def prepareAsync(self, audio: MediaBuffer) -> MediaBuffer:
+        return await prepareForTranscriptionAsync(audio, self.transcodePolicy, self.trimSilence, self.transcoder)
+
+    def isLong(self, audio: MediaBuffer) -> bool:
+        if self.segmentSeconds <= 0:
+            return False
+        if audio.duration > 0:
+            return audio.duration > self.segmentSeconds
+        # unknown length, only what can't be sent in one request
+        return audio.size > whisperMaxBytes
+
+    def segment(self, audio: MediaBuffer) -> List[MediaBuffer]:
+        pcm = decodePcm(audio, self.transcoder)
+        if pcm is None:
+            return None
+        return self.split(audio, pcm)
+
+    async def segmentAsync(self, audio: MediaBuffer) -> List[MediaBuffer]:
+        # ffmpeg runs on the transcoder pool, no thread waits for it
+        pcm = await decodePcmAsync(audio, self.transcoder)
+        if pcm is None:
+            return None
+        return await asyncio.to_thread(self.split, audio, pcm)
+
+    def split(self, audio: MediaBuffer, pcm: bytes) -> List[MediaBuffer]:
+        if self.trimSilence:
+            pcm = trimPcm(pcm)
+        name, _ = os.path.splitext(audio.name)
+        ranges = splitPcm(pcm, self.segmentSeconds, self.overlapSeconds)
+        logger.debug("transcribe {} in {} segments", audio.name, len(ranges))
+        return [MediaBuffer(f"{name}-{i}.wav", pcmToWav(pcm[a:b])) for i, (a, b) in enumerate(ranges)]
 
-    def convert(self, audFile: str) -> str:
-        retry = 3
-        while retry > 0:
+    def convert(self, audio: MediaBuffer) -> str:
+        if self.isLong(audio):
+            segments = self.segment(audio)
+            if segments is not None:
+                return stitchTranscripts(list(self.pool.map(self.transcribe, segments)))
+
+        audio = self.prepare(audio)
+        if audio is None:
+            return None
+        return self.transcribe(audio)
+
+    async def convertAsync(self, audio: MediaBuffer) -> str:
+        if self.isLong(audio):
+            segments = await self.segmentAsync(audio)
+            if segments is not None:
+                return stitchTranscripts(await asyncio.gather(*[self.transcribeAsync(s) for s in segments]))
+
+        audio = await self.prepareAsync(audio)
+        if audio is None:
+            return None
+        return await self.transcribeAsync(audio)
+
+    def transcribe(self, audio: MediaBuffer) -> str:
+        try:
+            transcript = self.policy.call(lambda timeout: self.client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(audio.name, audio.reader()),
+                timeout=timeout
+            ))
+            return transcript.text
+        except Exception as e:
+            logger.error("speech2text request failed, {}", str(e))
+            return None
+
+    async def transcribeAsync(self, audio: MediaBuffer) -> str:
+        async with self.slots:
             try:
-                with open(audFile, "rb") as bin:
-                    transcript = self.client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=bin,
-                        timeout=self.requestTimeout
-                    )
-                    break
+                transcript = await self.policy.callAsync(lambda timeout: self.asyncClient.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(audio.name, audio.reader()),
+                    timeout=timeout
+                ))
+                return transcript.text
             except Exception as e:
-                retry -= 1
-                logger.warn("speech2text request failed, {}", str(e))
+                logger.error("speech2text request failed, {}", str(e))
+                return None
+
+
+def normalizeWord(w: str) -> str:
+    return "".join(ch for ch in w.lower() if ch.isalnum())
+
+
+def stitchTranscripts(texts: List[str], maxSeam: int = 20) -> str:
+    # neighbouring segments overlap, so the words that end one transcript may start the next,
+    # None when no segment was transcribed, like a failed single request
+    if all(text is None for text in texts):
+        return None
+    words: List[str] = []
+    for text in texts:
+        if text is None:
+            continue
+        new = text.split()
+        tail = [normalizeWord(w) for w in words[-maxSeam:]]
+        head = [normalizeWord(w) for w in new[:maxSeam]]
+        seam = 0
+        for k in range(min(len(tail), len(head)), 0, -1):
+            if tail[-k:] == head[:k]:
+                seam = k
+                break
+        words.extend(new[seam:])
+    return " ".join(words)
+
 
-        return transcript.text
-        
 class ReadText(TextToSpeech):
-    def __init__(self, apiKey: str) -> None:
+    # opus in ogg is what telegram plays as a voice note
+
+    def __init__(self, apiKey: str, model: str = "tts-1", voice: str = "nova", cache: SpeechCache = None) -> None:
         self.client = getOpenAIClient(apiKey)
-        self.requestTimeout = 30
-    
-    def convert(self, text: str) -> Tuple[str, CleanFunc]:
-        retry = 3
-        while retry > 0:
-            try:
-                response = self.client.audio.speech.create(
-                    model="tts-1",
-                    voice="nova",
-                    input=text,
-                    response_format="aac",
-                    timeout=self.requestTimeout
-                )
-                break
-            except Exception as e:
-                logger.warn("text2speech request failed, {}", str(e))
-                retry -= 1
-        
-        filename = str(uuid.uuid4()) + ".aac"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-        response.stream_to_file(filepath)
-
-        return filepath, rmHandle(filepath)
\ No newline at end of file
+        self.asyncClient = getAsyncOpenAIClient(apiKey)
+        self.policy: CallPolicy = getPolicy("openai")
+        self.model: str = model
+        self.voice: str = voice
+        self.cache: SpeechCache = cache
+
+    def cached(self, key: str) -> MediaBuffer:
+        if self.cache is None:
+            return None
+        data = self.cache.get(key)
+        return MediaBuffer(speechFile, data) if data is not None else None
+
+    def remember(self, key: str, speech: MediaBuffer) -> None:
+        if self.cache is not None:
+            self.cache.put(key, speech.getValue())
+
+    def convert(self, text: str) -> MediaBuffer:
+        key = speechKey(text, self.voice, self.model, speechFormat)
+        speech = self.cached(key)
+        if speech is not None:
+            return speech
+
+        def request(timeout: float) -> MediaBuffer:
+            speech = MediaBuffer(speechFile)
+            with self.client.audio.speech.with_streaming_response.create(
+                model=self.model,
+                voice=self.voice,
+                input=text,
+                response_format=speechFormat,
+                timeout=timeout
+            ) as response:
+                for chunk in response.iter_bytes(speechChunk):
+                    speech.write(chunk)
+            return speech
+
+        try:
+            speech = self.policy.call(request)
+        except Exception as e:
+            logger.error("text2speech request failed, {}", str(e))
+            return None
+        self.remember(key, speech)
+        return speech
+
+    async def convertAsync(self, text: str) -> MediaBuffer:
+        key = speechKey(text, self.voice, self.model, speechFormat)
+        speech = self.cached(key)
+        if speech is not None:
+            return speech
+
+        async def request(timeout: float) -> MediaBuffer:
+            speech = MediaBuffer(speechFile)
+            async with self.asyncClient.audio.speech.with_streaming_response.create(
+                model=self.model,
+                voice=self.voice,
+                input=text,
+                response_format=speechFormat,
+                timeout=timeout
+            ) as response:
+                async for chunk in response.iter_bytes(speechChunk):
+                    speech.write(chunk)
+            return speech
+
+        try:
+            speech = await self.policy.callAsync(request)
+        except Exception as e:
+            logger.error("text2speech request failed, {}", str(e))
+            return None
+        self.remember(key, speech)
+        return speech
@@ -0,0 +1,130 @@
+from common import OpenAIConfig, Stats, getRoot
+
+import hashlib
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from loguru import logger
+
+
+def speechKey(text: str, voice: str, model: str, format: str) -> str:
+    return hashlib.sha256("\0".join([model, voice, format, text]).encode("utf-8")).hexdigest()
+
+
+class SpeechCache:
+    # synthesized speech by content key. recently used entries stay in memory,
+    # older ones are spilled to files in a directory, both sides evict least recently used first
+
+    def __init__(self, memoryBytes: int, diskBytes: int = 0, path: str = None) -> None:
+        self.lock: Lock = Lock()
+        self.memoryBytes: int = memoryBytes
+        self.diskBytes: int = diskBytes if path is not None else 0
+        self.path: str = path
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memorySize: int = 0
+        self.disk: OrderedDict[str, int] = OrderedDict() # key -> file size
+        self.diskSize: int = 0
+        self.stats: Stats = Stats()
+        if self.diskBytes > 0:
+            os.makedirs(path, exist_ok=True)
+            self.loadIndex()
+
+    def loadIndex(self) -> None:
+        # spilled entries survive a restart, oldest first
+        entries = []
+        for name in os.listdir(self.path):
+            full = os.path.join(self.path, name)
+            if os.path.isfile(full):
+                st = os.stat(full)
+                entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self.disk[name] = size
+            self.diskSize += size
+        self.evictDisk()
+
+    def get(self, key: str) -> bytes:
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.stats.incr("tts.hit")
+                return data
+            if key not in self.disk:
+                self.stats.incr("tts.miss")
+                return None
+
+        data = self.readFile(key)
+        with self.lock:
+            if data is None:
+                self.dropFile(key)
+                self.stats.incr("tts.miss")
+                return None
+            self.stats.incr("tts.hit")
+            self.stats.incr("tts.diskHit")
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            self.putMemory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        with self.lock:
+            self.putMemory(key, data)
+
+    def putMemory(self, key: str, data: bytes) -> None:
+        # caller holds the lock
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memorySize -= len(old)
+        self.memory[key] = data
+        self.memorySize += len(data)
+        while self.memorySize > self.memoryBytes and len(self.memory) > 0:
+            oldKey, oldData = self.memory.popitem(last=False)
+            self.memorySize -= len(oldData)
+            self.spill(oldKey, oldData)
+
+    def spill(self, key: str, data: bytes) -> None:
+        # caller holds the lock
+        if self.diskBytes <= 0 or len(data) > self.diskBytes:
+            return
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            return
+        try:
+            with open(os.path.join(self.path, key), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error("failed to spill speech {}, {}", key, str(e))
+            return
+        self.disk[key] = len(data)
+        self.diskSize += len(data)
+        self.evictDisk()
+
+    def evictDisk(self) -> None:
+        # caller holds the lock
+        while self.diskSize > self.diskBytes and len(self.disk) > 0:
+            self.dropFile(next(iter(self.disk)))
+
+    def dropFile(self, key: str) -> None:
+        size = self.disk.pop(key, None)
+        if size is None:
+            return
+        self.diskSize -= size
+        try:
+            os.remove(os.path.join(self.path, key))
+        except OSError:
+            pass
+
+    def readFile(self, key: str) -> bytes:
+        try:
+            with open(os.path.join(self.path, key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+def getSpeechCache(config: OpenAIConfig) -> SpeechCache:
+    if config.ttsCacheBytes <= 0 and config.ttsCacheDiskBytes <= 0:
+        return None
+    path = config.ttsCachePath if os.path.isabs(config.ttsCachePath) else os.path.join(getRoot(), config.ttsCachePath)
+    return SpeechCache(config.ttsCacheBytes, config.ttsCacheDiskBytes, path)
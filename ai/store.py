@@ -0,0 +1,165 @@
+from definition import ChatID, ConversationStore, Turn
+from common import StoreConfig, getRoot
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from typing import List, Tuple
+
+from loguru import logger
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS turns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cid TEXT NOT NULL,
+        ts REAL NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT,
+        images TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS turns_cid_ts ON turns (cid, ts)",
+    """CREATE TABLE IF NOT EXISTS blobs (
+        ref TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        ts REAL NOT NULL
+    )""",
+]
+
+pruneInterval = 3600
+
+
+def blobRef(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+class SqliteConversationStore(ConversationStore):
+    # writes are queued and committed in batches by one writer thread,
+    # reads use their own connection, WAL lets both run at once
+
+    def __init__(self, config: StoreConfig) -> None:
+        self.path: str = config.path if os.path.isabs(config.path) else os.path.join(getRoot(), config.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.flushInterval: float = config.flushInterval
+        self.batchSize: int = config.batchSize
+        self.retention: float = config.retention
+
+        self.readLock: Lock = Lock()
+        self.reader: sqlite3.Connection = self.connect()
+        for stmt in schema:
+            self.reader.execute(stmt)
+        self.reader.commit()
+
+        # items are (sql, params) or an Event to set once everything before it is committed
+        self.pending: Queue = Queue()
+        self.closed: bool = False
+        self.writer: Thread = Thread(target=self.writeLoop, name="conversation-store", daemon=True)
+        self.writer.start()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(self, cid: ChatID, turn: Turn) -> None:
+        ts = turn.ts if turn.ts > 0 else time.time()
+        images = json.dumps(turn.images) if len(turn.images) > 0 else None
+        self.pending.put((
+            "INSERT INTO turns (cid, ts, role, text, images) VALUES (?, ?, ?, ?, ?)",
+            (cid, ts, turn.role, turn.text, images)
+        ))
+
+    def putBlob(self, data: bytes) -> str:
+        ref = blobRef(data)
+        self.pending.put((
+            # a blob seen again is kept as long as its latest use
+            "INSERT INTO blobs (ref, data, ts) VALUES (?, ?, ?) ON CONFLICT (ref) DO UPDATE SET ts = excluded.ts",
+            (ref, data, time.time())
+        ))
+        return ref
+
+    def flush(self, timeout: float = 10) -> None:
+        done = Event()
+        self.pending.put(done)
+        done.wait(timeout)
+
+    def load(self, cid: ChatID, since: float) -> List[Turn]:
+        # turns still queued for this chat must be visible
+        self.flush()
+        with self.readLock:
+            rows = self.reader.execute(
+                "SELECT ts, role, text, images FROM turns WHERE cid = ? AND ts > ? ORDER BY id",
+                (cid, since)
+            ).fetchall()
+        return [Turn(role=role, text=text, images=json.loads(images) if images else [], ts=ts) for ts, role, text, images in rows]
+
+    def getBlob(self, ref: str) -> bytes:
+        self.flush()
+        with self.readLock:
+            row = self.reader.execute("SELECT data FROM blobs WHERE ref = ?", (ref,)).fetchone()
+        return None if row is None else row[0]
+
+    def writeLoop(self) -> None:
+        conn = self.connect()
+        lastPrune = 0.0
+        while not self.closed or not self.pending.empty():
+            batch: List[Tuple[str, tuple]] = []
+            waiters: List[Event] = []
+            try:
+                item = self.pending.get(timeout=self.flushInterval)
+            except Empty:
+                item = None
+            # collect whatever else is queued, up to a batch
+            while item is not None:
+                if isinstance(item, Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batchSize:
+                    break
+                try:
+                    item = self.pending.get_nowait()
+                except Empty:
+                    item = None
+
+            if len(batch) > 0:
+                try:
+                    with conn:
+                        for sql, params in batch:
+                            conn.execute(sql, params)
+                except Exception as e:
+                    logger.error("failed to write {} conversation records, {}", len(batch), str(e))
+            for w in waiters:
+                w.set()
+
+            now = time.time()
+            if self.retention > 0 and now - lastPrune > pruneInterval:
+                lastPrune = now
+                self.prune(conn, now - self.retention)
+        conn.close()
+
+    def prune(self, conn: sqlite3.Connection, before: float) -> None:
+        try:
+            with conn:
+                conn.execute("DELETE FROM turns WHERE ts < ?", (before,))
+                conn.execute("DELETE FROM blobs WHERE ts < ?", (before,))
+        except Exception as e:
+            logger.error("failed to prune conversation store, {}", str(e))
+
+    def close(self) -> None:
+        self.closed = True
+        self.writer.join()
+        with self.readLock:
+            self.reader.close()
+
+
+def getConversationStore(config: StoreConfig) -> ConversationStore:
+    if config is None or config.backend == "none":
+        return None
+    if config.backend == "sqlite":
+        return SqliteConversationStore(config)
+    raise ValueError("unknown conversation store backend: " + config.backend)
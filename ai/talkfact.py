@@ -1,34 +1,161 @@
-from definition import ConversationID, Conversation, AITalkFactory, ChatID, ImageRecognizer, Talk
+from definition import ConversationID, Conversation, AITalkFactory, ChatID, ImageRecognizer, Talk, ConversationStore
 
 from common import Config
+from ai.store import getConversationStore
 
 from ai.openaitalk import OpenAITalk
-from ai.geminitalk import GeminiTalk
+from ai.vision import ImagePipeline, getImagePipeline
+from ai.blobs import BlobStore, getBlobStore
+from ai.geminitalk import GeminiTalk, getGeminiUploads
+from ai.geminiupload import GeminiUploads
+from ai.keypool import KeyPool, getKeyPool
+from ai.failover import FailoverTalk
 
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from threading import Lock
 from typing import Dict
 from loguru import logger
 
+
+@dataclass
+class Session:
+    talk: Talk
+    lastUsed: float
+    size: int = 0 # estimated bytes, measured when the session is handed out
+
+
 class AITalkFactory(AITalkFactory):
 
     def __init__(self, config: Config) -> None:
         self.config: Config = config
-        self.talks: Dict[ChatID, Talk] = {}
+        self.lock: Lock = Lock()
+        # least recently used first
+        self.talks: OrderedDict[ChatID, Session] = OrderedDict()
+        self.creating: Dict[ChatID, Future] = {}
+        self.totalSize: int = 0
+        self.store: ConversationStore = getConversationStore(config.store)
+        # shared by all talks so a forwarded picture is prepared once
+        self.images: ImagePipeline = getImagePipeline(config.openAI) if config.openAI is not None else None
+        self.blobs: BlobStore = getBlobStore(config.openAI) if config.openAI is not None else None
+        self.uploads: GeminiUploads = getGeminiUploads(config.gemini) if config.gemini is not None else None
+        self.keys: KeyPool = getKeyPool(config.openAI) if config.openAI is not None else None
 
-    
-    def getTalk(self, cid: ChatID) -> Talk:
-        if cid in self.talks:
-            return self.talks[cid]
+        self.maxSessions: int = config.system.maxSessions
+        self.maxBytes: int = config.system.maxSessionBytes
+        self.idleTimeout: float = config.system.sessionIdleTimeout
+        if self.idleTimeout <= 0:
+            # an idle talk has no usable context after this anyway
+            ctx = self.config.gemini if self.useGemini() else self.config.openAI
+            self.idleTimeout = ctx.contextTimeout
+
+    def useGemini(self) -> bool:
+        return self.config.system.useGemini and self.config.gemini is not None
 
-        if self.config.system.useGemini and self.config.gemini is not None:
+    def canFailOver(self) -> bool:
+        c = self.config
+        return c.system.providerFailover and c.openAI is not None and c.openAI.apiKey != "" \
+            and c.gemini is not None and c.gemini.apiKey != ""
+
+    def createGeminiTalk(self, cid: ChatID, store: ConversationStore) -> Talk:
+        return GeminiTalk(self.config.botName, self.config.gemini, store, cid, self.uploads)
+
+    def createOpenAITalk(self, cid: ChatID, store: ConversationStore) -> Talk:
+        return OpenAITalk(self.config.botName, self.config.openAI, store, cid, self.images, self.blobs, self.keys)
+
+    def createTalk(self, cid: ChatID) -> Talk:
+        if self.useGemini():
             logger.debug("create gemini talk for chat {}", cid)
-            talk = GeminiTalk(self.config.botName, self.config.gemini)
+            talk = self.createGeminiTalk(cid, self.store)
+            backup = self.createOpenAITalk
         else:
             logger.debug("create openai talk for chat {}", cid)
-            try:
-                talk = OpenAITalk(self.config.botName, self.config.openAI)
-            except Exception as e:
-                logger.error("fail to create openai talk, %s", str(e))
-        self.talks[cid] = talk
-        
+            talk = self.createOpenAITalk(cid, self.store)
+            backup = self.createGeminiTalk
+
+        if not self.canFailOver():
+            return talk
+        # the backup only borrows the context, the primary keeps storing it
+        return FailoverTalk(talk, lambda: backup(cid, None))
+
+    def getTalk(self, cid: ChatID) -> Talk:
+        now = time.monotonic()
+        with self.lock:
+            session = self.talks.get(cid)
+            if session is not None and now - session.lastUsed < self.idleTimeout:
+                self.talks.move_to_end(cid)
+                session.lastUsed = now
+                size = session.talk.getMemoryUsage()
+                self.totalSize += size - session.size
+                session.size = size
+                self.evict()
+                return session.talk
+
+            # two first messages of one chat must end up with the same talk
+            future = self.creating.get(cid)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.creating[cid] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            talk = self.createTalk(cid)
+        except Exception as e:
+            logger.error("fail to create talk for chat {}, {}", cid, str(e))
+            with self.lock:
+                del self.creating[cid]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.drop(cid)
+            size = talk.getMemoryUsage()
+            self.talks[cid] = Session(talk, time.monotonic(), size)
+            self.totalSize += size
+            del self.creating[cid]
+            self.evict()
+        future.set_result(talk)
+
         return talk
 
+    def measure(self, cid: ChatID) -> None:
+        # after a turn, so its growth counts before the next message comes
+        with self.lock:
+            session = self.talks.get(cid)
+            if session is None:
+                return
+            size = session.talk.getMemoryUsage()
+            self.totalSize += size - session.size
+            session.size = size
+            self.evict()
+
+    def drop(self, cid: ChatID) -> None:
+        # caller holds the lock
+        session = self.talks.pop(cid, None)
+        if session is not None:
+            self.totalSize -= session.size
+
+    def evict(self) -> None:
+        # caller holds the lock
+        now = time.monotonic()
+        while len(self.talks) > 0:
+            cid, session = next(iter(self.talks.items()))
+            if now - session.lastUsed < self.idleTimeout:
+                break
+            logger.debug("drop idle talk of chat {}", cid)
+            self.drop(cid)
+
+        # keep the most recent session even if it alone is over the byte cap
+        while len(self.talks) > 1 and (len(self.talks) > self.maxSessions or self.totalSize > self.maxBytes):
+            cid = next(iter(self.talks))
+            logger.debug("drop talk of chat {}, {} sessions, {} bytes", cid, len(self.talks), self.totalSize)
+            self.drop(cid)
+
+    def sessionCount(self) -> int:
+        with self.lock:
+            return len(self.talks)
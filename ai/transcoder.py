@@ -0,0 +1,229 @@
+from definition import MediaBuffer
+from common import Stats
+
+import array
+import asyncio
+import io
+import math
+import os
+import subprocess
+import time
+import warnings
+import wave
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import List, Tuple
+
+from loguru import logger
+
+try:
+    # deprecated since python 3.11, removed in 3.13
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+speechRate = 16000
+# trimmed silence is quieter than -50 dBFS, looked at in 20 ms windows
+silenceLevel = int(32768 * 10 ** (-50 / 20))
+silenceWindow = speechRate // 50
+
+
+class Transcoder:
+    # ffmpeg jobs on their own bounded pool, a job running past its timeout is killed
+
+    def __init__(self, workers: int = 2, timeout: float = 60) -> None:
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        self.timeout: float = timeout
+        self.stats: Stats = Stats()
+        self.lock: Lock = Lock()
+        self.queued: int = 0
+        self.running: int = 0
+
+    def submit(self, command: List[str], input: bytes = None, timeout: float = None) -> Future:
+        with self.lock:
+            self.queued += 1
+            self.stats.gauge("transcode.queued", self.queued)
+        return self.pool.submit(self.execute, command, input, timeout or self.timeout, time.monotonic())
+
+    def run(self, command: List[str], input: bytes = None, timeout: float = None) -> bytes:
+        return self.submit(command, input, timeout).result()
+
+    async def runAsync(self, command: List[str], input: bytes = None, timeout: float = None) -> bytes:
+        return await asyncio.wrap_future(self.submit(command, input, timeout))
+
+    def execute(self, command: List[str], input: bytes, timeout: float, submitted: float) -> bytes:
+        start = time.monotonic()
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.stats.gauge("transcode.queued", self.queued)
+            self.stats.gauge("transcode.running", self.running)
+        self.stats.observe("transcode.wait", start - submitted)
+        try:
+            return self.spawn(command, input, timeout)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.stats.gauge("transcode.running", self.running)
+            self.stats.observe("transcode.run", time.monotonic() - start)
+
+    def spawn(self, command: List[str], input: bytes, timeout: float) -> bytes:
+        try:
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logger.error("failed to start {}, {}", command[0], str(e))
+            self.stats.incr("transcode.failed")
+            return None
+
+        try:
+            output, _ = proc.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            logger.error("{} killed after {} seconds", command[0], timeout)
+            self.stats.incr("transcode.timeout")
+            return None
+
+        if proc.returncode != 0 or len(output) == 0:
+            logger.debug("{} failed, error code {}", command[0], proc.returncode)
+            self.stats.incr("transcode.failed")
+            return None
+        return output
+
+
+defaultTranscoder: Transcoder = None
+
+def getTranscoder() -> Transcoder:
+    global defaultTranscoder
+    if defaultTranscoder is None:
+        defaultTranscoder = Transcoder()
+    return defaultTranscoder
+
+
+def canConvertInProcess(audio: MediaBuffer) -> bool:
+    return audioop is not None and audio.ext() == ".wav"
+
+
+def convertWav(audio: MediaBuffer, trimSilence: bool = False) -> MediaBuffer:
+    # pcm wav to 16 kHz mono 16 bit wav without a subprocess, None if the file is not plain pcm,
+    # an empty buffer if nothing but silence was trimmed away
+    data = wavToPcm(audio)
+    if data is None:
+        return None
+    name, _ = os.path.splitext(audio.name)
+    if trimSilence:
+        data = trimPcm(data)
+        if len(data) == 0:
+            return MediaBuffer(name + ".wav")
+    return MediaBuffer(name + ".wav", pcmToWav(data))
+
+
+def wavToPcm(audio: MediaBuffer) -> bytes:
+    # 16 kHz mono 16 bit samples of a pcm wav
+    try:
+        with wave.open(audio.reader(), "rb") as w:
+            channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            data = w.readframes(w.getnframes())
+    except (wave.Error, EOFError) as e:
+        logger.debug("{} is not a pcm wav, {}", audio.name, str(e))
+        return None
+    if channels > 2:
+        return None
+
+    if width == 1:
+        # 8 bit wav is unsigned
+        data = audioop.bias(data, 1, -128)
+    if channels == 2:
+        data = audioop.tomono(data, width, 0.5, 0.5)
+    if width != 2:
+        data = audioop.lin2lin(data, width, 2)
+    if rate != speechRate:
+        data, _ = audioop.ratecv(data, 2, 1, rate, speechRate, None)
+    return data
+
+
+def pcmToWav(data: bytes) -> bytes:
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(speechRate)
+        w.writeframes(data)
+    return out.getvalue()
+
+
+pcmCommand = ["ffmpeg", "-i", "pipe:0", "-vn", "-ar", str(speechRate), "-ac", "1", "-f", "s16le", "pipe:1"]
+
+
+def decodePcm(audio: MediaBuffer, transcoder: Transcoder = None) -> bytes:
+    if canConvertInProcess(audio):
+        data = wavToPcm(audio)
+        if data is not None:
+            return data
+    transcoder = transcoder or getTranscoder()
+    return transcoder.run(pcmCommand, audio.getValue())
+
+
+async def decodePcmAsync(audio: MediaBuffer, transcoder: Transcoder = None) -> bytes:
+    if canConvertInProcess(audio):
+        data = await asyncio.to_thread(wavToPcm, audio)
+        if data is not None:
+            return data
+    transcoder = transcoder or getTranscoder()
+    return await transcoder.runAsync(pcmCommand, audio.getValue())
+
+
+def level(data: bytes) -> float:
+    # rms of 16 bit samples
+    if audioop is not None:
+        return audioop.rms(data, 2)
+    samples = array.array("h", data[:len(data) // 2 * 2])
+    if len(samples) == 0:
+        return 0
+    return math.sqrt(sum(v * v for v in samples) / len(samples))
+
+
+def quietestPoint(data: bytes, lo: int, hi: int) -> int:
+    # start of the quietest window in [lo, hi), both multiples of the window size
+    step = silenceWindow * 2
+    best, bestLevel = hi, None
+    for i in range(lo, hi, step):
+        l = level(data[i:i + step])
+        if bestLevel is None or l < bestLevel:
+            best, bestLevel = i, l
+    return best
+
+
+def splitPcm(data: bytes, segment: float, overlap: float) -> List[Tuple[int, int]]:
+    # byte ranges of about segment seconds, cut in the quietest spot of each segment's last quarter,
+    # every range reaches overlap seconds into its neighbours
+    step = silenceWindow * 2
+    perSecond = speechRate * 2
+    segmentBytes = max(step, int(segment * perSecond) // step * step)
+    searchBytes = max(step, segmentBytes // 4 // step * step)
+    overlapBytes = int(overlap * perSecond) // 2 * 2
+
+    ranges = []
+    start = 0
+    while start < len(data):
+        target = start + segmentBytes
+        if target >= len(data):
+            ranges.append((max(0, start - overlapBytes), len(data)))
+            break
+        # segments shorter than a window would cut where they start, every one moves on at least a window
+        cut = max(quietestPoint(data, target - searchBytes, target), start + step)
+        ranges.append((max(0, start - overlapBytes), min(len(data), cut + overlapBytes)))
+        start = cut
+    return ranges
+
+
+def trimPcm(data: bytes) -> bytes:
+    # 16 bit mono, drop the silent windows at both ends
+    step = silenceWindow * 2
+    windows = range(0, len(data), step)
+    loud = [i for i in windows if level(data[i:i + step]) > silenceLevel]
+    if len(loud) == 0:
+        return b""
+    return data[loud[0]:loud[-1] + step]
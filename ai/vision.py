@@ -0,0 +1,148 @@
+from definition import MediaBuffer
+from common import Config, OpenAIConfig, Stats
+
+import hashlib
+import io
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Tuple
+
+import PIL.ExifTags
+import PIL.Image
+import PIL.ImageOps
+from loguru import logger
+
+# how the vision models bill a picture: a base cost plus one per 512 px tile of the resized image
+visionDetails = ["low", "high"]
+imageFormats = {"jpeg": "image/jpeg", "webp": "image/webp"}
+tileSize = 512
+baseTokens = 85
+tileTokens = 170
+highFitSize = 2048 # high detail first fits the picture in a 2048 square
+highShortSide = 768 # then scales the short side down to 768
+lowSize = 512 # low detail sees a 512 square, whatever the picture
+
+
+def visionSize(width: int, height: int, detail: str = "high") -> Tuple[int, int]:
+    # the size the model looks at, pictures are never scaled up
+    if detail == "low":
+        scale = min(1.0, lowSize / max(width, height))
+    else:
+        scale = min(1.0, highFitSize / max(width, height))
+        scale = min(scale, highShortSide / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def visionTokens(width: int, height: int, detail: str = "high") -> int:
+    if detail == "low":
+        return baseTokens
+    w, h = visionSize(width, height, detail)
+    return baseTokens + tileTokens * math.ceil(w / tileSize) * math.ceil(h / tileSize)
+
+
+# a 1024 square, when the picture can't be read
+unknownTokens = visionTokens(1024, 1024)
+
+
+@dataclass
+class VisionImage:
+    data: bytes
+    mime: str
+    width: int = 0
+    height: int = 0
+    tokens: int = unknownTokens
+
+
+class ImagePipeline:
+    # pictures resized to what the model looks at and re-encoded, cached by content
+
+    def __init__(self, detail: str = "high", format: str = "jpeg", quality: int = 85, cacheBytes: int = 32 * 1024 * 1024) -> None:
+        if detail not in visionDetails:
+            raise ValueError("unknown vision detail: " + detail)
+        if format not in imageFormats:
+            raise ValueError("unknown image format: " + format)
+        self.detail: str = detail
+        self.format: str = format
+        self.quality: int = quality
+        self.cacheBytes: int = cacheBytes
+        self.lock: Lock = Lock()
+        self.cache: OrderedDict[str, VisionImage] = OrderedDict()
+        self.cacheSize: int = 0
+        self.stats: Stats = Stats()
+
+    def key(self, data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def prepare(self, image: MediaBuffer) -> VisionImage:
+        data = image.getValue()
+        key = self.key(data)
+        with self.lock:
+            prepared = self.cache.get(key)
+            if prepared is not None:
+                self.cache.move_to_end(key)
+                self.stats.incr("vision.hit")
+                return prepared
+        self.stats.incr("vision.miss")
+
+        prepared = self.encode(image.name, data)
+        self.stats.observe("vision.saved", len(data) - len(prepared.data))
+        with self.lock:
+            if key not in self.cache and len(prepared.data) <= self.cacheBytes:
+                self.cache[key] = prepared
+                self.cacheSize += len(prepared.data)
+                while self.cacheSize > self.cacheBytes:
+                    _, old = self.cache.popitem(last=False)
+                    self.cacheSize -= len(old.data)
+        return prepared
+
+    def encode(self, name: str, data: bytes) -> VisionImage:
+        try:
+            img = PIL.Image.open(io.BytesIO(data))
+            source = PIL.Image.MIME.get(img.format)
+            width, height = img.size
+            size = visionSize(width, height, self.detail)
+            tokens = visionTokens(width, height, self.detail)
+            rotated = img.getexif().get(PIL.ExifTags.Base.Orientation, 1) in (5, 6, 7, 8)
+            # jpeg decodes straight to a smaller scale, much cheaper than a full decode of a big photo
+            img.draft("RGB", size)
+            img = PIL.ImageOps.exif_transpose(img)
+            if rotated:
+                width, height, size = height, width, (size[1], size[0])
+
+            if img.mode not in ("RGB", "RGBA") or (img.mode == "RGBA" and self.format == "jpeg"):
+                img = img.convert("RGB")
+            if img.size != size:
+                img = img.resize(size, PIL.Image.Resampling.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, format=self.format.upper(), quality=self.quality)
+        except (OSError, ValueError, PIL.Image.DecompressionBombError) as e:
+            logger.warning("failed to prepare image {}, sent as it is, {}", name, str(e))
+            return VisionImage(data, imageFormats["jpeg"])
+
+        encoded = out.getvalue()
+        if len(encoded) >= len(data) and size == (width, height) and source == imageFormats[self.format]:
+            # already small enough, a second lossy pass would only hurt
+            encoded = data
+        return VisionImage(encoded, imageFormats[self.format], size[0], size[1], tokens)
+
+
+def getImagePipeline(config: OpenAIConfig) -> ImagePipeline:
+    return ImagePipeline(config.visionDetail, config.visionFormat, config.visionQuality, config.visionCacheBytes)
+
+
+def visionTargetSize(config: Config) -> int:
+    # short side in px a photo needs before the active vision model scales it down
+    if config.system.useGemini and config.gemini is not None:
+        return config.gemini.visionTargetSize
+    if config.openAI.visionTargetSize > 0:
+        return config.openAI.visionTargetSize
+    return lowSize if config.openAI.visionDetail == "low" else highShortSide
+
+
+def visionTargetLongSide(config: Config) -> bool:
+    # low detail fits the long side in lowSize, so that is the side a photo is picked by
+    if config.system.useGemini and config.gemini is not None:
+        return False
+    return config.openAI.visionTargetSize <= 0 and config.openAI.visionDetail == "low"
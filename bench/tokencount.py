@@ -0,0 +1,74 @@
+# per-turn cost of OpenAITalk history bookkeeping as the conversation grows
+# usage: python -m bench.tokencount
+import re
+import time
+from collections import deque
+from typing import Deque
+from unittest import mock
+
+import ai.openaitalk as openaitalk
+from ai.openaitalk import OpenAITalk
+from common import OpenAIConfig
+
+turns = 2000
+reportAt = [10, 100, 500, 1000, 2000]
+question = "Could you explain how the context window of this conversation is managed, in a few words?"
+answer = "Sure. Every entry keeps its token count, the window keeps a running total and drops the oldest entries first. " * 4
+
+
+class CountingEncoding:
+    # wraps an encoding and counts encode calls
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.calls = 0
+
+    def encode(self, text: str):
+        self.calls += 1
+        return self.encoding.encode(text)
+
+
+class RegexEncoding:
+    # stand-in when tiktoken can't fetch its BPE files (offline)
+    pattern = re.compile(r"\w+|[^\w\s]")
+
+    def encode(self, text: str):
+        return self.pattern.findall(text)
+
+
+def loadEncoding(model: str):
+    try:
+        return openaitalk.encoding_for_model(model), "tiktoken"
+    except Exception:
+        return RegexEncoding(), "regex fallback"
+
+
+def main():
+    cfg = OpenAIConfig(apiKey="bench", model="gpt-3.5-turbo", contextTimeout=3600)
+    encoding, name = loadEncoding(cfg.model)
+    counting = CountingEncoding(encoding)
+
+    # lift the window cap so the whole history stays in context, the worst case for per-turn work
+    with mock.patch.object(openaitalk, "encoding_for_model", lambda m: counting), \
+         mock.patch.object(openaitalk, "maxMessageQueueToken", 1 << 62):
+        talk = OpenAITalk("Chloe", cfg)
+
+        print(f"encoding: {name}")
+        print(f"{'turn':>6} {'history':>8} {'window tokens':>14} {'us/turn':>10} {'encodes/turn':>13}")
+        timings: Deque[float] = deque(maxlen=50)
+        encodes: Deque[int] = deque(maxlen=50)
+        for turn in range(1, turns + 1):
+            before = counting.calls
+            start = time.perf_counter()
+            talk.prepareNewMessage(question)
+            talk.appendAnswer(answer)
+            timings.append(time.perf_counter() - start)
+            encodes.append(counting.calls - before)
+
+            if turn in reportAt:
+                usPerTurn = sum(timings) / len(timings) * 1e6
+                encodesPerTurn = sum(encodes) / len(encodes)
+                print(f"{turn:>6} {len(talk.messageQueue):>8} {talk.queueToken:>14} {usPerTurn:>10.1f} {encodesPerTurn:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
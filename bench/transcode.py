@@ -0,0 +1,64 @@
+# bytes uploaded and latency of each voice transcode policy before transcription
+# usage: python -m bench.transcode [audio files...]
+# without files a synthetic 20 s voice note with silence around it is used.
+# set OPENAI_API_KEY to include the transcription request in the end-to-end latency
+import os
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+from ai.common import prepareForTranscription
+from ai.speech import Wisper
+from definition import MediaBuffer
+
+rounds = 3
+policies: List[Tuple[str, bool]] = [("mp3", False), ("auto", False), ("slim", False), ("slim", True)]
+
+
+def sampleVoice() -> MediaBuffer:
+    # 20 s tone with 3 s of silence on both ends, encoded like a telegram voice note
+    command = [
+        "ffmpeg", "-f", "lavfi", "-i", "sine=frequency=440:duration=20:sample_rate=48000,adelay=3000,apad=pad_dur=3",
+        "-ac", "1", "-c:a", "libopus", "-b:a", "32k", "-f", "ogg", "pipe:1"
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return MediaBuffer("voice/sample.oga", result.stdout)
+
+
+def loadFiles(paths: List[str]) -> List[MediaBuffer]:
+    files = []
+    for p in paths:
+        with open(p, "rb") as f:
+            files.append(MediaBuffer(os.path.basename(p), f.read()))
+    return files
+
+
+def main():
+    inputs = loadFiles(sys.argv[1:]) if len(sys.argv) > 1 else [sampleVoice()]
+    apiKey = os.environ.get("OPENAI_API_KEY")
+    # every prepared output is an accepted format, the default policy sends it as it is
+    whisper = Wisper(apiKey) if apiKey is not None else None
+
+    print(f"{'input':>20} {'policy':>10} {'in bytes':>10} {'upload bytes':>13} {'transcode ms':>13} {'end-to-end ms':>14}")
+    for audio in inputs:
+        for policy, trim in policies:
+            name = policy + ("+trim" if trim else "")
+            transcodeTime = 0.0
+            totalTime = 0.0
+            size = 0
+            for _ in range(rounds):
+                start = time.perf_counter()
+                prepared = prepareForTranscription(audio, policy, trim)
+                transcodeTime += time.perf_counter() - start
+                size = prepared.size if prepared is not None else 0
+                if whisper is not None and prepared is not None:
+                    whisper.convert(prepared)
+                totalTime += time.perf_counter() - start
+
+            e2e = f"{totalTime / rounds * 1000:>14.1f}" if whisper is not None else f"{'n/a':>14}"
+            print(f"{audio.name[-20:]:>20} {name:>10} {audio.size:>10} {size:>13} {transcodeTime / rounds * 1000:>13.1f} {e2e}")
+
+
+if __name__ == '__main__':
+    main()
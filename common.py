@@ -1,37 +1,109 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
+import time
 import yaml
 import datetime
+from threading import Lock
 from loguru import logger 
-from typing import Callable
+from typing import Callable, Dict, List
 
 
 @dataclass
 class OpenAIConfig:
     apiKey: str
     model: str
+    apiKeys: List[str] = field(default_factory=list) # more keys of the same provider, requests go to the one with the most room
+    rpm: int = 500 # requests per minute of each key, corrected by the rate limit headers of the answers
+    tpm: int = 60000 # tokens per minute of each key
     contextTimeout: int = 120
     visionModel: str = "gpt-4-vision-preview"
     visionMaxToken: int = 300
     visionContextTimeout: int = 60
+    visionDetail: str = "high" # low sends a 512 px picture for a flat 85 tokens, high is billed per 512 px tile
+    visionFormat: str = "jpeg" # pictures are re-encoded to jpeg or webp
+    visionQuality: int = 85
+    visionCacheBytes: int = 32 * 1024 * 1024 # prepared pictures kept by content
+    visionTargetSize: int = 0 # short side in px of the telegram photo size downloaded, 0 to follow visionDetail (a 512 px long side for low)
+    visionBlobBytes: int = 64 * 1024 * 1024 # pictures of all conversations kept in memory, each once
+    visionBlobDiskBytes: int = 512 * 1024 * 1024 # pictures spilled to visionBlobPath, 0 to keep memory only
+    visionBlobPath: str = "data/images"
+    transcodePolicy: str = "auto" # voice before transcription: auto (pass accepted formats through), slim (16 kHz mono) or mp3
+    trimSilence: bool = False # cut leading and trailing silence, this always transcodes
+    transcribeSegment: float = 120 # seconds, longer voice is transcribed in concurrent segments, 0 to disable
+    transcribeOverlap: float = 1 # seconds each segment reaches into its neighbours
+    transcribeWorkers: int = 4 # segments transcribed at once
+    ttsModel: str = "tts-1"
+    ttsVoice: str = "nova"
+    ttsCacheBytes: int = 16 * 1024 * 1024 # synthesized speech kept in memory
+    ttsCacheDiskBytes: int = 256 * 1024 * 1024 # speech spilled to ttsCachePath, 0 to keep memory only
+    ttsCachePath: str = "data/tts"
 
 @dataclass
 class GeminiConfig:
     apiKey: str
     model: str = "gemini-pro"
     contextTimeout: int = 600
+    maxContextTokens: int = 8192 # estimated tokens of history sent with each request, oldest turns are dropped first
+    contextCacheTokens: int = 0 # cache the history on the server once this many tokens of it are uncached, 0 to disable, needs a model with caching
     visionModel: str = "gemini-pro-vision"
+    visionTargetSize: int = 768 # short side in px of the telegram photo size downloaded, 0 for the largest
+    uploadWorkers: int = 4 # pictures uploaded at once
+    uploadTimeout: float = 60 # seconds until an uploaded picture must be ready
+
+    def __post_init__(self) -> None:
+        if self.contextCacheTokens > 0 and self.contextCacheTokens >= self.maxContextTokens:
+            raise ValueError(f"gemini contextCacheTokens {self.contextCacheTokens} must be below maxContextTokens {self.maxContextTokens}")
 
 @dataclass
 class TelegramConfig:
     botToken: str
     escapeText: bool = False
     parseMode: str = ""
+    cacheCapacity: int = 10000 # chats and chat members kept in memory, each
+    cacheTTL: int = 300 # seconds before a cached chat or member is refreshed
+    streaming: bool = False # reply by editing a placeholder message while the answer streams in
+    streamInterval: float = 1.0 # min seconds between two edits of a streaming reply
+    downloadWorkers: int = 4 # concurrent media downloads
+    sendRate: float = 30 # messages per second over all chats
+    chatRate: float = 1 # messages per second in one private chat
+    groupRate: float = 20 # messages per minute in one group
+    sendWorkers: int = 4 # sends to different chats in flight at once
+    webhookUrl: str = "" # public https url telegram posts updates to, empty for long polling
+    webhookListen: str = "0.0.0.0"
+    webhookPort: int = 8443
+    webhookSecret: str = "" # telegram sends it with each update, others are turned away, empty for a random one
+    webhookCert: str = "" # certificate and key files to serve https directly, empty behind a tls proxy
+    webhookKey: str = ""
 
 @dataclass
 class SystemConfig:
     whitelistEnabled: bool
     useGemini: bool = True
+    workers: int = 4 # threads handling messages, each chat is handled by at most one at a time
+    maxSessions: int = 10000 # conversations kept in memory
+    maxSessionBytes: int = 256 * 1024 * 1024 # estimated bytes of all conversations kept in memory
+    sessionIdleTimeout: int = 0 # seconds before an idle conversation is dropped, 0 for the provider's contextTimeout
+    useAsyncio: bool = False # serve all conversations on one event loop instead of the thread pool
+    transcodeWorkers: int = 2 # ffmpeg processes running at once
+    transcodeTimeout: float = 60 # seconds before a transcode is killed
+    ttsWorkers: int = 3 # parts of voice answers synthesized at once
+    groupVoicePolicy: str = "always" # transcribe group voice notes: always, reply (only when addressed to the bot) or never
+    asyncConcurrency: int = 256 # max messages handled at once in asyncio mode
+    retryAttempts: int = 3 # tries of one provider call
+    retryBaseDelay: float = 0.5 # seconds, doubled for each retry, a random part of it is waited
+    retryMaxDelay: float = 8
+    requestDeadline: float = 60 # seconds all tries of one provider call may take
+    breakerThreshold: int = 5 # failed calls in a row before calls to a provider are paused
+    breakerReset: float = 30 # seconds a paused provider is left alone before one call probes it
+    providerFailover: bool = True # ask the other configured provider when all keys of one are rate limited
+
+@dataclass
+class StoreConfig:
+    backend: str = "none" # "none" keeps conversations in memory only, "sqlite" persists them
+    path: str = "data/chloe.db" # relative to the project root
+    flushInterval: float = 0.5 # seconds between batched writes
+    batchSize: int = 100
+    retention: int = 7 * 24 * 3600 # seconds before stored turns are deleted, 0 to keep forever
 
 @dataclass
 class Config:
@@ -40,6 +112,7 @@ class Config:
     gemini: GeminiConfig
     telegram: TelegramConfig
     system: SystemConfig
+    store: StoreConfig = field(default_factory=StoreConfig)
 
 class ACL:
     def __init__(self, data):
@@ -85,6 +158,7 @@ def getConfig() -> Config:
         data['gemini'] = GeminiConfig(**data['gemini'])
         data['telegram'] = TelegramConfig(**data['telegram'])
         data['system'] = SystemConfig(**data['system'])
+        data['store'] = StoreConfig(**data.get('store', {}))
         config = Config(**data)
         return config
 
@@ -116,8 +190,80 @@ class Defer:
             if callable(f):
                 f()
 
-def rmHandle(f: str) -> Callable:
-    def rmFunc():
-        os.remove(f)
-    return rmFunc
-    
\ No newline at end of file
+
+class Stats:
+    # thread safe counters and timings, read with snapshot()
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+
+    def incr(self, name: str, n: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, value: float) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            self.counters[name + ".count"] = self.counters.get(name + ".count", 0) + 1
+            self.counters[name + ".sum"] = self.counters.get(name + ".sum", 0) + value
+            self.gauges[name + ".max"] = max(self.gauges.get(name + ".max", value), value)
+
+    def get(self, name: str) -> float:
+        with self.lock:
+            return self.counters.get(name, self.gauges.get(name, 0))
+
+    def ratio(self, part: str, other: str) -> float:
+        with self.lock:
+            a = self.counters.get(part, 0)
+            b = self.counters.get(other, 0)
+        return a / (a + b) if a + b > 0 else 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            snap = dict(self.counters)
+            snap.update(self.gauges)
+            return snap
+
+
+class TokenBucket:
+    # capacity refills evenly over period, sync takes over the counts a server reports
+
+    def __init__(self, capacity: float, period: float = 60) -> None:
+        self.capacity: float = capacity
+        self.level: float = capacity
+        self.rate: float = capacity / period
+        self.updated: float = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        # now may be read before another caller refilled
+        if now <= self.updated:
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def fraction(self, now: float) -> float:
+        self.refill(now)
+        return self.level / self.capacity
+
+    def canTake(self, n: float, now: float) -> bool:
+        self.refill(now)
+        # a request bigger than the whole bucket goes through once it is full
+        return self.level >= min(n, self.capacity)
+
+    def take(self, n: float) -> None:
+        self.level -= n
+
+    def waitFor(self, n: float) -> float:
+        return max(0.0, (min(n, self.capacity) - self.level) / self.rate)
+
+    def sync(self, limit: float, remaining: float, reset: float) -> None:
+        self.refill(time.monotonic())
+        self.capacity = limit
+        self.level = remaining
+        if reset is not None and reset > 0 and remaining < limit:
+            self.rate = (limit - remaining) / reset
@@ -1,11 +1,62 @@
+import asyncio
+import os
+import shutil
+import tempfile
 from abc import ABC, abstractmethod
-from typing import Callable, List, Tuple, Iterable
+from dataclasses import dataclass, field
+from typing import IO, Callable, List, Tuple, Iterable, AsyncIterator
 
 ChatID = str
 UserID = str
 MessageID = str
 CleanFunc = Callable[[], None]
 
+# media larger than this is spilled to an anonymous temp file
+spillSize = 8 * 1024 * 1024
+
+class MediaBuffer:
+    # bytes of a photo or an audio, kept in memory unless large.
+    # nothing to clean up, the spilled file goes away with the buffer
+
+    def __init__(self, name: str, data: bytes = None) -> None:
+        self.name: str = name # file name, its extension tells the format
+        self.file: tempfile.SpooledTemporaryFile = tempfile.SpooledTemporaryFile(max_size=spillSize)
+        self.size: int = 0
+        self.duration: float = 0 # seconds of audio, 0 when unknown
+        self.named: IO[bytes] = None
+        if data is not None:
+            self.write(data)
+
+    def write(self, data: bytes) -> None:
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(data)
+        self.size += len(data)
+
+    def getValue(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+    def reader(self) -> IO[bytes]:
+        # rewound underlying file, read it before handing the buffer on
+        self.file.seek(0)
+        return self.file
+
+    def ext(self) -> str:
+        return os.path.splitext(self.name)[-1].lower()
+
+    def path(self) -> str:
+        # for tools that only take a file name, written once and removed with the buffer
+        if self.named is None:
+            self.named = tempfile.NamedTemporaryFile(suffix=self.ext())
+            shutil.copyfileobj(self.reader(), self.named)
+            self.named.flush()
+        return self.named.name
+
+    def close(self) -> None:
+        self.file.close()
+        if self.named is not None:
+            self.named.close()
+
 class User(ABC):
 
     @abstractmethod
@@ -44,12 +95,16 @@ class Chat(ABC):
     def quoteMessage(self, message: str, replyTo: MessageID, quote: str) -> None:
         raise NotImplementedError("not implemented")
 
+    @abstractmethod
+    def replyStream(self, deltas: Iterable[str], replyTo: MessageID) -> str:
+        raise NotImplementedError("not implemented")
+
     @abstractmethod
     def replyImage(self, imgPath: str, message: MessageID) -> None:
         raise NotImplementedError("not implemented")
     
     @abstractmethod
-    def replyVoice(self, audPath: str, message: MessageID) -> None:
+    def replyVoice(self, audio: MediaBuffer, message: MessageID) -> None:
         raise NotImplementedError("not implemented")
     
     @abstractmethod
@@ -61,12 +116,19 @@ class Media(ABC):
     def getText(self) -> List[str]:
         return None
     
-    def getPhoto(self) -> List[Tuple[str, CleanFunc]]:
+    def getPhoto(self) -> List[MediaBuffer]:
         return None
 
-    def getVoice(self) -> List[Tuple[str, CleanFunc]]:
+    def getVoice(self) -> List[MediaBuffer]:
         return None
 
+    # cheap checks, they do not fetch anything
+    def hasPhoto(self) -> bool:
+        return self.getPhoto() is not None
+
+    def hasVoice(self) -> bool:
+        return self.getVoice() is not None
+
 class Message(ABC):
     
     @abstractmethod
@@ -80,11 +142,22 @@ class Message(ABC):
     @abstractmethod
     def getChat(self) -> Chat:
         raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def getChatID(self) -> ChatID:
+        raise NotImplementedError("not implemented")
     
     @abstractmethod
     def getMedia(sefl) -> Media:
         raise NotImplementedError("not implemented")
 
+    def isReplyToSelf(self) -> bool:
+        return False
+
+    def getMentions(self) -> List[str]:
+        # usernames mentioned by the message markup, with the leading @
+        return []
+
         
         
 
@@ -95,6 +168,79 @@ class MessageBot(ABC):
         raise NotImplementedError("not implemented")
 
 
+### asyncio variants of the IM interfaces
+
+class AsyncChat(ABC):
+
+    @abstractmethod
+    def getID(self) -> ChatID:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def getMemberCount(self) -> int:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def replyMessage(self, message: str, replyTo: MessageID) -> None:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def quoteMessage(self, message: str, replyTo: MessageID, quote: str) -> None:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def replyStream(self, deltas: AsyncIterator[str], replyTo: MessageID) -> str:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def replyVoice(self, audio: MediaBuffer, message: MessageID) -> None:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def getSelf(self) -> User:
+        raise NotImplementedError("not implemented")
+
+
+class AsyncMessage(ABC):
+
+    @abstractmethod
+    def getID(self) -> MessageID:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def getUser(self) -> User:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    async def getChat(self) -> AsyncChat:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def getChatID(self) -> ChatID:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def getMedia(self) -> Media:
+        raise NotImplementedError("not implemented")
+
+    def isReplyToSelf(self) -> bool:
+        return False
+
+    def getMentions(self) -> List[str]:
+        return []
+
+    async def fetchMedia(self) -> None:
+        # download media the message only refers to, getMedia() is complete afterwards
+        pass
+
+
+class AsyncMessageBot(ABC):
+
+    @abstractmethod
+    def getMessages(self) -> AsyncIterator[AsyncMessage]:
+        raise NotImplementedError("not implemented")
+
+
 ### AI interfaces
 
 ConversationID = int # int64 actually
@@ -102,9 +248,12 @@ ConversationID = int # int64 actually
 class ImageRecognizer(ABC):
     
     @abstractmethod
-    def prepareImages(self, images: List[str]=None) -> None:
+    def prepareImages(self, images: List[MediaBuffer]=None) -> None:
         raise NotImplementedError("not implemented")
 
+    async def prepareImagesAsync(self, images: List[MediaBuffer]=None) -> None:
+        await asyncio.to_thread(self.prepareImages, images)
+
 
 class Conversation(ABC):
     
@@ -112,9 +261,68 @@ class Conversation(ABC):
     def ask(self, q: str) -> str:
         raise NotImplementedError("not implemented")
 
+    def askStream(self, q: str) -> Iterable[str]:
+        # yields answer deltas, falls back to one blocking answer
+        yield self.ask(q)
+
+    async def askAsync(self, q: str) -> str:
+        return await asyncio.to_thread(self.ask, q)
+
+    async def askStreamAsync(self, q: str) -> AsyncIterator[str]:
+        yield await self.askAsync(q)
+
 
 class Talk(Conversation, ImageRecognizer):
-    pass
+
+    def getMemoryUsage(self) -> int:
+        # rough bytes held by the conversation, used to cap the session store
+        return 0
+
+    def lastError(self) -> Exception:
+        # why the last question got an apology instead of an answer, None if it was answered
+        return None
+
+    def history(self) -> List["Turn"]:
+        # text turns of the current context, oldest first
+        return []
+
+    def adopt(self, turns: List["Turn"]) -> None:
+        # replace the context with turns of another talk
+        pass
+
+    def takeAnswer(self, answer: str) -> None:
+        # the pending question was answered by another talk
+        pass
+
+
+@dataclass
+class Turn:
+    role: str # "user" or "assistant"
+    text: str = None
+    images: List[str] = field(default_factory=list) # references, never inline data
+    ts: float = 0 # unix time
+
+
+class ConversationStore(ABC):
+
+    @abstractmethod
+    def append(self, cid: ChatID, turn: Turn) -> None:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def load(self, cid: ChatID, since: float) -> List[Turn]:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def putBlob(self, data: bytes) -> str:
+        raise NotImplementedError("not implemented")
+
+    @abstractmethod
+    def getBlob(self, ref: str) -> bytes:
+        raise NotImplementedError("not implemented")
+
+    def close(self) -> None:
+        pass
 
 
 class AITalkFactory(ABC):
@@ -123,20 +331,30 @@ class AITalkFactory(ABC):
     def getTalk(self, cid: ChatID) -> Talk:
         raise NotImplementedError("not implemented")
 
+    def measure(self, cid: ChatID) -> None:
+        # the talk of cid has changed size
+        pass
+
 
 class SpeechToText(ABC):
     
     @abstractmethod
-    def convert(self, audFile: str) -> str:
+    def convert(self, audio: MediaBuffer) -> str:
         raise NotImplementedError("not implemented")
 
+    async def convertAsync(self, audio: MediaBuffer) -> str:
+        return await asyncio.to_thread(self.convert, audio)
+
 
 class TextToSpeech(ABC):
     
     @abstractmethod
-    def convert(self, text: str) -> Tuple[str, CleanFunc]:
+    def convert(self, text: str) -> MediaBuffer:
         raise NotImplementedError("not implemented")
 
+    async def convertAsync(self, text: str) -> MediaBuffer:
+        return await asyncio.to_thread(self.convert, text)
+
 
 class ImageGenerator(ABC):
     
@@ -1,38 +1,232 @@
 from definition import Chat, ChatID, User, UserID
+from common import Stats
 
+from loguru import logger
+
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
 from threading import Lock
 from _thread import LockType
-from typing import Dict
+from typing import Any, Callable, Deque, Dict, Hashable, List, Tuple
 #from dataclasses import dataclass
 
+Loader = Callable[[], Any]
 
-class ChatCache:
-    
-    def __init__(self) -> None:
+# a stale entry is still served (and refreshed in background) until it is this many ttl old
+staleFactor = 2
+
+
+class CacheShard:
+
+    def __init__(self, capacity: int) -> None:
         self.lock: LockType = Lock()
-        self.chats: Dict[ChatID, Chat] = {}
-        self.users: Dict[ChatID, Dict[UserID, User]] = {}
-        
-     
+        self.capacity: int = capacity
+        self.entries: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict() # key -> (value, loaded at)
+        self.inflight: Dict[Hashable, Future] = {}
+
+    def put(self, key: Hashable, value: Any) -> None:
+        # caller holds the lock
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class TTLCache:
+    # sharded LRU, entries are refreshed after ttl seconds.
+    # concurrent loads of one key share a single loader call.
+
+    def __init__(self, name: str, capacity: int, ttl: float, refresher: ThreadPoolExecutor, stats: Stats, shards: int = 16) -> None:
+        self.name: str = name
+        self.ttl: float = ttl
+        self.refresher: ThreadPoolExecutor = refresher
+        self.stats: Stats = stats
+        perShard = max(1, capacity // shards)
+        self.shards: List[CacheShard] = [CacheShard(perShard) for _ in range(shards)]
+
+    def shardOf(self, key: Hashable) -> CacheShard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key: Hashable) -> Any:
+        # fresh entries only, no loading
+        shard = self.shardOf(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                shard.entries.move_to_end(key)
+                self.stats.incr(self.name + ".hit")
+                return entry[0]
+        self.stats.incr(self.name + ".miss")
+        return None
+
+    def peek(self, key: Hashable) -> Tuple[Any, bool]:
+        # entries up to staleFactor ttl old and whether they are due for a refresh,
+        # for callers that load and refresh on their own, like the asyncio bot
+        shard = self.shardOf(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry[1]
+                if age < self.ttl * staleFactor:
+                    shard.entries.move_to_end(key)
+                    self.stats.incr(self.name + ".hit")
+                    return entry[0], age >= self.ttl
+        self.stats.incr(self.name + ".miss")
+        return None, False
+
+    def put(self, key: Hashable, value: Any) -> None:
+        shard = self.shardOf(key)
+        with shard.lock:
+            shard.put(key, value)
+
+    def getOrLoad(self, key: Hashable, loader: Loader) -> Any:
+        shard = self.shardOf(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry[1]
+                if age < self.ttl * staleFactor:
+                    shard.entries.move_to_end(key)
+                    self.stats.incr(self.name + ".hit")
+                    if age >= self.ttl and key not in shard.inflight:
+                        self.stats.incr(self.name + ".refresh")
+                        shard.inflight[key] = Future()
+                        self.refresher.submit(self.load, shard, key, loader)
+                    return entry[0]
+
+            self.stats.incr(self.name + ".miss")
+            future = shard.inflight.get(key)
+            if future is None:
+                future = Future()
+                shard.inflight[key] = future
+                owner = True
+            else:
+                self.stats.incr(self.name + ".shared")
+                owner = False
+
+        if owner:
+            self.load(shard, key, loader)
+        return future.result()
+
+    def load(self, shard: CacheShard, key: Hashable, loader: Loader) -> None:
+        with shard.lock:
+            future = shard.inflight[key]
+        try:
+            value = loader()
+        except Exception as e:
+            with shard.lock:
+                del shard.inflight[key]
+            future.set_exception(e)
+            return
+
+        with shard.lock:
+            if value is not None:
+                shard.put(key, value)
+            del shard.inflight[key]
+        future.set_result(value)
+
+    def size(self) -> int:
+        total = 0
+        for shard in self.shards:
+            with shard.lock:
+                total += len(shard.entries)
+        return total
+
+
+class ChatCache:
+
+    def __init__(self, capacity: int = 10000, ttl: float = 300) -> None:
+        self.stats: Stats = Stats()
+        self.refresher: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-cache")
+        self.chats: TTLCache = TTLCache("chat", capacity, ttl, self.refresher, self.stats)
+        self.users: TTLCache = TTLCache("user", capacity, ttl, self.refresher, self.stats)
+
+
     def getChat(self, cid: ChatID) -> Chat:
-        with self.lock:
-            if cid in self.chats:
-                return self.chats[cid]
-            return None
+        return self.chats.get(cid)
 
     def cacheChat(self, cid: ChatID, chat: Chat) -> None:
-        with self.lock:
-            self.chats[cid] = chat
-    
+        self.chats.put(cid, chat)
+
+    def peekChat(self, cid: ChatID) -> Tuple[Chat, bool]:
+        return self.chats.peek(cid)
+
+    def loadChat(self, cid: ChatID, loader: Callable[[], Chat]) -> Chat:
+        return self.chats.getOrLoad(cid, loader)
+
     def getChatUser(self, cid: ChatID, uid: UserID) -> User:
-        with self.lock:
-            if cid in self.users:
-                if uid in self.users[cid]:
-                    return self.users[cid][uid]
-            return None
-    
+        return self.users.get((cid, uid))
+
     def cacheChatUser(self, cid: ChatID, uid: UserID, user: User) -> None:
+        self.users.put((cid, uid), user)
+
+    def peekChatUser(self, cid: ChatID, uid: UserID) -> Tuple[User, bool]:
+        return self.users.peek((cid, uid))
+
+    def loadChatUser(self, cid: ChatID, uid: UserID, loader: Callable[[], User]) -> User:
+        return self.users.getOrLoad((cid, uid), loader)
+
+    def hitRate(self) -> Dict[str, float]:
+        return {
+            "chat": self.stats.ratio("chat.hit", "chat.miss"),
+            "user": self.stats.ratio("user.hit", "user.miss"),
+        }
+
+
+class OrderedPipeline:
+    # runs jobs concurrently on a bounded pool and hands their results on
+    # in submit order per key, a slow job only holds back its own key
+
+    def __init__(self, name: str, workers: int, stats: Stats) -> None:
+        self.name: str = name
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.stats: Stats = stats
+        self.lock: LockType = Lock()
+        self.pending: Dict[Hashable, Deque[Future]] = {}
+        self.inflight: int = 0
+        self.ready: Queue = Queue()
+
+    def submit(self, key: Hashable, job: Callable[[], Any], inline: bool = False) -> None:
+        # inline jobs are cheap, they run on the caller but still wait for earlier jobs of the key
+        if inline:
+            future = Future()
+            try:
+                future.set_result(job())
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self.pool.submit(job)
+
         with self.lock:
-            if cid not in self.users:
-                self.users[cid] = {}
-            self.users[cid][uid] = user
\ No newline at end of file
+            self.pending.setdefault(key, deque()).append(future)
+            if not inline:
+                self.inflight += 1
+            self.stats.gauge(self.name + ".inflight", self.inflight)
+        future.add_done_callback(lambda f: self.release(key, inline))
+
+    def release(self, key: Hashable, inline: bool) -> None:
+        with self.lock:
+            if not inline:
+                self.inflight -= 1
+                self.stats.gauge(self.name + ".inflight", self.inflight)
+            pending = self.pending.get(key)
+            while pending is not None and len(pending) > 0 and pending[0].done():
+                future = pending.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("{} job of {} failed, {}", self.name, key, str(e))
+                    self.stats.incr(self.name + ".failed")
+                    continue
+                if result is not None:
+                    self.ready.put(result)
+            if pending is not None and len(pending) == 0:
+                del self.pending[key]
+            self.stats.gauge(self.name + ".ready", self.ready.qsize())
+
+    def get(self) -> Any:
+        result = self.ready.get()
+        self.stats.gauge(self.name + ".ready", self.ready.qsize())
+        return result
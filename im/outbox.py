@@ -0,0 +1,236 @@
+from common import Stats, TelegramConfig, TokenBucket
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Any, Awaitable, Callable, Deque, Dict, Set, Tuple
+
+from loguru import logger
+
+floodRetries = 5 # tries of one send that keeps hitting the flood limit
+idleBuckets = 1024 # per chat buckets kept before full ones of idle chats are dropped
+
+
+def floodWait(e: Exception) -> float:
+    # seconds telegram asked to wait after a 429, None for any other error
+    if getattr(e, "error_code", None) != 429:
+        return None
+    result = getattr(e, "result_json", None) or {}
+    return float((result.get("parameters") or {}).get("retry_after", 1))
+
+
+@dataclass
+class Send:
+    chat: int
+    request: Callable[[], Any]
+    fallback: Callable[[], Any] = None # tried once when request fails for another reason than the flood limit
+    future: Any = None
+    queued: float = field(default_factory=time.monotonic)
+    tries: int = 0
+
+
+class SendSchedule:
+    # which send goes next: private chats before groups, then the one waiting longest,
+    # within the global and the per chat limit. one send per chat at a time keeps chat order
+
+    def __init__(self, config: TelegramConfig, stats: Stats) -> None:
+        self.config: TelegramConfig = config
+        self.stats: Stats = stats
+        self.all: TokenBucket = TokenBucket(config.sendRate, period=1)
+        self.queues: Dict[int, Deque[Send]] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.pausedUntil: Dict[int, float] = {}
+        self.busy: Set[int] = set()
+        self.pending: int = 0
+
+    def bucketOf(self, chat: int) -> TokenBucket:
+        bucket = self.buckets.get(chat)
+        if bucket is None:
+            # private chat ids are positive, groups and channels negative
+            if chat > 0:
+                bucket = TokenBucket(1, period=1 / self.config.chatRate)
+            else:
+                bucket = TokenBucket(self.config.groupRate, period=60)
+            self.buckets[chat] = bucket
+        return bucket
+
+    def push(self, send: Send, front: bool = False) -> None:
+        queue = self.queues.setdefault(send.chat, deque())
+        if front:
+            queue.appendleft(send)
+        else:
+            queue.append(send)
+        self.pending += 1
+        self.stats.gauge("send.pending", self.pending)
+        if len(self.buckets) > idleBuckets:
+            self.prune()
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for chat in [c for c, b in self.buckets.items() if c not in self.queues and c not in self.busy and b.fraction(now) >= 1]:
+            del self.buckets[chat]
+            self.pausedUntil.pop(chat, None)
+
+    def pop(self, now: float) -> Tuple[Send, float]:
+        # the next send, or seconds until one may go, None when there is nothing to send
+        best: Send = None
+        wait: float = None
+        for chat, queue in self.queues.items():
+            if chat in self.busy:
+                continue
+            bucket = self.bucketOf(chat)
+            delay = max(self.pausedUntil.get(chat, 0) - now, bucket.waitFor(1) if not bucket.canTake(1, now) else 0)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = queue[0]
+            if best is None or (head.chat > 0, -head.queued) > (best.chat > 0, -best.queued):
+                best = head
+        if best is None:
+            return None, wait
+        if not self.all.canTake(1, now):
+            return None, self.all.waitFor(1)
+
+        self.all.take(1)
+        self.bucketOf(best.chat).take(1)
+        queue = self.queues[best.chat]
+        queue.popleft()
+        if len(queue) == 0:
+            del self.queues[best.chat]
+        self.busy.add(best.chat)
+        self.pending -= 1
+        self.stats.gauge("send.pending", self.pending)
+        self.stats.observe("send.queued", now - best.queued)
+        return best, None
+
+    def done(self, send: Send) -> None:
+        self.busy.discard(send.chat)
+
+    def limited(self, send: Send, wait: float) -> None:
+        # the chat waits as long as telegram asked, the send goes first once it may
+        self.busy.discard(send.chat)
+        self.pausedUntil[send.chat] = time.monotonic() + wait
+        self.stats.incr("send.flood")
+        self.push(send, front=True)
+
+
+class Outbox:
+    # all sends of the bot, callers get a future instead of waiting for their turn
+
+    def __init__(self, config: TelegramConfig, stats: Stats) -> None:
+        self.schedule: SendSchedule = SendSchedule(config, stats)
+        self.stats: Stats = stats
+        self.cond: Condition = Condition()
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=config.sendWorkers, thread_name_prefix="tg-send")
+        self.dispatcher: Thread = Thread(target=self.dispatch, name="tg-outbox", daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, chat: int, request: Callable[[], Any], fallback: Callable[[], Any] = None) -> Future:
+        send = Send(chat, request, fallback, Future())
+        with self.cond:
+            self.schedule.push(send)
+            self.cond.notify()
+        return send.future
+
+    def dispatch(self) -> None:
+        while True:
+            with self.cond:
+                send, wait = self.schedule.pop(time.monotonic())
+                while send is None:
+                    self.cond.wait(wait)
+                    send, wait = self.schedule.pop(time.monotonic())
+            self.pool.submit(self.run, send)
+
+    def run(self, send: Send) -> None:
+        send.tries += 1
+        try:
+            result = send.request()
+        except Exception as e:
+            self.failed(send, e)
+            return
+        with self.cond:
+            self.schedule.done(send)
+            self.cond.notify()
+        send.future.set_result(result)
+
+    def failed(self, send: Send, e: Exception) -> None:
+        wait = floodWait(e)
+        with self.cond:
+            if wait is not None and send.tries < floodRetries:
+                logger.warning("telegram flood limit in chat {}, retry in {} seconds", send.chat, wait)
+                self.schedule.limited(send, wait)
+            elif wait is None and send.fallback is not None:
+                logger.error("failed to send to chat {}, {}", send.chat, str(e))
+                self.schedule.done(send)
+                self.schedule.push(Send(send.chat, send.fallback, None, send.future, send.queued), front=True)
+            else:
+                logger.error("failed to send to chat {}, {}", send.chat, str(e))
+                self.stats.incr("send.failed")
+                self.schedule.done(send)
+                send.future.set_exception(e)
+            self.cond.notify()
+
+
+class AsyncOutbox:
+    # the same schedule for the asyncio bot, started on the loop of the first send
+
+    def __init__(self, config: TelegramConfig, stats: Stats) -> None:
+        self.schedule: SendSchedule = SendSchedule(config, stats)
+        self.stats: Stats = stats
+        self.wakeup: asyncio.Event = None
+        self.dispatcher: asyncio.Task = None
+        self.running: Set[asyncio.Task] = set()
+
+    def submit(self, chat: int, request: Callable[[], Awaitable], fallback: Callable[[], Awaitable] = None) -> asyncio.Future:
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        send = Send(chat, request, fallback, asyncio.get_running_loop().create_future())
+        # failures are logged here, a caller that doesn't wait must not get them reported again
+        send.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.schedule.push(send)
+        self.wakeup.set()
+        return send.future
+
+    async def dispatch(self) -> None:
+        while True:
+            send, wait = self.schedule.pop(time.monotonic())
+            if send is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self.run(send))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, send: Send) -> None:
+        send.tries += 1
+        try:
+            result = await send.request()
+        except Exception as e:
+            self.failed(send, e)
+        else:
+            self.schedule.done(send)
+            send.future.set_result(result)
+        self.wakeup.set()
+
+    def failed(self, send: Send, e: Exception) -> None:
+        wait = floodWait(e)
+        if wait is not None and send.tries < floodRetries:
+            logger.warning("telegram flood limit in chat {}, retry in {} seconds", send.chat, wait)
+            self.schedule.limited(send, wait)
+        elif wait is None and send.fallback is not None:
+            logger.error("failed to send to chat {}, {}", send.chat, str(e))
+            self.schedule.done(send)
+            self.schedule.push(Send(send.chat, send.fallback, None, send.future, send.queued), front=True)
+        else:
+            logger.error("failed to send to chat {}, {}", send.chat, str(e))
+            self.stats.incr("send.failed")
+            self.schedule.done(send)
+            send.future.set_exception(e)
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+from definition import AsyncMessageBot, AsyncMessage, AsyncChat, Media, MediaBuffer, MessageID, User, UserID, ChatID
+from im.common import ChatCache
+from im.outbox import AsyncOutbox
+from im.webhook import WebhookServer
+from im.tgchat import TgBot, TgMedia, TgUser, TgFormatter, _idPrefix, streamPlaceholder, statsInterval, replyToUser, mentionsOf, isMentionedBy, pickPhoto
+from common import Stats, TelegramConfig
+
+import asyncio, os, time
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List
+
+from loguru import logger
+
+
+class AsyncTgBot(AsyncMessageBot):
+
+    def __init__(self, config: TelegramConfig, photoTarget: int = 0, photoLongSide: bool = False) -> None:
+        self.config = config
+        self.photoTarget: int = photoTarget
+        self.photoLongSide: bool = photoLongSide
+        self.msgQueue: asyncio.Queue[types.Message] = asyncio.Queue()
+        self.api: AsyncTeleBot = AsyncTeleBot(config.botToken)
+        @self.api.message_handler(content_types=['audio', 'photo', 'voice', 'text'])
+        async def enQueue(message: types.Message) -> None:
+            await self.msgQueue.put(message)
+
+        self.task: asyncio.Task = None
+        self.dispatcher: asyncio.Task = None
+        self.webhook: WebhookServer = None
+        self.cache: ChatCache = ChatCache(config.cacheCapacity, config.cacheTTL)
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.me: types.User = None
+
+        self.stats: Stats = Stats()
+        self.downloadSlots: asyncio.Semaphore = asyncio.Semaphore(config.downloadWorkers)
+        self.outbox: AsyncOutbox = AsyncOutbox(config, self.stats)
+        # last conversion task of each chat, the next one waits for it before handing on
+        self.chatTail: Dict[int, asyncio.Task] = {}
+        self.ready: asyncio.Queue[AsyncMessage] = asyncio.Queue()
+
+    async def getMessages(self) -> AsyncIterator[AsyncMessage]:
+        if self.task is None:
+            self.task = asyncio.create_task(self.listen())
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        while True:
+            msg: AsyncMessage = await self.ready.get()
+            self.stats.gauge("download.ready", self.ready.qsize())
+            yield msg
+
+    async def listen(self) -> None:
+        if self.config.webhookUrl != "":
+            # the webhook server runs its own threads, updates are handled on this loop
+            loop = asyncio.get_running_loop()
+            self.webhook = WebhookServer(self.config,
+                                         lambda update: asyncio.run_coroutine_threadsafe(self.api.process_new_updates([update]), loop),
+                                         self.stats)
+            await self.api.set_webhook(url=self.config.webhookUrl, certificate=self.webhook.certificate(),
+                                       secret_token=self.webhook.secret)
+            return
+
+        # getUpdates is refused while a webhook is set
+        try:
+            await self.api.remove_webhook()
+        except Exception as e:
+            logger.error("failed to remove webhook, {}", str(e))
+        await self.api.infinity_polling()
+
+    async def dispatch(self) -> None:
+        lastLog = time.monotonic()
+        while True:
+            tgMsg: types.Message = await self.msgQueue.get()
+            self.stats.gauge("incoming", self.msgQueue.qsize())
+            cid = tgMsg.chat.id
+            task = asyncio.create_task(self.convertInOrder(tgMsg, self.chatTail.get(cid)))
+            self.chatTail[cid] = task
+            task.add_done_callback(lambda t, cid=cid: self.releaseTail(cid, t))
+
+            now = time.monotonic()
+            if now - lastLog > statsInterval:
+                lastLog = now
+                logger.debug("telegram pipeline stats: {}", self.stats.snapshot())
+
+    def releaseTail(self, cid: int, task: asyncio.Task) -> None:
+        if self.chatTail.get(cid) is task:
+            del self.chatTail[cid]
+
+    async def convertInOrder(self, tgMsg: types.Message, previous: asyncio.Task) -> None:
+        msg: AsyncTgMessage = None
+        try:
+            me = await self.getMe()
+            msg = await self.tgMessageConvert(tgMsg)
+            # media of messages that are probably for us is fetched ahead, the rest only on demand
+            if self.hasMedia(tgMsg) and (tgMsg.chat.type == "private" or msg.isReplyToSelf() or isMentionedBy(msg.getMentions(), me.username)):
+                await msg.fetchMedia()
+        except Exception as e:
+            logger.error("failed to convert message {}, {}", tgMsg.message_id, str(e))
+            self.stats.incr("download.failed")
+
+        if previous is not None:
+            await asyncio.wait([previous])
+        if msg is not None:
+            await self.ready.put(msg)
+            self.stats.gauge("download.ready", self.ready.qsize())
+
+    stripPrefixToInt = TgBot.stripPrefixToInt
+    hasMedia = TgBot.hasMedia
+
+    async def getMe(self) -> types.User:
+        if self.me is None:
+            self.me = await self.api.get_me()
+        return self.me
+
+    def startLoad(self, key: Hashable, load: Callable[[], Awaitable]) -> asyncio.Future:
+        # concurrent misses of one key share a single request
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self.loaded(key, t))
+        return task
+
+    def loaded(self, key: Hashable, task: asyncio.Future) -> None:
+        self.inflight.pop(key, None)
+        # nobody awaits a background refresh, its failure is only logged
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("failed to load {}, {}", key, str(task.exception()))
+
+    async def loadOnce(self, key: Hashable, load: Callable[[], Awaitable]):
+        return await asyncio.shield(self.startLoad(key, load))
+
+    def refresh(self, name: str, key: Hashable, load: Callable[[], Awaitable]) -> None:
+        # a stale entry is served while a task on the loop fetches the new one
+        if key not in self.inflight:
+            self.cache.stats.incr(name + ".refresh")
+            self.startLoad(key, load)
+
+    async def lookupChat(self, cid: ChatID) -> AsyncChat:
+        chat, stale = self.cache.peekChat(cid)
+
+        async def load() -> AsyncChat:
+            memberCnt: int = await self.api.get_chat_member_count(self.stripPrefixToInt(cid))
+            chat = AsyncTgChat(self, cid, memberCnt)
+            self.cache.cacheChat(cid, chat)
+            return chat
+
+        if chat is not None:
+            if stale:
+                self.refresh("chat", ("chat", cid), load)
+            return chat
+        return await self.loadOnce(("chat", cid), load)
+
+    async def lookupUser(self, uid: UserID, cid: ChatID) -> User:
+        user, stale = self.cache.peekChatUser(cid, uid)
+
+        async def load() -> User:
+            tgUser: types.ChatMember = await self.api.get_chat_member(self.stripPrefixToInt(cid), self.stripPrefixToInt(uid))
+            user = TgUser(uid, cid, tgUser.user.username, tgUser.user.first_name)
+            self.cache.cacheChatUser(cid, uid, user)
+            return user
+
+        if user is not None:
+            if stale:
+                self.refresh("user", ("user", cid, uid), load)
+            return user
+        return await self.loadOnce(("user", cid, uid), load)
+
+    async def tgMessageConvert(self, tgMsg: types.Message) -> AsyncMessage:
+        msg = AsyncTgMessage(self,
+                             MessageID(_idPrefix + str(tgMsg.message_id)),
+                             UserID(_idPrefix + str(tgMsg.from_user.id)),
+                             ChatID(_idPrefix + str(tgMsg.chat.id)))
+        msg.media.addText(tgMsg.text)
+        msg.replyTo = replyToUser(tgMsg)
+        msg.mentions = mentionsOf(tgMsg.text, tgMsg.entities) + mentionsOf(tgMsg.caption, tgMsg.caption_entities)
+        if tgMsg.voice is not None or tgMsg.audio is not None:
+            sound = tgMsg.voice if tgMsg.voice is not None else tgMsg.audio
+            msg.media.referVoice(sound.file_id, sound.duration or 0)
+        if tgMsg.photo is not None:
+            msg.media.referPhoto(pickPhoto(tgMsg.photo, self.photoTarget, self.photoLongSide).file_id)
+            if tgMsg.caption is not None:
+                msg.media.addText(tgMsg.caption)
+
+        return msg
+
+    async def downloadFile(self, fd: str) -> MediaBuffer:
+        start = time.monotonic()
+        file_info: types.File = await self.api.get_file(fd)
+        binary: bytes = await self.api.download_file(file_info.file_path)
+        self.stats.observe("download.latency", time.monotonic() - start)
+        return MediaBuffer(os.path.basename(file_info.file_path), binary)
+
+
+class AsyncTgMessage(AsyncMessage):
+
+    def __init__(self, bot: AsyncTgBot, mid: MessageID, uid: UserID, cid: ChatID) -> None:
+        self.bot: AsyncTgBot = bot
+        self.mid: MessageID = mid
+        self.uid: UserID = uid
+        self.cid: ChatID = cid
+        # no fetcher, referred media is downloaded by fetchMedia
+        self.media: TgMedia = TgMedia()
+        self.replyTo: int = None
+        self.mentions: List[str] = []
+
+    def getID(self) -> MessageID:
+        return self.mid
+
+    async def getUser(self) -> User:
+        return await self.bot.lookupUser(self.uid, self.cid)
+
+    async def getChat(self) -> AsyncChat:
+        return await self.bot.lookupChat(self.cid)
+
+    def getChatID(self) -> ChatID:
+        return self.cid
+
+    def getMedia(self) -> Media:
+        return self.media
+
+    def isReplyToSelf(self) -> bool:
+        return self.replyTo is not None and self.bot.me is not None and self.replyTo == self.bot.me.id
+
+    def getMentions(self) -> List[str]:
+        return self.mentions
+
+    async def fetchMedia(self) -> None:
+        media = self.media
+        if len(media.voiceIds) == 0 and len(media.photoIds) == 0:
+            return
+        async with self.bot.downloadSlots:
+            while len(media.voiceIds) > 0:
+                media.addFetchedVoice(media.voiceIds[0], await self.bot.downloadFile(media.voiceIds[0]))
+                media.voiceIds.pop(0)
+            while len(media.photoIds) > 0:
+                media.addPhoto(await self.bot.downloadFile(media.photoIds[0]))
+                media.photoIds.pop(0)
+
+
+class AsyncTgChat(AsyncChat, TgFormatter):
+
+    def __init__(self, bot: AsyncTgBot, id: ChatID, memberCnt: int) -> None:
+        TgFormatter.__init__(self, bot.config)
+        self.id: ChatID = id
+        self.bot: AsyncTgBot = bot
+        self.memberCount: int = memberCnt
+
+    def getID(self) -> ChatID:
+        return self.id
+
+    def getMemberCount(self) -> int:
+        return self.memberCount
+
+    async def replyMessage(self, message: str, replyTo: MessageID) -> None:
+        self.send(message, self.escape(message), replyTo)
+
+    async def quoteMessage(self, message: str, replyTo: MessageID, quote: str) -> None:
+        self.send(self.plainQuote(message, quote), self.formatQuote(message, quote), replyTo)
+
+    def send(self, plain: str, formatted: str, replyTo: MessageID) -> None:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        replyId = self.bot.stripPrefixToInt(replyTo)
+        self.bot.outbox.submit(
+            chatId,
+            lambda: self.bot.api.send_message(chat_id=chatId, text=formatted, parse_mode=self.parseMode, reply_to_message_id=replyId),
+            lambda: self.bot.api.send_message(chat_id=chatId, text=plain, parse_mode="", reply_to_message_id=replyId)
+        )
+
+    async def replyStream(self, deltas: AsyncIterator[str], replyTo: MessageID) -> str:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        placeholder: types.Message = await self.bot.outbox.submit(chatId, lambda: self.bot.api.send_message(
+            chat_id=chatId,
+            text=streamPlaceholder,
+            parse_mode="",
+            reply_to_message_id=self.bot.stripPrefixToInt(replyTo)
+        ))
+
+        parts: List[str] = []
+        shown = streamPlaceholder
+        lastEdit: float = None
+        async for delta in deltas:
+            parts.append(delta)
+            now = time.monotonic()
+            if lastEdit is not None and now - lastEdit < self.streamInterval:
+                continue
+            text = "".join(parts)
+            if len(text.strip()) == 0 or text == shown:
+                continue
+            # partial markdown is usually broken, so show plain text until the answer is complete
+            if await self.editMessage(placeholder.message_id, text, ""):
+                shown = text
+            lastEdit = now
+
+        message = "".join(parts)
+        if not await self.editMessage(placeholder.message_id, self.escape(message), self.parseMode) and message != shown:
+            logger.error("failed to edit streamed message as markdown")
+            await self.editMessage(placeholder.message_id, message, "")
+        return message
+
+    async def editMessage(self, mid: int, text: str, parseMode: str) -> bool:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        try:
+            await self.bot.outbox.submit(chatId, lambda: self.bot.api.edit_message_text(
+                text=text,
+                chat_id=chatId,
+                message_id=mid,
+                parse_mode=parseMode
+            ))
+            return True
+        except Exception as e:
+            logger.debug("failed to edit message {}, {}", mid, str(e))
+            return False
+
+    async def replyVoice(self, audio: MediaBuffer, message: MessageID) -> None:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        self.bot.outbox.submit(chatId, lambda: self.bot.api.send_voice(chat_id=chatId, voice=audio.reader()))
+
+    async def getSelf(self) -> User:
+        me = await self.bot.getMe()
+        return await self.bot.lookupUser(UserID(_idPrefix + str(me.id)), self.id)
@@ -1,39 +1,108 @@
 from __future__ import annotations
 
-from definition import MessageBot, Message, Media, MessageID, User, UserID, Chat, ChatID, CleanFunc
-from im.common import ChatCache
-from common import rmHandle, TelegramConfig
+from definition import MessageBot, Message, Media, MediaBuffer, MessageID, User, UserID, Chat, ChatID
+from im.common import ChatCache, OrderedPipeline
+from im.outbox import Outbox
+from im.webhook import WebhookServer
+from common import Stats, TelegramConfig
 
-import os, tempfile, re
+import os, re, time
 from queue import Queue
-from threading import Thread
+from threading import Lock, Thread
 from telebot import TeleBot, types
-from typing import Iterable, Tuple, List
+from typing import Callable, Dict, Iterable, List
 
 from loguru import logger
 
 _idPrefix = 'tg-'
+streamPlaceholder = '...'
+statsInterval = 60
 
 class TgBot(MessageBot):
     
-    def __init__(self, config: TelegramConfig) -> None:
+    def __init__(self, config: TelegramConfig, photoTarget: int = 0, photoLongSide: bool = False) -> None:
         self.config = config
+        self.photoTarget: int = photoTarget # short side in px a downloaded photo should have, 0 for the largest
+        self.photoLongSide: bool = photoLongSide # photoTarget is the long side instead
         self.msgQueue: Queue[types.Message] = Queue()
         self.api: TeleBot = TeleBot(config.botToken)
         @self.api.message_handler(content_types=['audio', 'photo', 'voice', 'text']) #, 'video', 'document', 'location', 'contact', 'sticker', 'picture'])
         def enQueue(message: types.Message) -> None:
             self.msgQueue.put(message)
 
-        self.task: Thread = Thread(target=self.api.infinity_polling)
-        self.task.start()
-        self.cache: ChatCache = ChatCache()
+        self.cache: ChatCache = ChatCache(config.cacheCapacity, config.cacheTTL)
+        self.stats: Stats = Stats()
+        # media is fetched off the consumer thread, messages still come out in chat order
+        self.downloads: OrderedPipeline = OrderedPipeline("download", config.downloadWorkers, self.stats)
+        # sends keep to telegram's flood limits without holding up the workers
+        self.outbox: Outbox = Outbox(config, self.stats)
+        self.dispatcher: Thread = Thread(target=self.dispatch, name="tg-dispatch", daemon=True)
+        self.dispatcher.start()
+
+        self.webhook: WebhookServer = None
+        if config.webhookUrl != "":
+            # updates are pushed to us, the same handlers take them
+            self.webhook = WebhookServer(config, lambda update: self.api.process_new_updates([update]), self.stats)
+            self.api.set_webhook(url=config.webhookUrl, certificate=self.webhook.certificate(),
+                                 secret_token=self.webhook.secret)
+            self.task: Thread = None
+        else:
+            self.task: Thread = Thread(target=self.poll)
+            self.task.start()
+
+    def poll(self) -> None:
+        # getUpdates is refused while a webhook is set
+        try:
+            self.api.remove_webhook()
+        except Exception as e:
+            logger.error("failed to remove webhook, {}", str(e))
+        self.api.infinity_polling()
 
     def getMessages(self) -> Iterable[Message]:
         while True:
-            tgMsg: types.Message = self.msgQueue.get()
-            msg: Message = self.tgMessageConvert(tgMsg)
+            msg: Message = self.downloads.get()
             if msg is not None:
                 yield msg
+
+    def dispatch(self) -> None:
+        lastLog = time.monotonic()
+        while True:
+            tgMsg: types.Message = self.msgQueue.get()
+            self.stats.gauge("incoming", self.msgQueue.qsize())
+            try:
+                msg: TgMessage = self.tgMessageConvert(tgMsg)
+            except Exception as e:
+                logger.error("failed to convert message {}, {}", tgMsg.message_id, str(e))
+                continue
+            # media of messages that are probably for us is fetched ahead, the rest only on demand
+            if self.likelyHandled(tgMsg, msg):
+                self.downloads.submit(tgMsg.chat.id, lambda m=msg: self.prefetch(m))
+            else:
+                self.downloads.submit(tgMsg.chat.id, lambda m=msg: m, inline=True)
+
+            now = time.monotonic()
+            if now - lastLog > statsInterval:
+                lastLog = now
+                logger.debug("telegram pipeline stats: {}", self.stats.snapshot())
+
+    def hasMedia(self, tgMsg: types.Message) -> bool:
+        return tgMsg.voice is not None or tgMsg.audio is not None or tgMsg.photo is not None
+
+    def likelyHandled(self, tgMsg: types.Message, msg: Message) -> bool:
+        if not self.hasMedia(tgMsg):
+            return False
+        if tgMsg.chat.type == "private" or msg.isReplyToSelf():
+            return True
+        return isMentionedBy(msg.getMentions(), self.api.user.username)
+
+    def prefetch(self, msg: TgMessage) -> TgMessage:
+        try:
+            msg.media.fetch()
+        except Exception as e:
+            # the handler tries again when it needs the media
+            logger.error("failed to prefetch media of message {}, {}", msg.getID(), str(e))
+            self.stats.incr("download.failed")
+        return msg
     
     def stripPrefixToInt(self, id: str) -> int:
         if id.startswith(_idPrefix):
@@ -41,69 +110,96 @@ class TgBot(MessageBot):
         return int(id)
     
     def lookupChat(self, cid: ChatID) -> Chat:
-        chat: Chat = self.cache.getChat(cid)
-        if chat is not None:
-            return chat
-        
-        #tgChat: types.Chat = self.bot.get_chat(cid)
-        memberCnt: int = self.api.get_chat_member_count(self.stripPrefixToInt(cid))
-        chat = TgChat(self, cid, memberCnt)
-        self.cache.cacheChat(cid, chat)
+        def load() -> Chat:
+            #tgChat: types.Chat = self.bot.get_chat(cid)
+            memberCnt: int = self.api.get_chat_member_count(self.stripPrefixToInt(cid))
+            return TgChat(self, cid, memberCnt)
 
-        return chat
+        return self.cache.loadChat(cid, load)
     
     def lookupUser(self, uid: UserID, cid: ChatID) -> User:
-        user: User = self.cache.getChatUser(cid, uid)
-        if user is not None:
-            return user
-        
-        tgUser: types.ChatMember = self.api.get_chat_member(self.stripPrefixToInt(cid), self.stripPrefixToInt(uid))
-        user = TgUser(uid, cid, tgUser.user.username, tgUser.user.first_name)
-        self.cache.cacheChatUser(cid, uid, user)
+        def load() -> User:
+            tgUser: types.ChatMember = self.api.get_chat_member(self.stripPrefixToInt(cid), self.stripPrefixToInt(uid))
+            return TgUser(uid, cid, tgUser.user.username, tgUser.user.first_name)
 
-        return user
+        return self.cache.loadChatUser(cid, uid, load)
 
     
     def tgMessageConvert(self, tgMsg: types.Message) -> Message:
         msg = TgMessage(self,
                         MessageID(_idPrefix + str(tgMsg.message_id)),
                         UserID(_idPrefix + str(tgMsg.from_user.id)),
-                        ChatID(_idPrefix + str(tgMsg.chat.id)))
+                        ChatID(_idPrefix + str(tgMsg.chat.id)),
+                        TgMedia(self.downloadFile))
         msg.withText(tgMsg.text)
+        msg.replyTo = replyToUser(tgMsg)
+        msg.mentions = mentionsOf(tgMsg.text, tgMsg.entities) + mentionsOf(tgMsg.caption, tgMsg.caption_entities)
         if tgMsg.voice is not None or tgMsg.audio is not None:
-            # save file to tmp
-            if tgMsg.voice is not None:
-                fd: str = tgMsg.voice.file_id
-            else:
-                fd: str = tgMsg.audio.file_id
-            fp, cleanFunc = self.downloadFile(fd)
-            msg.withAudio(fp, cleanFunc)
+            sound = tgMsg.voice if tgMsg.voice is not None else tgMsg.audio
+            msg.media.referVoice(sound.file_id, sound.duration or 0)
         if tgMsg.photo is not None:
-            # get the largest latest image
-            fd: str = tgMsg.photo[-1].file_id
-            fp, cleanFunc = self.downloadFile(fd)
-            msg.withPhoto(fp, cleanFunc)
+            msg.media.referPhoto(pickPhoto(tgMsg.photo, self.photoTarget, self.photoLongSide).file_id)
             if tgMsg.caption is not None:
                 msg.withText(tgMsg.caption)
 
         return msg
     
-    def downloadFile(self, fd: str) -> Tuple[str, CleanFunc]:
+    def downloadFile(self, fd: str) -> MediaBuffer:
+        start = time.monotonic()
         file_info: types.File = self.api.get_file(fd)
-        ext = os.path.splitext(file_info.file_path)[-1]
         binary: bytes = self.api.download_file(file_info.file_path)
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmpf:
-            tmpf.write(binary)
-            #def clean():
-            #    os.remove(tmpf.name)
-            return tmpf.name, rmHandle(tmpf.name)
+        self.stats.observe("download.latency", time.monotonic() - start)
+        return MediaBuffer(os.path.basename(file_info.file_path), binary)
         
 
+def replyToUser(tgMsg: types.Message) -> int:
+    replied = tgMsg.reply_to_message
+    if replied is None or replied.from_user is None:
+        return None
+    return replied.from_user.id
+
+
+def pickPhoto(sizes: List[types.PhotoSize], target: int, longSide: bool = False) -> types.PhotoSize:
+    # the smallest size the vision model won't have to scale up, the largest if none is big enough
+    largest = max(sizes, key=lambda p: p.width * p.height)
+    side = max if longSide else min
+    fits = [p for p in sizes if side(p.width, p.height) >= target] if target > 0 else []
+    if len(fits) == 0:
+        return largest
+    return min(fits, key=lambda p: p.width * p.height)
+
+
+def mentionsOf(text: str, entities: List[types.MessageEntity]) -> List[str]:
+    if text is None or entities is None:
+        return []
+    # entity offsets count utf-16 code units
+    encoded = text.encode("utf-16-le")
+    mentions = []
+    for e in entities:
+        if e.type == "mention":
+            mentions.append(encoded[e.offset * 2:(e.offset + e.length) * 2].decode("utf-16-le"))
+    return mentions
+
+
+def isMentionedBy(mentions: List[str], username: str) -> bool:
+    if username is None:
+        return False
+    name = "@" + username.lower()
+    return any(m.lower() == name for m in mentions)
+
+
 class TgMedia(Media):
-    def __init__(self):
+    # photos and voices may be referred to by telegram file id, they are downloaded on first access
+
+    def __init__(self, fetcher: Callable[[str], MediaBuffer] = None):
         self.text = None
         self.voice = None
         self.photo = None
+        self.fetcher = fetcher
+        self.voiceIds: List[str] = []
+        self.photoIds: List[str] = []
+        self.durations: Dict[str, float] = {} # file id -> seconds, as telegram reports them
+        self.lock: Lock = Lock()
 
     def addText(self, text: str):
         if text is not None:
@@ -111,52 +207,83 @@ class TgMedia(Media):
                 self.text = []
             self.text.append(text)
     
-    def addVoice(self, audioFile: str, cleanFunc: CleanFunc):
-        if audioFile is not None and cleanFunc is not None:
+    def addVoice(self, audio: MediaBuffer):
+        if audio is not None:
             if self.voice is None:
                 self.voice = []
-            self.voice.append((audioFile, cleanFunc))
+            self.voice.append(audio)
 
-    def addPhoto(self, photoFile: str, cleanFunc: CleanFunc):
-        if photoFile is not None and cleanFunc is not None:
+    def addPhoto(self, photo: MediaBuffer):
+        if photo is not None:
             if self.photo is None:
                 self.photo = []
-            self.photo.append((photoFile, cleanFunc))
-
-    def getPhoto(self) -> List[Tuple[str, CleanFunc]]:
+            self.photo.append(photo)
+
+    def referVoice(self, fd: str, duration: float = 0):
+        self.voiceIds.append(fd)
+        self.durations[fd] = duration
+
+    def addFetchedVoice(self, fd: str, audio: MediaBuffer):
+        if audio is not None:
+            audio.duration = self.durations.get(fd, 0)
+        self.addVoice(audio)
+
+    def referPhoto(self, fd: str):
+        self.photoIds.append(fd)
+
+    def fetch(self):
+        if self.fetcher is None:
+            return
+        with self.lock:
+            while len(self.voiceIds) > 0:
+                self.addFetchedVoice(self.voiceIds[0], self.fetcher(self.voiceIds[0]))
+                self.voiceIds.pop(0)
+            while len(self.photoIds) > 0:
+                self.addPhoto(self.fetcher(self.photoIds[0]))
+                self.photoIds.pop(0)
+
+    def getPhoto(self) -> List[MediaBuffer]:
+        self.fetch()
         return self.photo
 
-    def getVoice(self) -> List[Tuple[str, CleanFunc]]:
+    def getVoice(self) -> List[MediaBuffer]:
+        self.fetch()
         return self.voice
     
     def getText(self) -> List[str]:
         return self.text
 
+    def hasPhoto(self) -> bool:
+        return self.photo is not None or len(self.photoIds) > 0
+
+    def hasVoice(self) -> bool:
+        return self.voice is not None or len(self.voiceIds) > 0
+
 
 
 class TgMessage(Message):
     
-    def __init__(self, bot: TgBot, mid: MessageID, uid: UserID, cid: ChatID) -> None:
+    def __init__(self, bot: TgBot, mid: MessageID, uid: UserID, cid: ChatID, media: TgMedia = None) -> None:
         self.bot: TgBot = bot
         self.mid: MessageID = mid
         self.uid: UserID = uid
         self.cid: ChatID = cid
         self.text: str = None
-        self.audioFile: str = None
-        self.cleanAudio: CleanFunc = None
-        self.media: TgMedia = TgMedia()
+        self.media: TgMedia = media if media is not None else TgMedia()
+        self.replyTo: int = None # telegram id of the author of the replied message
+        self.mentions: List[str] = []
 
     
     def withText(self, text: str) -> TgMessage:
         self.media.addText(text)
         return self
 
-    def withAudio(self, filePath: str, cleanFunc: CleanFunc) -> TgMessage:
-        self.media.addVoice(filePath, cleanFunc)
+    def withAudio(self, audio: MediaBuffer) -> TgMessage:
+        self.media.addVoice(audio)
         return self
 
-    def withPhoto(self, filePath: str, cleanFunc: CleanFunc) -> TgMessage:
-        self.media.addPhoto(filePath, cleanFunc)
+    def withPhoto(self, photo: MediaBuffer) -> TgMessage:
+        self.media.addPhoto(photo)
         return self
 
     def getID(self) -> MessageID:
@@ -168,21 +295,29 @@ class TgMessage(Message):
     def getChat(self) -> Chat:
         return self.bot.lookupChat(self.cid)
     
+    def getChatID(self) -> ChatID:
+        return self.cid
+
     def getMedia(self) -> Media:
         return self.media
+
+    def isReplyToSelf(self) -> bool:
+        return self.replyTo is not None and self.replyTo == self.bot.api.user.id
+
+    def getMentions(self) -> List[str]:
+        return self.mentions
     
  
 
-class TgChat(Chat):
+class TgFormatter:
+    # text formatting shared by the threaded and the asyncio chat
 
-    def __init__(self, bot: TgBot, id: ChatID, memberCnt: int) -> None:
-        self.id: ChatID = id
-        self.bot: TgBot = bot
-        self.parseMode = bot.config.parseMode
-        self.needEscape = bot.config.escapeText
-        self.memberCount: int = memberCnt
+    def __init__(self, config: TelegramConfig) -> None:
+        self.parseMode = config.parseMode
+        self.needEscape = config.escapeText
+        self.streamInterval = config.streamInterval
         self.notouchPattens = self.createPatterns()
-        
+
     def createPatterns(self) -> List[re.Pattern]:
         pattens: List[re.Pattern] = []
 
@@ -195,86 +330,25 @@ class TgChat(Chat):
         return pattens
 
 
-    def getID(self) -> ChatID:
-        return self.id
-
-    def getMemberCount(self) -> int:
-        return self.memberCount
-
-    def sendMessage(self, message: str) -> None:
-        raise NotImplementedError("not implemented")
-
-    def replyMessage(self, message: str, replyTo: MessageID) -> None:
-        escapedMsg = self.escape(message)
-        if escapedMsg != message:
-            logger.debug("escaped message: {}", escapedMsg)
-            
-        try:
-            self.bot.api.send_message(
-                chat_id=self.bot.stripPrefixToInt(self.id),
-                text=escapedMsg,
-                parse_mode=self.parseMode,
-                reply_to_message_id=self.bot.stripPrefixToInt(replyTo)
-            )
-        except Exception as e:
-            logger.error("failed to send message as markdown, {}", str(e))
-            self.bot.api.send_message(
-                chat_id=self.bot.stripPrefixToInt(self.id),
-                text=message,
-                parse_mode="",
-                reply_to_message_id=self.bot.stripPrefixToInt(replyTo)
-            )
-
+    def formatQuote(self, message: str, quote: str) -> str:
+        md = ""
+        if self.parseMode.startswith("Markdown"):
+            #md = "\n".join([f"**{self.escape(l)}**" for l in quote.splitlines()])
+            md = f"```{self.escape(quote)}```"
+        else:
+            md = quote
+        md += "  \n"
+        md += "  \n"
+        md += self.escape(message)
+        return md
+
+    def plainQuote(self, message: str, quote: str) -> str:
+        plain = quote
+        plain += "  \n"
+        plain += "  \n"
+        plain += message
+        return plain
 
-
-    def quoteMessage(self, message: str, replyTo: MessageID, quote: str) -> None:
-        try:
-            md = ""
-            if self.parseMode.startswith("Markdown"):
-                #md = "\n".join([f"**{self.escape(l)}**" for l in quote.splitlines()])
-                md = f"```{self.escape(quote)}```"
-            else:
-                md = quote
-            md += "  \n"
-            md += "  \n"
-            md += self.escape(message)
-
-            self.bot.api.send_message(
-                chat_id=self.bot.stripPrefixToInt(self.id),
-                text=md,
-                parse_mode=self.parseMode,
-                reply_to_message_id=self.bot.stripPrefixToInt(replyTo)
-            )
-        except Exception as e:
-            logger.error("failed to send quote message as markdown, {}", str(e))
-
-            plain = quote
-            plain += "  \n"
-            plain += "  \n"
-            plain += message
-
-            self.bot.api.send_message(
-                chat_id=self.bot.stripPrefixToInt(self.id),
-                text=plain,
-                parse_mode="",
-                reply_to_message_id=self.bot.stripPrefixToInt(replyTo)
-            )
-
-
-    def replyImage(self, imgPath: str, message: MessageID) -> None:
-        raise NotImplementedError("not implemented")
-    
-    def replyVoice(self, audPath: str, message: MessageID) -> None:
-        with open(audPath, "rb") as voice:
-            self.bot.api.send_voice(
-                chat_id=self.bot.stripPrefixToInt(self.id),
-                voice=voice
-            )
-    
-    def getSelf(self) -> User:
-        sid = UserID(_idPrefix +str(self.bot.api.user.id))
-        return self.bot.lookupUser(sid, self.id)
-    
     def escapePuncs(self, msg: str) -> str:
         escape_chars = r'_*[]()~`>#+-=|{}.!'
         return "".join('\\' + ch if ch in escape_chars else ch for ch in msg)
@@ -317,6 +391,102 @@ class TgChat(Chat):
 
         return ''.join(escaped)
 
+
+class TgChat(Chat, TgFormatter):
+
+    def __init__(self, bot: TgBot, id: ChatID, memberCnt: int) -> None:
+        TgFormatter.__init__(self, bot.config)
+        self.id: ChatID = id
+        self.bot: TgBot = bot
+        self.memberCount: int = memberCnt
+        
+    def getID(self) -> ChatID:
+        return self.id
+
+    def getMemberCount(self) -> int:
+        return self.memberCount
+
+    def sendMessage(self, message: str) -> None:
+        raise NotImplementedError("not implemented")
+
+    def replyMessage(self, message: str, replyTo: MessageID) -> None:
+        escapedMsg = self.escape(message)
+        if escapedMsg != message:
+            logger.debug("escaped message: {}", escapedMsg)
+
+        # plain text when telegram can't parse the markdown
+        self.send(message, escapedMsg, replyTo)
+
+    def quoteMessage(self, message: str, replyTo: MessageID, quote: str) -> None:
+        self.send(self.plainQuote(message, quote), self.formatQuote(message, quote), replyTo)
+
+    def send(self, plain: str, formatted: str, replyTo: MessageID) -> None:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        replyId = self.bot.stripPrefixToInt(replyTo)
+        self.bot.outbox.submit(
+            chatId,
+            lambda: self.bot.api.send_message(chat_id=chatId, text=formatted, parse_mode=self.parseMode, reply_to_message_id=replyId),
+            lambda: self.bot.api.send_message(chat_id=chatId, text=plain, parse_mode="", reply_to_message_id=replyId)
+        )
+
+    def replyStream(self, deltas: Iterable[str], replyTo: MessageID) -> str:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        placeholder: types.Message = self.bot.outbox.submit(chatId, lambda: self.bot.api.send_message(
+            chat_id=chatId,
+            text=streamPlaceholder,
+            parse_mode="",
+            reply_to_message_id=self.bot.stripPrefixToInt(replyTo)
+        )).result()
+
+        parts: List[str] = []
+        shown = streamPlaceholder
+        lastEdit: float = None
+        for delta in deltas:
+            parts.append(delta)
+            now = time.monotonic()
+            if lastEdit is not None and now - lastEdit < self.streamInterval:
+                continue
+            text = "".join(parts)
+            if len(text.strip()) == 0 or text == shown:
+                continue
+            # partial markdown is usually broken, so show plain text until the answer is complete
+            if self.editMessage(placeholder.message_id, text, ""):
+                shown = text
+            lastEdit = now
+
+        message = "".join(parts)
+        escapedMsg = self.escape(message)
+        if not self.editMessage(placeholder.message_id, escapedMsg, self.parseMode) and message != shown:
+            logger.error("failed to edit streamed message as markdown")
+            self.editMessage(placeholder.message_id, message, "")
+        return message
+
+    def editMessage(self, mid: int, text: str, parseMode: str) -> bool:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        try:
+            # edits count against the flood limits as well
+            self.bot.outbox.submit(chatId, lambda: self.bot.api.edit_message_text(
+                text=text,
+                chat_id=chatId,
+                message_id=mid,
+                parse_mode=parseMode
+            )).result()
+            return True
+        except Exception as e:
+            logger.debug("failed to edit message {}, {}", mid, str(e))
+            return False
+
+    def replyImage(self, imgPath: str, message: MessageID) -> None:
+        raise NotImplementedError("not implemented")
+    
+    def replyVoice(self, audio: MediaBuffer, message: MessageID) -> None:
+        chatId = self.bot.stripPrefixToInt(self.id)
+        self.bot.outbox.submit(chatId, lambda: self.bot.api.send_voice(chat_id=chatId, voice=audio.reader()))
+    
+    def getSelf(self) -> User:
+        sid = UserID(_idPrefix +str(self.bot.api.user.id))
+        return self.bot.lookupUser(sid, self.id)
+
 class TgUser(User):
 
     def __init__(self, id: UserID, cid: ChatID, username: str, firstname: str) -> None:
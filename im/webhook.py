@@ -0,0 +1,87 @@
+from common import Stats, TelegramConfig
+
+import hmac
+import secrets
+import ssl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Callable
+from urllib.parse import urlparse
+
+from telebot import types
+from loguru import logger
+
+secretHeader = "X-Telegram-Bot-Api-Secret-Token"
+maxUpdateBytes = 1024 * 1024
+
+
+class WebhookServer:
+    # receives the updates telegram posts to webhookUrl and hands them to feed.
+    # telegram is answered before the update is handled, it would resend a slow one
+
+    def __init__(self, config: TelegramConfig, feed: Callable[[types.Update], None], stats: Stats) -> None:
+        self.config: TelegramConfig = config
+        self.path: str = urlparse(config.webhookUrl).path or "/"
+        # without a configured secret a random one is registered, the url alone must not let anyone post updates
+        self.secret: str = config.webhookSecret or secrets.token_urlsafe(32)
+        self.feed: Callable[[types.Update], None] = feed
+        self.stats: Stats = stats
+        self.server: ThreadingHTTPServer = ThreadingHTTPServer((config.webhookListen, config.webhookPort), self.handler())
+        self.server.daemon_threads = True
+        if config.webhookCert != "":
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(config.webhookCert, config.webhookKey or None)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.port: int = self.server.server_address[1]
+        self.task: Thread = Thread(target=self.server.serve_forever, name="tg-webhook", daemon=True)
+        self.task.start()
+        logger.info("listen for telegram updates on port {}", self.port)
+
+    def handler(self) -> type:
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                webhook.receive(self)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def receive(self, request: BaseHTTPRequestHandler) -> None:
+        if request.path != self.path:
+            request.send_error(404)
+            return
+        if not hmac.compare_digest(request.headers.get(secretHeader, "").encode(), self.secret.encode()):
+            self.stats.incr("webhook.rejected")
+            request.send_error(403)
+            return
+        size = int(request.headers.get("Content-Length", 0))
+        if size <= 0 or size > maxUpdateBytes:
+            request.send_error(400)
+            return
+        body = request.rfile.read(size)
+
+        request.send_response(200)
+        request.send_header("Content-Length", "0")
+        request.end_headers()
+        request.wfile.flush()
+
+        self.stats.incr("webhook.updates")
+        try:
+            self.feed(types.Update.de_json(body.decode("utf-8")))
+        except Exception as e:
+            logger.error("failed to handle webhook update, {}", str(e))
+            self.stats.incr("webhook.failed")
+
+    def certificate(self) -> bytes:
+        # a self signed certificate has to be uploaded with setWebhook
+        if self.config.webhookCert == "":
+            return None
+        with open(self.config.webhookCert, "rb") as f:
+            return f.read()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,10 +1,11 @@
 from common import getConfig, getAcl, setLogger
 from service.botservice import SmartBot
+from service.asyncbotservice import AsyncSmartBot
 
 setLogger()
 
 if __name__ == '__main__':
     cfg = getConfig()
     acl = getAcl()
-    sb = SmartBot(cfg, acl)
+    sb = AsyncSmartBot(cfg, acl) if cfg.system.useAsyncio else SmartBot(cfg, acl)
     sb.run()
\ No newline at end of file
@@ -0,0 +1,152 @@
+from definition import AsyncMessageBot, AsyncMessage, AsyncChat, MediaBuffer, MessageID
+from common import Config, ACL
+from im.tgasync import AsyncTgBot
+from service.botservice import SmartBot, deniedMessage, splitSpeech
+from ai.vision import visionTargetSize, visionTargetLongSide
+from service.mailbox import AsyncMailboxScheduler
+
+import asyncio
+from functools import partial
+from typing import List
+
+from loguru import logger
+
+
+class AsyncSmartBot(SmartBot):
+    # same routine as SmartBot, but chats are drained by tasks on one event loop
+
+    def __init__(self, config: Config, acl: ACL) -> None:
+        super().__init__(config, acl)
+        self.asyncMailbox: AsyncMailboxScheduler = AsyncMailboxScheduler(config.system.asyncConcurrency)
+        self.ttsSlots: asyncio.Semaphore = asyncio.Semaphore(config.system.ttsWorkers)
+
+    def createBots(self, config: Config) -> List[AsyncMessageBot]:
+        return [AsyncTgBot(config.telegram, visionTargetSize(config), visionTargetLongSide(config))]
+
+    async def listen(self, bot: AsyncMessageBot) -> None:
+        async for m in bot.getMessages():
+            self.asyncMailbox.submit(m.getChatID(), partial(self.handleMessageAsync, m))
+
+    async def serve(self) -> None:
+        await asyncio.gather(*[self.listen(bot) for bot in self.bots])
+
+    def run(self) -> None:
+        asyncio.run(self.serve())
+
+    async def handleMessageAsync(self, m: AsyncMessage) -> None:
+        try:
+            user = await m.getUser()
+            chat = await m.getChat()
+        except Exception as e:
+            logger.error("failed to look up message {}, {}", m.getID(), str(e))
+            return
+        if user is None or user.getID() is None or chat is None:
+            logger.warn("received empty message, skip it")
+            return
+
+        try:
+            await self.handleAsync(m, user, chat)
+        finally:
+            # after the turn, so its growth counts before the next message comes
+            self.talkFactory.measure(chat.getID())
+
+    async def handleAsync(self, m: AsyncMessage, user, chat) -> None:
+        uid = user.getID()
+        cid = chat.getID()
+
+        media = m.getMedia()
+        texts = media.getText()
+        msgText = None if texts is None or len(texts) == 0 else texts[0]
+        mid = m.getID()
+
+        allowed = self.isAllowed(uid, cid)
+
+        memberCnt = chat.getMemberCount()
+        botUsername = (await chat.getSelf()).getUserName()
+        group = memberCnt > 2
+        addressed = not group or self.isAddressed(m, msgText, botUsername)
+
+        if not addressed and not media.hasVoice():
+            return
+        if media.hasVoice() and not self.shouldTranscribe(group, addressed):
+            return
+
+        if addressed and not allowed:
+            await chat.replyMessage(deniedMessage, mid)
+            logger.info("access denied for user '{}' in chat '{}', message text: {}", uid, cid, msgText)
+            return
+
+        await m.fetchMedia()
+
+        voice = None
+        if media.getVoice() is not None:
+            voice = media.getVoice()[0] # only one voice for now
+
+        photos = []
+        if media.getPhoto() is not None:
+            photos = media.getPhoto()
+
+        if voice is not None:
+            text = await self.s2t.convertAsync(voice)
+        else:
+            text = msgText
+
+        if not addressed and not self.isMentioned(text, botUsername):
+            return
+
+        if not allowed:
+            await chat.replyMessage(deniedMessage, mid)
+            logger.info("access denied for user '{}' in chat '{}', message text: {}", uid, cid, text)
+            return
+
+        logger.info("received question from {}, id {}: {}", user.getUserName(), uid, text)
+
+        talk = self.talkFactory.getTalk(cid)
+
+        if len(photos) > 0:
+            logger.debug("prepare {} images", len(photos))
+            await talk.prepareImagesAsync(photos)
+
+        if text is None or len(text) == 0:
+            logger.debug("no text, skip ask")
+            return
+
+        try:
+            if voice is None and self.streamReply:
+                answer = await chat.replyStream(talk.askStreamAsync(text), mid)
+                logger.debug("received answer for chat {}: {}", cid, answer)
+                logger.info("replied to {}", user.getUserName())
+                return
+
+            answer = await talk.askAsync(text)
+            logger.debug("received answer for chat {}: {}", cid, answer)
+
+            if voice is not None:
+                await chat.quoteMessage(answer, mid, "Transcription:\n" + text)
+                if await self.replySpeechAsync(chat, answer, mid) > 0:
+                    logger.info("voice replied to {}", user.getUserName())
+                else:
+                    logger.error("failed converting to speech: {}", text)
+            else:
+                await chat.replyMessage(answer, mid)
+                logger.info("replied to {}", user.getUserName())
+        except Exception as e:
+            logger.error("exception when replying message to {}, error: {}", user.getUserName(), str(e))
+
+    async def synthesize(self, part: str) -> MediaBuffer:
+        async with self.ttsSlots:
+            return await self.t2s.convertAsync(part)
+
+    async def replySpeechAsync(self, chat: AsyncChat, answer: str, mid: MessageID) -> int:
+        parts = [asyncio.ensure_future(self.synthesize(p)) for p in splitSpeech(answer)]
+        sent = 0
+        for part in parts:
+            try:
+                speech = await part
+            except Exception as e:
+                logger.error("failed to synthesize speech part, {}", str(e))
+                continue
+            if speech is not None:
+                await chat.replyVoice(speech, mid)
+                sent += 1
+        return sent
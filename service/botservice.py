@@ -1,38 +1,59 @@
-from definition import BotService, MessageBot, Message, SpeechToText, TextToSpeech, UserID
-from common import Config, ACL, Defer
-from im.tgchat import TgBot
+from definition import BotService, MessageBot, Message, SpeechToText, TextToSpeech, UserID, Chat, ChatID, MessageID
+from common import Config, ACL
+from im.tgchat import TgBot, isMentionedBy
+from ai.vision import visionTargetSize, visionTargetLongSide
 from ai.talkfact import AITalkFactory
-from ai.common import convertToMp3
 from ai.speech import Wisper, ReadText
+from ai.transcoder import Transcoder
+from ai.speechcache import getSpeechCache
+from ai.resilience import configurePolicies
+
+from service.mailbox import MailboxScheduler
 
 from queue import Queue
-from threading import Thread, Semaphore, Lock
+from threading import Thread
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import List, Dict, Iterable, Tuple
 
 from loguru import logger
 
 
 puncs = [",", ".", "，", "。", "!", "?", "！", "？"]
+# voice answers are synthesized in parts cut after these, the latin ones only when followed by a space
+sentenceEnds = [p for p in puncs if p not in [",", "，"]] + ["\n"]
+speechPartChars = 200 # later parts collect sentences up to about this long, the first is one sentence
+speechMaxChars = 4000 # below the tts input limit
+deniedMessage = "Sorry, this AI assistant is not allowed in this conversation. Please contact the administrator for access."
+voicePolicies = ["always", "reply", "never"]
 
 class SmartBot(BotService):
 
     def __init__(self, config: Config, acl: ACL) -> None:
-        tgBot = TgBot(config.telegram)
+        configurePolicies(config.system)
         talkFact = AITalkFactory(config)
 
         self.botName = config.botName
-        self.bots: List[MessageBot] = [tgBot]
+        self.bots: List[MessageBot] = self.createBots(config)
         self.talkFactory = talkFact
         self.acl: ACL = acl
-        self.s2t: SpeechToText = Wisper(config.openAI.apiKey)
-        self.t2s: TextToSpeech = ReadText(config.openAI.apiKey)
-
-        self.sem = Semaphore(4)
-        self.glock = Lock()
-        self.ulocks: Dict[UserID, Lock] = {}
-        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=8)
+        self.transcoder: Transcoder = Transcoder(config.system.transcodeWorkers, config.system.transcodeTimeout)
+        self.s2t: SpeechToText = Wisper(config.openAI.apiKey, config.openAI.transcodePolicy, config.openAI.trimSilence, self.transcoder,
+                                        config.openAI.transcribeSegment, config.openAI.transcribeOverlap, config.openAI.transcribeWorkers)
+        self.t2s: TextToSpeech = ReadText(config.openAI.apiKey, config.openAI.ttsModel, config.openAI.ttsVoice, getSpeechCache(config.openAI))
+        self.streamReply: bool = config.telegram.streaming
+        self.groupVoicePolicy: str = config.system.groupVoicePolicy
+        if self.groupVoicePolicy not in voicePolicies:
+            raise ValueError("unknown group voice policy: " + self.groupVoicePolicy)
+
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=config.system.workers)
+        self.ttsPool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=config.system.ttsWorkers, thread_name_prefix="tts")
+        # messages of one chat are handled in order and one at a time, they share the chat's talk
+        self.mailbox: MailboxScheduler = MailboxScheduler(self.pool)
         
+    def createBots(self, config: Config) -> List[MessageBot]:
+        return [TgBot(config.telegram, visionTargetSize(config), visionTargetLongSide(config))]
+
     def listenToAll(self) -> Iterable[Message]:
         msgQ: Queue[Message] = Queue()
 
@@ -52,6 +73,8 @@ class SmartBot(BotService):
         return None, None
 
     def isMentioned(self, text: str, botUsername: str) -> bool:
+        if text is None:
+            return False
         tokens = text.split()
         tokens = spliteByPunctuation(tokens)
 
@@ -62,143 +85,160 @@ class SmartBot(BotService):
         
         return listContains(head, self.botName, True)
 
-    def getUserLock(self, uid: UserID) -> Lock:
-        with self.glock:
-            if uid in self.ulocks:
-                return self.ulocks[uid]
-            else:
-                ul = Lock()
-                self.ulocks[uid] = ul
-                return ul
-    
+    def isAllowed(self, uid: UserID, cid: ChatID) -> bool:
+        return self.acl.allowUser(uid) or self.acl.allowChat(cid)
+
+    def isAddressed(self, m: Message, text: str, botUsername: str) -> bool:
+        # cheap checks that need no media: a reply to the bot, an @mention, or the name in the text
+        if m.isReplyToSelf():
+            return True
+        if isMentionedBy(m.getMentions(), botUsername):
+            return True
+        return self.isMentioned(text, botUsername)
+
+    def shouldTranscribe(self, group: bool, addressed: bool) -> bool:
+        if not group or self.groupVoicePolicy == "always":
+            return True
+        if self.groupVoicePolicy == "reply":
+            return addressed
+        return False
+
     def handleMessage(self, m: Message) -> None:
-        with Defer() as defer:
-            if m is None or m.getUser() is None or m.getUser().getID() is None or m.getChat() is None:
-                logger.warn("received empty message, skip it")
-                if m is not None:
-                    logger.debug("message user is {}", m.getUser().getID())
-                    logger.debug("message chat is {}", m.getChat().getID())
-                return
+        if m is None or m.getUser() is None or m.getUser().getID() is None or m.getChat() is None:
+            logger.warn("received empty message, skip it")
+            if m is not None:
+                logger.debug("message user is {}", m.getUser().getID())
+                logger.debug("message chat is {}", m.getChat().getID())
+            return
+    
+        user = m.getUser()
+        uid = user.getID()
+
+        chat = m.getChat()
+        cid = chat.getID()
+        
+        media = m.getMedia()
+        #msgText = None if m.getMedia().getText() is None else m.getMedia().getText()[0]
+        texts = media.getText()
+        if texts is None or len(texts) == 0:
+            msgText = None
+        else:
+            msgText = texts[0]
+        mid = m.getID()
+
+        allowed = self.isAllowed(uid, cid)
+
+        # routine, cheap filters first so that ignored messages never download their media
+        memberCnt = chat.getMemberCount()
+        botUsername = chat.getSelf().getUserName()
+        group = memberCnt > 2
+        addressed = not group or self.isAddressed(m, msgText, botUsername)
+
+        if not addressed and not media.hasVoice():
+            return
+        if media.hasVoice() and not self.shouldTranscribe(group, addressed):
+            return
+
+        if addressed and not allowed:
+            chat.replyMessage(deniedMessage, mid)
+            logger.info("access denied for user '{}' in chat '{}', message text: {}", uid, cid, msgText)
+            return
+
+        voice = None
+        if media.hasVoice():
+            voice = media.getVoice()[0] # only one voice for now
+
+        if voice is not None:
+            # set text to voice content
+            text = self.s2t.convert(voice)
+        else:
+            text = msgText
+        
+        # handle drawing request
+        desc, size = self.isDrawRequest(text)
+        if desc is not None and size is not None:
+            # TODO
+            pass
+            return
         
-            user = m.getUser()
-            uid = user.getID()
-            
-            lock = self.getUserLock(uid)
-            lock.acquire()
-            def unlock(l: Lock):
-                def inner():
-                    l.release()
-                return inner
-            defer(unlock(lock))
-
-            self.sem.acquire()
-            def release(s: Semaphore):
-                def inner():
-                    s.release()
-                return inner
-            defer(release(self.sem))
-
-            chat = m.getChat()
-            cid = chat.getID()
-            
-            voice = None
-            if m.getMedia().getVoice() is not None:
-                for voice, cleanFunc in m.getMedia().getVoice():
-                    defer(cleanFunc)
-                    break # only one voice for now
             
-            photos = []
-            if m.getMedia().getPhoto() is not None:
-                for photo, cleanImageFunc in m.getMedia().getPhoto():
-                    photos.append(photo) # for telegram there will be only one image one message, but we use list anyway
-                    defer(cleanImageFunc)
-
-            #msgText = None if m.getMedia().getText() is None else m.getMedia().getText()[0]
-            texts = m.getMedia().getText()
-            if texts is None or len(texts) == 0:
-                msgText = None
-            else:
-                msgText = m.getMedia().getText()[0]
-            mid = m.getID()
 
-            allowed = self.acl.allowUser(uid)
-            if not allowed:
-                allowed = self.acl.allowChat(cid)
+        if not addressed and not self.isMentioned(text, botUsername):
+            return
 
-            # routine
-            memberCnt = chat.getMemberCount()
-            botUsername = chat.getSelf().getUserName()
+        if not allowed:
+            chat.replyMessage(deniedMessage, mid)
+            logger.info("access denied for user '{}' in chat '{}', message text: {}", uid, cid, text)
+            return
 
-            if not allowed and memberCnt <= 2:
-                chat.replyMessage("Sorry, this AI assistant is not allowed in this conversation."+
-                                " Please contact the administrator for access.", mid)
-                logger.info("access denied for user '{}' in chat '{}', message text: {}", uid, cid, msgText)
-                return
+        photos = []
+        if media.hasPhoto():
+            photos = media.getPhoto() # for telegram there will be only one image one message, but we use list anyway
 
-            if voice is not None:
-                # set text to voice content
-                mp3File, cleanMp3 = convertToMp3(audioFile=voice)
-                defer(cleanMp3)
+        logger.info("received question from {}, id {}: {}", user.getUserName(), uid, text)
+        
+        talk = self.talkFactory.getTalk(cid)
 
-                text = self.s2t.convert(mp3File)
-            else:
-                text = msgText
-            
-            # handle drawing request
-            desc, size = self.isDrawRequest(text)
-            if desc is not None and size is not None:
-                # TODO
-                pass
-                return
-            
-                
+        # handle vision request
+        if len(photos) > 0:
+            logger.debug("prepare {} images", len(photos))
+            talk.prepareImages(photos)
+        
+        if text is None or len(text) == 0:
+            logger.debug("no text, skip ask")
+            return
 
-            if memberCnt > 2 and not self.isMentioned(text, botUsername):
-                return
+        if voice is None and self.streamReply:
+            try:
+                answer = chat.replyStream(talk.askStream(text), mid)
+                logger.debug("received answer for chat {}: {}", cid, answer)
+                logger.info("replied to {}", user.getUserName())
+            except Exception as e:
+                logger.error("exception when streaming reply to {}, error: {}", user.getUserName(), str(e))
+            return
 
-            if not allowed:
-                chat.replyMessage("Sorry, this AI assistant is not allowed in this conversation."+
-                                " Please contact the administrator for access.", mid)
-                logger.info("access denied for user '{}' in chat '{}', message text: {}", uid, cid, text)
-                return
+        answer = talk.ask(text)
+        logger.debug("received answer for chat {}: {}", cid, answer)
 
-            logger.info("received question from {}, id {}: {}", user.getUserName(), uid, text)
-            
-            talk = self.talkFactory.getTalk(cid)
-
-            # handle vision request
-            if len(photos) > 0:
-                logger.debug("prepare {} images", len(photos))
-                talk.prepareImages(photos)
+        try:
+            if voice is not None:
+                chat.quoteMessage(answer, mid, "Transcription:\n" + text)
+                if self.replySpeech(chat, answer, mid) > 0:
+                    logger.info("voice replied to {}", user.getUserName())
+                else:
+                    logger.error("failed converting to speech: {}", text)
+            else:
+                chat.replyMessage(answer, mid)
+                logger.info("replied to {}", user.getUserName())
+        except Exception as e:
+            logger.error("exception when replying message to {}, error: {}", user.getUserName(), str(e))
             
-            if text is None or len(text) == 0:
-                logger.debug("no text, skip ask")
-                return
-
-            answer = talk.ask(text)
-            logger.debug("received answer for chat {}: {}", cid, answer)
 
+    def replySpeech(self, chat: Chat, answer: str, mid: MessageID) -> int:
+        # parts are synthesized in parallel and sent in order as soon as each is ready
+        parts = [self.ttsPool.submit(self.t2s.convert, p) for p in splitSpeech(answer)]
+        sent = 0
+        for part in parts:
             try:
-                if voice is not None:
-                    chat.quoteMessage(answer, mid, "Transcription:\n" + text)
-                    vf, cleanAac = self.t2s.convert(answer)
-                    defer(cleanAac)
-                    if vf is not None and cleanAac is not None:
-                        chat.replyVoice(vf, mid)
-                        logger.info("voice replied to {}", user.getUserName())
-                    else:
-                        logger.error("failed converting to speech: {}", text)
-                else:
-                    chat.replyMessage(answer, mid)
-                    logger.info("replied to {}", user.getUserName())
+                speech = part.result()
             except Exception as e:
-                logger.error("exception when replying message to {}, error: {}", user.getUserName(), str(e))
-                
+                logger.error("failed to synthesize speech part, {}", str(e))
+                continue
+            if speech is not None:
+                chat.replyVoice(speech, mid)
+                sent += 1
+        return sent
 
     def run(self) -> None:
         for m in self.listenToAll():
             #self.handleMessage(m)
-            future = self.pool.submit(self.handleMessage, m)
+            self.mailbox.submit(m.getChatID(), partial(self.handleTurn, m))
+
+    def handleTurn(self, m: Message) -> None:
+        try:
+            self.handleMessage(m)
+        finally:
+            self.talkFactory.measure(m.getChatID())
             
 
 
@@ -227,3 +267,31 @@ def spliteByPunctuation(ss: List[str]) -> List[str]:
     
     return [s for s in ss if s != ""]
 
+
+def splitSentences(text: str) -> List[str]:
+    sentences = []
+    start = 0
+    for i, ch in enumerate(text):
+        if ch not in sentenceEnds:
+            continue
+        # 3.14 or v1.2 is not the end of a sentence
+        if ch in ".!?" and i + 1 < len(text) and not text[i + 1].isspace():
+            continue
+        sentences.append(text[start:i + 1])
+        start = i + 1
+    sentences.append(text[start:])
+    return [s.strip() for s in sentences if len(s.strip()) > 0]
+
+
+def splitSpeech(text: str) -> List[str]:
+    # the first part is the first sentence so that the first voice arrives early
+    parts: List[str] = []
+    for sentence in splitSentences(text):
+        while len(sentence) > speechMaxChars:
+            parts.append(sentence[:speechMaxChars])
+            sentence = sentence[speechMaxChars:]
+        if len(parts) > 1 and len(parts[-1]) < speechPartChars and len(parts[-1]) + len(sentence) < speechMaxChars:
+            parts[-1] += " " + sentence
+        else:
+            parts.append(sentence)
+    return parts
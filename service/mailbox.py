@@ -0,0 +1,91 @@
+from concurrent.futures import Executor
+from collections import deque
+from threading import Lock
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Set
+
+import asyncio
+
+from loguru import logger
+
+
+class MailboxScheduler:
+    # runs jobs of one key in submit order and never two at once,
+    # jobs of different keys share the pool
+
+    def __init__(self, pool: Executor) -> None:
+        self.pool: Executor = pool
+        self.lock: Lock = Lock()
+        # a key has a mailbox only while it has pending jobs, and then exactly one worker owns it
+        self.mailboxes: Dict[Hashable, Deque[Callable[[], None]]] = {}
+
+    def submit(self, key: Hashable, job: Callable[[], None]) -> None:
+        with self.lock:
+            box = self.mailboxes.get(key)
+            if box is not None:
+                box.append(job)
+                return
+            self.mailboxes[key] = deque([job])
+        self.pool.submit(self.drain, key)
+
+    def drain(self, key: Hashable) -> None:
+        with self.lock:
+            job = self.mailboxes[key][0]
+
+        try:
+            job()
+        except Exception as e:
+            logger.exception("job for {} failed, {}", key, str(e))
+
+        with self.lock:
+            box = self.mailboxes[key]
+            box.popleft()
+            if len(box) == 0:
+                del self.mailboxes[key]
+                return
+        # one job per turn, so a busy key goes to the back of the pool queue instead of holding a worker
+        self.pool.submit(self.drain, key)
+
+    def pending(self) -> int:
+        with self.lock:
+            return sum(len(box) for box in self.mailboxes.values())
+
+    def activeKeys(self) -> int:
+        with self.lock:
+            return len(self.mailboxes)
+
+
+class AsyncMailboxScheduler:
+    # asyncio counterpart of MailboxScheduler, concurrency across keys is capped by a semaphore
+
+    def __init__(self, concurrency: int) -> None:
+        self.sem = asyncio.Semaphore(concurrency)
+        self.mailboxes: Dict[Hashable, Deque[Callable[[], Awaitable[None]]]] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    def submit(self, key: Hashable, job: Callable[[], Awaitable[None]]) -> None:
+        box = self.mailboxes.get(key)
+        if box is not None:
+            box.append(job)
+            return
+        self.mailboxes[key] = deque([job])
+        task = asyncio.create_task(self.drain(key))
+        # keep a reference until done, the loop only holds weak ones
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def drain(self, key: Hashable) -> None:
+        box = self.mailboxes[key]
+        while len(box) > 0:
+            try:
+                async with self.sem:
+                    await box[0]()
+            except Exception as e:
+                logger.exception("job for {} failed, {}", key, str(e))
+            box.popleft()
+        del self.mailboxes[key]
+
+    def pending(self) -> int:
+        return sum(len(box) for box in self.mailboxes.values())
+
+    def activeKeys(self) -> int:
+        return len(self.mailboxes)
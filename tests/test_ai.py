@@ -1,11 +1,43 @@
 import unittest
+import asyncio
+import gc
+import io
+import json
+import os
+import struct
+import sys
+import wave
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 
-from definition import ChatID
-from common import getConfig
+from definition import ChatID, MediaBuffer, Talk
+from common import getConfig, GeminiConfig, OpenAIConfig, StoreConfig
 #from im.tgchat import TgBot
 from ai.talkfact import AITalkFactory
+import ai.openaitalk as openaitalk
+import ai.common as aicommon
+from ai.transcoder import Transcoder, level, pcmToWav, silenceWindow, splitPcm, wavToPcm
+from ai.speechcache import SpeechCache
+from ai.speech import ReadText, Wisper, stitchTranscripts
+from ai.vision import ImagePipeline, visionTargetLongSide, visionTargetSize, visionTokens
+from ai.blobs import BlobStore
+from ai.resilience import CallPolicy, CircuitBreaker
+from ai.keypool import KeyPool, KeySlot, TokenBucket
+from ai.failover import FailoverTalk
+import ai.geminiupload as geminiupload
+import ai.geminitalk as geminitalk
+
+import PIL.Image
+from ai.store import SqliteConversationStore
     
+from openai import OpenAI
 import google.ai.generativelanguage as glm
 import google.generativeai as genai
 
@@ -45,5 +77,1004 @@ class TestBot(unittest.TestCase):
 
 
 
+class WordEncoding:
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text: str):
+        self.calls += 1
+        return text.split()
+
+
+class TestOpenAIHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.encoding = WordEncoding()
+        with mock.patch.object(openaitalk, "encoding_for_model", lambda m: self.encoding):
+            self.talk = openaitalk.OpenAITalk("Chloe", OpenAIConfig(apiKey="ut", model="gpt-3.5-turbo", contextTimeout=3600))
+
+    def test_token_count_once_per_entry(self):
+        for i in range(20):
+            before = self.encoding.calls
+            self.talk.prepareNewMessage("one two three")
+            self.talk.appendAnswer("four five")
+            self.assertEqual(self.encoding.calls - before, 2)
+
+        self.assertEqual(len(self.talk.messageQueue), 20)
+        self.assertEqual(self.talk.queueToken, self.talk.greeting.t + 20 * 5)
+
+    def test_trim_oldest_first(self):
+        with mock.patch.object(openaitalk, "maxMessageQueueToken", self.talk.greeting.t + 12):
+            for i in range(5):
+                self.talk.prepareNewMessage(f"q{i} two three")
+                self.talk.appendAnswer("four five")
+
+            # two turns of 5 tokens fit, the third would not
+            self.assertEqual([qa.q for qa in self.talk.messageQueue], ["q3 two three", "q4 two three"])
+            self.assertEqual(self.talk.queueToken, self.talk.greeting.t + 10)
+
+            # a single oversized question is still sent
+            self.talk.prepareNewMessage(" ".join(["word"] * 50))
+            self.assertEqual(len(self.talk.messageQueue), 1)
+
+            messages, hasImage = self.talk.buildMessages()
+            self.assertEqual(messages[0]["role"], "system")
+            self.assertEqual(len(messages), 2)
+            self.assertFalse(hasImage)
+
+
+class FakeTalk(Talk):
+    def __init__(self, size: int = 0):
+        self.size = size
+
+    def ask(self, q: str) -> str:
+        return q
+
+    def prepareImages(self, images=None) -> None:
+        pass
+
+    def getMemoryUsage(self) -> int:
+        return self.size
+
+
+class TestTalkFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.config = getConfig()
+        self.config.system.sessionIdleTimeout = 60
+
+    def test_create_once_under_contention(self):
+        factory = AITalkFactory(self.config)
+        created = []
+
+        def create(cid):
+            created.append(cid)
+            time.sleep(0.05)
+            return FakeTalk()
+
+        factory.createTalk = create
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            talks = list(pool.map(lambda _: factory.getTalk("tg-1"), range(8)))
+
+        self.assertEqual(len(created), 1)
+        self.assertTrue(all(t is talks[0] for t in talks))
+
+    def test_lru_and_byte_cap(self):
+        self.config.system.maxSessions = 3
+        self.config.system.maxSessionBytes = 250
+        factory = AITalkFactory(self.config)
+        factory.createTalk = lambda cid: FakeTalk(100)
+
+        for cid in ["a", "b", "c", "d"]:
+            factory.getTalk(cid)
+        self.assertEqual(list(factory.talks.keys()), ["c", "d"])
+        self.assertLessEqual(factory.totalSize, 250)
+
+    def test_growth_counted_after_turn(self):
+        self.config.system.maxSessionBytes = 250
+        factory = AITalkFactory(self.config)
+        factory.createTalk = lambda cid: FakeTalk(100)
+        factory.getTalk("a")
+        talk = factory.getTalk("b")
+        self.assertEqual(factory.totalSize, 200)
+
+        talk.size = 180 # the turn grew it
+        factory.measure("b")
+        self.assertEqual(list(factory.talks.keys()), ["b"])
+        self.assertEqual(factory.totalSize, 180)
+
+    def test_idle_timeout(self):
+        self.config.system.sessionIdleTimeout = 0.05
+        factory = AITalkFactory(self.config)
+        factory.createTalk = lambda cid: FakeTalk()
+
+        first = factory.getTalk("a")
+        self.assertIs(factory.getTalk("a"), first)
+        time.sleep(0.06)
+        self.assertIsNot(factory.getTalk("a"), first)
+        self.assertEqual(factory.sessionCount(), 1)
+
+
+class TestConversationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = StoreConfig(backend="sqlite", path=os.path.join(self.dir.name, "chloe.db"), flushInterval=0.01)
+        self.encoding = WordEncoding()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def newTalk(self, store):
+        with mock.patch.object(openaitalk, "encoding_for_model", lambda m: self.encoding):
+            return openaitalk.OpenAITalk("Chloe", OpenAIConfig(apiKey="ut", model="gpt-3.5-turbo", contextTimeout=3600), store, "tg-1")
+
+    def test_restore_after_restart(self):
+        store = SqliteConversationStore(self.config)
+        talk = self.newTalk(store)
+        talk.prepareNewImageMessage(MediaBuffer("cat.jpg", b"not really a jpeg"))
+        talk.prepareNewMessage("what is this")
+        talk.answered("a cat")
+        talk.prepareNewMessage("and its name")
+        talk.answered("Tom")
+        store.close()
+
+        store = SqliteConversationStore(self.config)
+        restored = self.newTalk(store)
+        self.assertEqual(len(restored.messageQueue), 0) # lazy until the first message
+        restored.prepareNewMessage("thanks")
+
+        self.assertEqual([(qa.q, qa.a) for qa in restored.messageQueue],
+                         [(None, None), ("what is this", "a cat"), ("and its name", "Tom"), ("thanks", None)])
+        self.assertEqual(restored.messageQueue[0].p.dataUrl(), talk.messageQueue[0].p.dataUrl())
+        self.assertEqual(restored.queueToken, talk.queueToken + 1)
+
+        # the image is stored once, as a blob the turn refers to
+        turns = store.load("tg-1", 0)
+        self.assertTrue(turns[0].images[0].startswith("sha256:"))
+        store.close()
+
+    def test_slow_restore_does_not_block_other_chats(self):
+        loading = threading.Event()
+        release = threading.Event()
+        class SlowStore:
+            def load(self, cid, since):
+                loading.set()
+                release.wait(5)
+                return []
+            def append(self, cid, turn):
+                pass
+
+        restoring = self.newTalk(SlowStore())
+        other = self.newTalk(None)
+        async def completeAsync(args):
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="hello"))])
+        restoring.completeAsync = other.completeAsync = completeAsync
+
+        async def run():
+            start = time.monotonic()
+            task = asyncio.create_task(restoring.askAsync("hi"))
+            while not loading.is_set():
+                await asyncio.sleep(0.01)
+            # answered while the first chat still waits for its history
+            self.assertEqual(await other.askAsync("hi"), "hello")
+            self.assertLess(time.monotonic() - start, 1)
+            release.set()
+            self.assertEqual(await task, "hello")
+        asyncio.run(run())
+
+
+class FakeTranscoder:
+    def __init__(self):
+        self.commands = []
+
+    def run(self, command, input=None, timeout=None):
+        self.commands.append(command)
+        return b"converted"
+
+    async def runAsync(self, command, input=None, timeout=None):
+        self.commands.append(command)
+        return b"converted async"
+
+
+class TestTranscodePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.transcoder = FakeTranscoder()
+        self.commands = self.transcoder.commands
+
+    def prepare(self, audio, policy, trimSilence=False):
+        return aicommon.prepareForTranscription(audio, policy, trimSilence, self.transcoder)
+
+    def test_accepted_format_passes_through(self):
+        voice = MediaBuffer("voice/file_1.oga", b"opus")
+        self.assertIs(self.prepare(voice, "auto"), voice)
+        self.assertEqual(self.commands, [])
+
+    def test_other_formats_go_to_16k_mono(self):
+        audio = MediaBuffer("audio/file_2.amr", b"amr")
+        slim = self.prepare(audio, "auto")
+        self.assertEqual(slim.name, "audio/file_2.ogg")
+        self.assertEqual(slim.getValue(), b"converted")
+        self.assertIn("16000", self.commands[0])
+        self.assertIn("pipe:0", self.commands[0])
+        self.assertNotIn("-af", self.commands[0])
+
+        # trimming needs a decode, so even accepted formats are transcoded
+        self.prepare(MediaBuffer("voice.oga", b"opus"), "auto", trimSilence=True)
+        self.assertIn(aicommon.trimFilter, self.commands[1])
+
+    def test_async_awaits_the_transcoder(self):
+        audio = MediaBuffer("audio/file_2.amr", b"amr")
+        slim = asyncio.run(aicommon.prepareForTranscriptionAsync(audio, "auto", False, self.transcoder))
+        self.assertEqual(slim.getValue(), b"converted async")
+        self.assertIn("16000", self.commands[0])
+        voice = MediaBuffer("voice/file_1.oga", b"opus")
+        self.assertIs(asyncio.run(aicommon.prepareForTranscriptionAsync(voice, "auto", False, self.transcoder)), voice)
+
+    def test_mp3_policy(self):
+        mp3 = self.prepare(MediaBuffer("voice.oga", b"opus"), "mp3")
+        self.assertEqual(mp3.name, "voice.mp3")
+        self.assertIn("192k", self.commands[0])
+
+    def test_wav_converted_in_process(self):
+        tone = b"".join(struct.pack("<hh", v, v) for v in [8000, -8000] * 22050)
+        silence = b"\x00" * 4 * 22050
+        out = io.BytesIO()
+        with wave.open(out, "wb") as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(silence + tone + silence)
+
+        wav = self.prepare(MediaBuffer("memo.wav", out.getvalue()), "slim", trimSilence=True)
+        self.assertEqual(self.commands, [])
+        with wave.open(wav.reader(), "rb") as w:
+            self.assertEqual((w.getnchannels(), w.getsampwidth(), w.getframerate()), (1, 2, 16000))
+            # one second of tone is left, give or take a window
+            self.assertAlmostEqual(w.getnframes() / 16000, 1.0, delta=0.05)
+
+    def test_silent_wav_not_transcribed(self):
+        silence = MediaBuffer("memo.wav", pcmToWav(b"\x00" * 32000))
+        self.assertIsNone(self.prepare(silence, "slim", trimSilence=True))
+        self.assertIsNone(asyncio.run(aicommon.prepareForTranscriptionAsync(silence, "slim", True, self.transcoder)))
+        self.assertEqual(self.commands, [])
+
+        whisper = Wisper("test", trimSilence=True)
+        whisper.transcribe = mock.Mock(return_value="")
+        self.assertIsNone(whisper.convert(silence))
+        whisper.transcribe.assert_not_called()
+
+
+class TestTranscoder(unittest.TestCase):
+
+    def test_pipes_and_metrics(self):
+        transcoder = Transcoder(workers=2, timeout=10)
+        upper = [sys.executable, "-c", "import sys; sys.stdout.buffer.write(sys.stdin.buffer.read().upper())"]
+        self.assertEqual(transcoder.run(upper, b"voice"), b"VOICE")
+        self.assertEqual(asyncio.run(transcoder.runAsync(upper, b"async")), b"ASYNC")
+        self.assertEqual(transcoder.stats.get("transcode.run.count"), 2)
+        self.assertEqual(transcoder.stats.get("transcode.queued"), 0)
+        self.assertEqual(transcoder.stats.get("transcode.running"), 0)
+
+    def test_kill_on_timeout(self):
+        transcoder = Transcoder(workers=1, timeout=10)
+        start = time.monotonic()
+        self.assertIsNone(transcoder.run([sys.executable, "-c", "import time; time.sleep(30)"], timeout=0.5))
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(transcoder.stats.get("transcode.timeout"), 1)
+
+    def test_missing_binary(self):
+        transcoder = Transcoder(workers=1)
+        self.assertIsNone(transcoder.run(["no-such-transcoder-binary"]))
+        self.assertEqual(transcoder.stats.get("transcode.failed"), 1)
+
+
+def wordTone(k, seconds):
+    # square wave whose level names the word
+    amplitude = (k + 1) * 2000
+    return struct.pack("<hh", amplitude, -amplitude) * int(16000 * seconds / 2)
+
+
+def hearWords(audio):
+    # fake transcription, one word per run of tone
+    pcm = wavToPcm(audio)
+    step = silenceWindow * 2
+    words = []
+    previous = None
+    for i in range(0, len(pcm), step):
+        l = level(pcm[i:i + step])
+        word = f"w{round(l / 2000) - 1}" if l > 1000 else None
+        if word is not None and word != previous:
+            words.append(word)
+        previous = word
+    return " ".join(words)
+
+
+class TestChunkedTranscription(unittest.TestCase):
+
+    def setUp(self):
+        # 12 words of 0.4 s tone and 0.1 s pause
+        self.pcm = b"".join(wordTone(k, 0.4) + b"\x00" * 3200 for k in range(12))
+        self.words = " ".join(f"w{k}" for k in range(12))
+
+    def test_cuts_in_pauses_and_overlaps(self):
+        ranges = splitPcm(self.pcm, 2, 0.3)
+        self.assertGreater(len(ranges), 2)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(self.pcm))
+        overlap = int(0.3 * 32000)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            cut = start + overlap
+            self.assertEqual(end - cut, overlap)
+            self.assertEqual(level(self.pcm[cut:cut + silenceWindow * 2]), 0)
+
+    def test_tiny_segments_move_on(self):
+        ranges = splitPcm(self.pcm[:32000], 0.001, 0)
+        step = silenceWindow * 2
+        self.assertEqual(len(ranges), 32000 // step)
+        self.assertEqual(ranges[0], (0, step))
+        self.assertEqual(ranges[-1][1], 32000)
+
+    def test_segments_transcribed_concurrently_and_stitched(self):
+        whisper = Wisper("test", segmentSeconds=2, overlapSeconds=0.3, workers=3)
+        calls = []
+        def transcribe(audio):
+            calls.append(threading.current_thread().name)
+            return hearWords(audio)
+        whisper.transcribe = transcribe
+
+        audio = MediaBuffer("voice.wav", pcmToWav(self.pcm))
+        audio.duration = 6
+        self.assertEqual(whisper.convert(audio), self.words)
+        self.assertGreater(len(calls), 2)
+        self.assertTrue(all(name.startswith("whisper") for name in calls))
+
+        async def transcribeAsync(audio):
+            return hearWords(audio)
+        whisper.transcribeAsync = transcribeAsync
+        self.assertEqual(asyncio.run(whisper.convertAsync(audio)), self.words)
+
+    def test_async_segments_decoded_without_blocking_a_thread(self):
+        class PcmTranscoder:
+            def run(self, command, input=None, timeout=None):
+                raise AssertionError("the async path must not wait on the pool")
+
+        pcm = self.pcm
+        async def runAsync(command, input=None, timeout=None):
+            return pcm
+        transcoder = PcmTranscoder()
+        transcoder.runAsync = runAsync
+
+        whisper = Wisper("test", transcoder=transcoder, segmentSeconds=2, overlapSeconds=0.3)
+        async def transcribeAsync(audio):
+            return hearWords(audio)
+        whisper.transcribeAsync = transcribeAsync
+        audio = MediaBuffer("voice.oga", b"opus")
+        audio.duration = 6
+        self.assertEqual(asyncio.run(whisper.convertAsync(audio)), self.words)
+
+    def test_short_voice_is_one_request(self):
+        whisper = Wisper("test", segmentSeconds=120)
+        whisper.transcribe = mock.Mock(return_value="hello")
+        voice = MediaBuffer("voice/file_1.oga", b"opus")
+        voice.duration = 5
+        self.assertEqual(whisper.convert(voice), "hello")
+        whisper.transcribe.assert_called_once_with(voice)
+
+    def test_stitch(self):
+        self.assertEqual(stitchTranscripts(["one two three", "Three, four five", None, "five six"]), "one two three four five six")
+        self.assertEqual(stitchTranscripts(["a b", "c d"]), "a b c d")
+        self.assertIsNone(stitchTranscripts([None, None]))
+        self.assertEqual(stitchTranscripts([None, ""]), "")
+
+        whisper = Wisper("test", segmentSeconds=2, overlapSeconds=0.3)
+        whisper.transcribe = mock.Mock(return_value=None)
+        audio = MediaBuffer("voice.wav", pcmToWav(self.pcm))
+        audio.duration = 6
+        self.assertIsNone(whisper.convert(audio))
+
+
+def pictureOf(width, height, format="PNG"):
+    out = io.BytesIO()
+    PIL.Image.new("RGB", (width, height), (200, 120, 40)).save(out, format=format)
+    return out.getvalue()
+
+
+class TestImagePipeline(unittest.TestCase):
+
+    def test_tile_tokens(self):
+        self.assertEqual(visionTokens(1024, 1024), 765) # 768 square, 2x2 tiles
+        self.assertEqual(visionTokens(2048, 4096), 1105) # 768x1536, 2x3 tiles
+        self.assertEqual(visionTokens(300, 200), 255) # one tile, never scaled up
+        self.assertEqual(visionTokens(4000, 3000, "low"), 85)
+
+    def test_photo_target(self):
+        def configOf(detail, size=0, useGemini=False):
+            return SimpleNamespace(openAI=OpenAIConfig(apiKey="test", model="gpt", visionDetail=detail, visionTargetSize=size),
+                                   gemini=GeminiConfig(apiKey="test"), system=SimpleNamespace(useGemini=useGemini))
+        low = configOf("low")
+        self.assertEqual((visionTargetSize(low), visionTargetLongSide(low)), (512, True))
+        high = configOf("high")
+        self.assertEqual((visionTargetSize(high), visionTargetLongSide(high)), (768, False))
+        # an explicit size is a short side
+        self.assertFalse(visionTargetLongSide(configOf("low", 600)))
+        self.assertFalse(visionTargetLongSide(configOf("low", useGemini=True)))
+
+    def test_resize_reencode_and_cache(self):
+        images = ImagePipeline(format="webp", quality=70)
+        photo = MediaBuffer("photo.png", pictureOf(4000, 3000))
+        prepared = images.prepare(photo)
+        self.assertEqual((prepared.width, prepared.height), (1024, 768))
+        self.assertEqual(prepared.tokens, 765)
+        self.assertEqual(prepared.mime, "image/webp")
+        with PIL.Image.open(io.BytesIO(prepared.data)) as img:
+            self.assertEqual((img.format, img.size), ("WEBP", (1024, 768)))
+
+        self.assertIs(images.prepare(MediaBuffer("again.png", photo.getValue())), prepared)
+        self.assertEqual(images.stats.get("vision.hit"), 1)
+        self.assertEqual(images.stats.get("vision.miss"), 1)
+
+    def test_small_jpeg_kept(self):
+        data = pictureOf(320, 240, "JPEG")
+        prepared = ImagePipeline(quality=95).prepare(MediaBuffer("small.jpg", data))
+        self.assertEqual((prepared.width, prepared.height, prepared.tokens), (320, 240, 255))
+        self.assertLessEqual(len(prepared.data), len(data))
+
+    def test_unreadable_sent_as_is(self):
+        prepared = ImagePipeline().prepare(MediaBuffer("cat.jpg", b"not really a jpeg"))
+        self.assertEqual(prepared.data, b"not really a jpeg")
+        self.assertEqual(prepared.tokens, 765)
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_shared_once_and_released_with_last_reference(self):
+        blobs = BlobStore(memoryBytes=1024)
+        handles = [blobs.put(b"meme", "image/jpeg") for _ in range(20)]
+        self.assertEqual(blobs.memorySize, 4)
+        self.assertEqual(blobs.stats.get("blob.shared"), 19)
+        self.assertEqual(handles[0].dataUrl(), "data:image/jpeg;base64,bWVtZQ==")
+
+        for h in handles[:-1]:
+            h.release()
+        key = handles[-1].key
+        self.assertEqual(blobs.get(key), b"meme")
+        del handles
+        # collected handles are released with the next store call
+        self.assertIsNone(blobs.get(key))
+        self.assertEqual(len(blobs.refs), 0)
+        self.assertEqual(blobs.memorySize, 0)
+
+    def test_collected_under_lock(self):
+        blobs = BlobStore(memoryBytes=1024)
+
+        class Owner:
+            pass
+        owner = Owner()
+        owner.me = owner # only the cyclic collector frees it
+        owner.picture = blobs.put(b"meme", "image/jpeg")
+        key = owner.picture.key
+        del owner
+
+        def collectInside():
+            with blobs.lock:
+                gc.collect()
+        worker = threading.Thread(target=collectInside, daemon=True)
+        worker.start()
+        worker.join(timeout=5)
+        self.assertFalse(worker.is_alive())
+        self.assertIsNone(blobs.get(key))
+        self.assertEqual(blobs.memorySize, 0)
+
+    def test_spill_and_promote(self):
+        blobs = BlobStore(memoryBytes=8, diskBytes=8, path=self.dir.name)
+        a = blobs.put(b"aaaa", "image/jpeg")
+        b = blobs.put(b"bbbb", "image/jpeg")
+        c = blobs.put(b"cccc", "image/jpeg") # a is spilled
+        self.assertEqual(list(blobs.disk), [a.key])
+        self.assertEqual(os.listdir(self.dir.name), [a.key])
+
+        self.assertEqual(a.getValue(), b"aaaa") # promoted, b is spilled
+        self.assertEqual(list(blobs.disk), [b.key])
+        b.release()
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+        # memory is over its cap rather than lose a referenced blob
+        d = blobs.put(b"dddd", "image/jpeg")
+        e = blobs.put(b"eeee", "image/jpeg")
+        f = blobs.put(b"ffff", "image/jpeg")
+        self.assertEqual(blobs.diskSize, 8)
+        self.assertEqual(blobs.memorySize, 12)
+        self.assertEqual([h.getValue() for h in (c, a, d, e, f)], [b"cccc", b"aaaa", b"dddd", b"eeee", b"ffff"])
+
+    def test_talk_releases_trimmed_pictures(self):
+        blobs = BlobStore(memoryBytes=1 << 20)
+        with mock.patch.object(openaitalk, "encoding_for_model", lambda m: WordEncoding()):
+            talk = openaitalk.OpenAITalk("Chloe", OpenAIConfig(apiKey="ut", model="gpt-3.5-turbo"), blobs=blobs)
+        talk.prepareNewImageMessage(MediaBuffer("cat.png", pictureOf(64, 64)))
+        self.assertEqual(len(blobs.refs), 1)
+        messages, hasImage = talk.buildMessages()
+        self.assertTrue(hasImage)
+        self.assertTrue(messages[-1]["content"][0]["image_url"]["url"].startswith("data:image/jpeg;base64,"))
+
+        talk.appendHistoryMessage(openaitalk.QA(q="new topic", t=2), True)
+        self.assertEqual(len(blobs.refs), 0)
+
+
+class FakeFileService:
+    # uploaded files are processing for two polls, then active
+    def __init__(self, expires=None):
+        self.expires = expires
+        self.uploads = 0
+        self.polls = {}
+        self.lock = threading.Lock()
+        self.concurrent = 0
+        self.peak = 0
+
+    def file(self, name, state):
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), expiration_time=self.expires)
+
+    def upload_file(self, path, mime_type, display_name):
+        with self.lock:
+            self.uploads += 1
+            self.concurrent += 1
+            self.peak = max(self.peak, self.concurrent)
+        time.sleep(0.1)
+        with self.lock:
+            self.concurrent -= 1
+        return self.file("files/" + display_name, "PROCESSING")
+
+    def get_file(self, name):
+        with self.lock:
+            self.polls[name] = self.polls.get(name, 0) + 1
+            return self.file(name, "ACTIVE" if self.polls[name] >= 2 else "PROCESSING")
+
+
+class TestGeminiUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeFileService()
+        patcher = mock.patch.multiple(geminiupload.genai, upload_file=self.service.upload_file, get_file=self.service.get_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parallel_upload_and_reuse(self):
+        uploads = geminiupload.GeminiUploads(workers=4, timeout=10)
+        photos = [MediaBuffer(f"p{i}.jpg", bytes([i])) for i in range(4)]
+        start = time.monotonic()
+        files = uploads.upload(photos + [MediaBuffer("again.jpg", bytes([0]))])
+        # four uploads at once, polled after 0.25 and 0.5 s rather than 2 s each
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(self.service.peak, 4)
+        self.assertEqual([f.name for f in files], ["files/p0.jpg", "files/p1.jpg", "files/p2.jpg", "files/p3.jpg", "files/p0.jpg"])
+        self.assertEqual(self.service.uploads, 4)
+
+        uploads.upload([MediaBuffer("forwarded.jpg", bytes([2]))])
+        self.assertEqual(self.service.uploads, 4)
+        self.assertEqual(uploads.stats.get("upload.reused"), 1)
+
+    def test_expiring_file_uploaded_again(self):
+        self.service.expires = datetime.now(timezone.utc) + timedelta(seconds=60)
+        uploads = geminiupload.GeminiUploads(timeout=10, keep=600)
+        uploads.upload([MediaBuffer("a.jpg", b"a")])
+        uploads.upload([MediaBuffer("a.jpg", b"a")])
+        self.assertEqual(self.service.uploads, 2)
+
+    def test_deadline(self):
+        self.service.get_file = lambda name: self.service.file(name, "PROCESSING")
+        uploads = geminiupload.GeminiUploads(timeout=0.5)
+        with mock.patch.object(geminiupload.genai, "get_file", self.service.get_file):
+            self.assertEqual(uploads.upload([MediaBuffer("slow.jpg", b"slow")]), [])
+        self.assertEqual(uploads.stats.get("upload.timeout"), 1)
+        self.assertEqual(uploads.files, {})
+
+
+class TestGeminiContext(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(geminitalk, "tokenScale", geminitalk.TokenScale())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.talk = geminitalk.GeminiTalk("Chloe", GeminiConfig(apiKey="ut", maxContextTokens=100), uploads=object())
+        self.greeting = list(self.talk.pendingContent)
+
+    def turn(self, i):
+        self.talk.beginTurn(f"question {i} " + "x" * 80) # 24 tokens
+        self.talk.endTurn(f"answer {i}")
+
+    def test_oldest_turns_dropped_greeting_kept(self):
+        for i in range(10):
+            self.turn(i)
+        content = self.talk.pendingContent
+        self.assertEqual(content[:2], self.greeting)
+        self.assertEqual(content[2]['role'], 'user')
+        self.assertEqual(content[-1]['parts'], ['answer 9'])
+        self.assertLessEqual(self.talk.contextTokens, 100)
+        self.assertEqual(self.talk.contextTokens, sum(geminitalk.estimateTokens(c) for c in content))
+
+        # expired context starts over from the greeting
+        self.talk.expireContext()
+        self.assertEqual(self.talk.pendingContent, self.greeting)
+
+    def test_calibrated_by_reported_usage(self):
+        self.turn(0)
+        kept = len(self.talk.pendingContent)
+        reported = SimpleNamespace(usage_metadata=SimpleNamespace(prompt_token_count=self.talk.contextTokens * 2))
+        self.talk.calibrate(reported)
+        self.assertAlmostEqual(geminitalk.tokenScale.get(), 2.0)
+        for i in range(1, 10):
+            self.turn(i)
+        self.assertLessEqual(self.talk.contextTokens * 2, 100)
+        self.assertLess(len(self.talk.pendingContent), kept + 2)
+
+
+class FakeGeminiModel:
+    def __init__(self, model_name="models/gemini-1.5-flash-001"):
+        self.model_name = model_name
+        self.requests = []
+
+    def generate_content(self, contents, request_options=None):
+        self.requests.append(list(contents))
+        return SimpleNamespace(text="answer " + "y" * 80, resolve=lambda: None, usage_metadata=None)
+
+
+class FakeCachedContent:
+    created = []
+
+    def __init__(self, contents, ttl):
+        self.name = f"cachedContents/{len(FakeCachedContent.created)}"
+        self.contents = contents
+        self.ttl = ttl
+        self.deleted = False
+
+    @classmethod
+    def create(cls, model, contents, ttl):
+        cache = cls(list(contents), ttl)
+        cls.created.append(cache)
+        return cache
+
+    def update(self, ttl):
+        self.ttl = ttl
+
+    def delete(self):
+        self.deleted = True
+
+
+class TestGeminiContextCache(unittest.TestCase):
+
+    def setUp(self):
+        FakeCachedContent.created = []
+        self.cachedModel = FakeGeminiModel()
+        for patcher in [mock.patch.object(geminitalk, "tokenScale", geminitalk.TokenScale()),
+                        mock.patch.object(geminitalk.caching, "CachedContent", FakeCachedContent),
+                        mock.patch.object(geminitalk.genai.GenerativeModel, "from_cached_content", lambda **kw: self.cachedModel)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.talk = geminitalk.GeminiTalk("Chloe", GeminiConfig(apiKey="ut", contextTimeout=600, maxContextTokens=120, contextCacheTokens=50), uploads=object())
+        self.talk.model = FakeGeminiModel()
+
+    def test_prefix_cached_and_rolled_over(self):
+        self.talk.ask("first " + "x" * 80)
+        self.assertEqual(FakeCachedContent.created, []) # greeting alone is too small
+
+        self.talk.ask("second " + "x" * 80)
+        cache = FakeCachedContent.created[0]
+        self.assertEqual(len(cache.contents), 4) # greeting and the first turn
+        self.assertEqual(cache.ttl, timedelta(seconds=600))
+        # only the new question is sent on top of the cache
+        self.assertEqual(self.cachedModel.requests[-1], [{'role': 'user', 'parts': ["second " + "x" * 80]}])
+
+        # history over budget drops a cache's worth of the oldest turns, the cache holding them goes as well
+        self.talk.ask("third " + "x" * 80)
+        self.assertTrue(cache.deleted)
+        self.assertIsNone(self.talk.cache)
+        self.assertLessEqual(self.talk.contextTokens, 120 - 50 + 22)
+        self.talk.ask("fourth " + "x" * 80)
+        self.assertEqual(len(FakeCachedContent.created), 2)
+        self.assertEqual(FakeCachedContent.created[1].contents[:2], self.talk.greeting)
+
+        self.talk.expireContext()
+        self.assertTrue(FakeCachedContent.created[1].deleted)
+        self.assertIsNone(self.talk.cache)
+
+    def test_steady_state_reuses_cache(self):
+        talk = geminitalk.GeminiTalk("Chloe", GeminiConfig(apiKey="ut", maxContextTokens=400, contextCacheTokens=100), uploads=object())
+        talk.model = FakeGeminiModel()
+        for i in range(30):
+            talk.ask(f"question {i} " + "x" * 80)
+            # the request fits, the answer is trimmed with the next question
+            self.assertLessEqual(talk.contextTokens - talk.contentTokens[-1], 400)
+        # the budget is full from the ninth turn on, a trim drops a cache's worth so most turns reuse the cache
+        self.assertLessEqual(len(FakeCachedContent.created), 10)
+        self.assertEqual(sum(not c.deleted for c in FakeCachedContent.created), 1)
+
+    def test_cache_must_fit_the_budget(self):
+        with self.assertRaises(ValueError):
+            GeminiConfig(apiKey="ut", maxContextTokens=8192, contextCacheTokens=32768)
+
+    def test_failed_cache_falls_back(self):
+        def fail(**kw):
+            raise Exception("model does not support caching")
+        with mock.patch.object(FakeCachedContent, "create", fail):
+            self.talk.ask("first " + "x" * 80)
+            self.talk.ask("second " + "x" * 80)
+        self.assertEqual(self.talk.cacheTokens, 0)
+        self.assertEqual(len(self.talk.model.requests[-1]), 5)
+
+
+class FakeProvider:
+    # local http server answering with scripted responses, the last one repeats
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = []
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                provider.requests.append((time.monotonic(), self.path, self.headers.get("Authorization")))
+                status, headers, body = provider.script[0] if len(provider.script) == 1 else provider.script.pop(0)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def completion(text):
+    return (200, {}, {"id": "c", "object": "chat.completion", "created": 0, "model": "gpt-3.5-turbo",
+                      "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]})
+
+
+unavailable = (503, {}, {"error": {"message": "overloaded"}})
+
+
+class TestResilience(unittest.TestCase):
+
+    def serve(self, script):
+        provider = FakeProvider(script)
+        self.addCleanup(provider.close)
+        return provider
+
+    def keysOf(self, provider, *keys, rpm=500):
+        return KeyPool([KeySlot(k, OpenAI(api_key=k, base_url=provider.url, max_retries=0), None) for k in keys or ["ut"]], rpm=rpm)
+
+    def newTalk(self, provider, policy, keys=None):
+        with mock.patch.object(openaitalk, "encoding_for_model", lambda m: WordEncoding()):
+            talk = openaitalk.OpenAITalk("Chloe", OpenAIConfig(apiKey="ut", model="gpt-3.5-turbo"), keys=keys or self.keysOf(provider))
+        talk.policy = policy
+        return talk
+
+    def test_backoff_and_retry_after(self):
+        provider = self.serve([(429, {"retry-after-ms": "300"}, {"error": {"message": "slow down"}}), unavailable, completion("hello")])
+        talk = self.newTalk(provider, CallPolicy("openai", attempts=3, baseDelay=0.01))
+        self.assertEqual(talk.ask("hi"), "hello")
+        self.assertEqual(len(provider.requests), 3)
+        self.assertGreaterEqual(provider.requests[1][0] - provider.requests[0][0], 0.3)
+        self.assertEqual(talk.policy.stats.get("openai.retry"), 2)
+
+    def test_client_error_not_retried(self):
+        provider = self.serve([(400, {}, {"error": {"message": "bad request"}})])
+        talk = self.newTalk(provider, CallPolicy("openai", attempts=3, baseDelay=0.01))
+        self.assertEqual(talk.ask("hi"), openaitalk.apologyMessage)
+        self.assertEqual(len(provider.requests), 1)
+        self.assertFalse(talk.policy.breaker.isOpen())
+
+    def test_deadline(self):
+        provider = self.serve([(429, {"retry-after": "5"}, {"error": {"message": "slow down"}}), completion("late")])
+        talk = self.newTalk(provider, CallPolicy("openai", attempts=3, deadline=1))
+        start = time.monotonic()
+        self.assertEqual(talk.ask("hi"), openaitalk.apologyMessage)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(talk.policy.stats.get("openai.deadline"), 1)
+
+    def test_breaker_fails_fast_then_probes(self):
+        provider = self.serve([unavailable])
+        policy = CallPolicy("openai", attempts=2, baseDelay=0.01, breaker=CircuitBreaker("openai", threshold=4, reset=0.3))
+        talk = self.newTalk(provider, policy)
+        talk.ask("one")
+        talk.ask("two")
+        self.assertTrue(policy.breaker.isOpen())
+        self.assertEqual(len(provider.requests), 4)
+
+        self.assertEqual(talk.ask("three"), openaitalk.apologyMessage)
+        self.assertEqual(len(provider.requests), 4)
+        self.assertEqual(policy.stats.get("openai.rejected"), 1)
+
+        time.sleep(0.35)
+        provider.script = [completion("back")]
+        self.assertEqual(talk.ask("four"), "back")
+        self.assertFalse(policy.breaker.isOpen())
+
+    def test_streamed_probe_breaking_off_closes_breaker(self):
+        provider = self.serve([unavailable])
+        policy = CallPolicy("openai", attempts=1, breaker=CircuitBreaker("openai", threshold=1, reset=0.1))
+        talk = self.newTalk(provider, policy)
+        talk.ask("one")
+        self.assertTrue(policy.breaker.isOpen())
+        time.sleep(0.15)
+
+        def brokenStream(args):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="part"))])
+            raise ConnectionError("connection reset")
+        talk.complete = brokenStream
+        self.assertEqual("".join(talk.askStream("two")), "part")
+        self.assertFalse(policy.breaker.isOpen())
+        self.assertFalse(policy.breaker.probing)
+
+    def test_unreported_probe_is_released(self):
+        breaker = CircuitBreaker("openai", threshold=1, reset=0.1)
+        policy = CallPolicy("openai", attempts=2, breaker=breaker)
+        breaker.failure()
+        time.sleep(0.15)
+
+        # the caller goes away between check and report, a closed stream or a cancelled task
+        attempts = policy.attempts()
+        attempt = next(attempts)
+        self.assertTrue(attempt.probe)
+        attempts.close()
+        self.assertFalse(breaker.probing)
+        self.assertTrue(policy.check())
+
+        # a probe nobody releases is given up after reset
+        time.sleep(0.15)
+        self.assertTrue(policy.check())
+
+    def test_least_loaded_key(self):
+        provider = self.serve([completion("hello")])
+        keys = self.keysOf(provider, "k0", "k1", rpm=10)
+        first = keys.acquire(10)
+        second = keys.acquire(10)
+        self.assertNotEqual(first.name, second.name) # the busy key is avoided
+
+        keys.release(first, {"x-ratelimit-limit-requests": "10", "x-ratelimit-remaining-requests": "0",
+                             "x-ratelimit-reset-requests": "6s"})
+        keys.release(second)
+        self.assertEqual(keys.acquire(10).name, second.name)
+        self.assertAlmostEqual(first.requests.waitFor(1), 0.6, delta=0.05)
+
+    def test_exhausted_keys(self):
+        bucket = TokenBucket(2, period=1)
+        self.assertTrue(bucket.canTake(5, time.monotonic())) # bigger than the bucket goes through once full
+        provider = self.serve([completion("hello")])
+        keys = self.keysOf(provider, "k0", rpm=1)
+        keys.acquire(1)
+        with self.assertRaises(Exception) as ctx:
+            keys.acquire(1)
+        self.assertGreater(ctx.exception.wait, 0)
+        self.assertFalse(keys.available())
+
+    def test_limited_key_retried_on_another(self):
+        provider = self.serve([(429, {"retry-after": "5"}, {"error": {"message": "slow down"}}), completion("hello")])
+        talk = self.newTalk(provider, CallPolicy("openai", attempts=3, deadline=1), self.keysOf(provider, "k0", "k1"))
+        start = time.monotonic()
+        self.assertEqual(talk.ask("hi"), "hello")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertNotEqual(provider.requests[0][2], provider.requests[1][2])
+        self.assertGreater(talk.keys.slots[0].coolUntil, time.monotonic())
+        self.assertTrue(talk.keys.available())
+
+    def test_server_error_waits_with_a_free_key(self):
+        provider = self.serve([unavailable, unavailable, completion("hello")])
+        talk = self.newTalk(provider, CallPolicy("openai", attempts=3, baseDelay=0.2))
+        # the key has room, a 5xx still backs off (jitter pinned to its upper bound)
+        with mock.patch("ai.resilience.random.uniform", lambda lo, hi: hi):
+            self.assertEqual(talk.ask("hi"), "hello")
+        self.assertEqual(len(provider.requests), 3)
+        self.assertGreaterEqual(provider.requests[1][0] - provider.requests[0][0], 0.2)
+        self.assertGreaterEqual(provider.requests[2][0] - provider.requests[1][0], 0.4)
+
+    def test_failover_to_other_provider(self):
+        limited = self.serve([completion("first answer")])
+        other = self.serve([completion("from backup")])
+        talk = self.newTalk(limited, CallPolicy("openai", attempts=2, deadline=1))
+        backup = self.newTalk(other, CallPolicy("backup", attempts=1))
+        failover = FailoverTalk(talk, lambda: backup)
+
+        self.assertEqual(failover.ask("one"), "first answer")
+        self.assertIsNone(failover.backup)
+
+        limited.script = [(429, {"retry-after": "5"}, {"error": {"message": "slow down"}})]
+        self.assertEqual(failover.ask("two"), "from backup")
+        # the backup got the context, the primary keeps the answer
+        self.assertEqual([t.text for t in backup.history()], ["one", "first answer", "two", "from backup"])
+        self.assertEqual([t.text for t in talk.history()], ["one", "first answer", "two", "from backup"])
+
+        # the cooling key fails over without a request
+        self.assertEqual(failover.ask("three"), "from backup")
+        self.assertEqual(len(limited.requests), 2)
+        self.assertEqual(len(talk.history()), 6)
+
+    def test_failed_transcription_returns_none(self):
+        provider = self.serve([unavailable])
+        whisper = Wisper("ut")
+        whisper.client = OpenAI(api_key="ut", base_url=provider.url, max_retries=0)
+        whisper.policy = CallPolicy("openai", attempts=2, baseDelay=0.01)
+        self.assertIsNone(whisper.convert(MediaBuffer("voice.ogg", b"opus")))
+        self.assertEqual(len(provider.requests), 2)
+        self.assertEqual(provider.requests[0][1], "/v1/audio/transcriptions")
+
+
+class FakeSpeechResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_bytes(self, chunkSize=None):
+        yield self.data[:2]
+        yield self.data[2:]
+
+
+class TestSpeechCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_spill_and_promote(self):
+        cache = SpeechCache(memoryBytes=8, diskBytes=12, path=self.dir.name)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        cache.put("c", b"cccc") # a is spilled
+        self.assertEqual(list(cache.memory), ["b", "c"])
+        self.assertEqual(list(cache.disk), ["a"])
+
+        self.assertEqual(cache.get("a"), b"aaaa") # promoted, b is spilled
+        self.assertEqual(list(cache.memory), ["c", "a"])
+        self.assertEqual(cache.stats.get("tts.diskHit"), 1)
+
+        cache.put("d", b"dddd")
+        cache.put("e", b"eeee")
+        cache.put("f", b"ffff")
+        # disk keeps the most recently spilled 12 bytes
+        self.assertEqual(list(cache.disk), ["c", "a", "d"])
+        self.assertLessEqual(cache.diskSize, 12)
+        self.assertNotIn("b", cache.disk)
+        self.assertIsNone(cache.get("b"))
+
+        # spilled entries are found again after a restart
+        restarted = SpeechCache(memoryBytes=8, diskBytes=12, path=self.dir.name)
+        for key in cache.disk:
+            self.assertIsNotNone(restarted.get(key))
+
+    def test_repeated_text_is_synthesized_once(self):
+        tts = ReadText("test", cache=SpeechCache(memoryBytes=1024))
+        create = mock.Mock(return_value=FakeSpeechResponse(b"opus"))
+        tts.client = SimpleNamespace(audio=SimpleNamespace(speech=SimpleNamespace(
+            with_streaming_response=SimpleNamespace(create=create))))
+
+        first = tts.convert("Hello there")
+        second = tts.convert("Hello there")
+        self.assertEqual(first.getValue(), b"opus")
+        self.assertEqual(second.getValue(), b"opus")
+        self.assertEqual(first.name, "speech.ogg")
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(create.call_args.kwargs["response_format"], "opus")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
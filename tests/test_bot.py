@@ -1,9 +1,56 @@
 import unittest
 
+import asyncio
+import threading
+import time
 import telebot
+import json
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
-from common import getConfig
-from im.tgchat import TgChat
+from common import getConfig, Stats, TelegramConfig
+from im.tgchat import TgBot, TgChat, streamPlaceholder, pickPhoto
+from im.tgasync import AsyncTgBot, AsyncTgChat
+from im.common import ChatCache, OrderedPipeline
+from im.outbox import AsyncOutbox, Outbox, Send, SendSchedule
+
+
+class FakeApi:
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    def send_message(self, chat_id, text, parse_mode=None, reply_to_message_id=None):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, parse_mode=None):
+        if parse_mode == "Markdown" and text.count("*") % 2 == 1:
+            raise Exception("can't parse entities")
+        self.edits.append((text, parse_mode))
+
+
+class FakeAsyncApi(FakeApi):
+    async def send_message(self, *args, **kwargs):
+        return FakeApi.send_message(self, *args, **kwargs)
+
+    async def edit_message_text(self, *args, **kwargs):
+        return FakeApi.edit_message_text(self, *args, **kwargs)
+
+
+class FakeBot:
+    def __init__(self, config: TelegramConfig):
+        self.config = config
+        self.api = FakeApi()
+        self.outbox = Outbox(config, Stats())
+
+    def stripPrefixToInt(self, id: str) -> int:
+        return int(id.split("-")[-1])
     
 
 class TestBot(unittest.TestCase):
@@ -54,7 +101,388 @@ Alternatively, if you still want to use the non-hashable type as the key itself,
         chat = TgChat(None, "ut", 3)
         newText = chat.escape(text)
         
+
+    def test_reply_stream(self):
+        bot = FakeBot(TelegramConfig(botToken="", parseMode="Markdown", streaming=True, streamInterval=0, chatRate=1000))
+        chat = TgChat(bot, "tg-1", 2)
+
+        answer = chat.replyStream(iter(["Hello", ", ", "*world*"]), "tg-10")
+
+        self.assertEqual(answer, "Hello, *world*")
+        self.assertEqual(bot.api.sent, [streamPlaceholder])
+        # first delta is shown at once, the final edit carries the parse mode
+        self.assertEqual(bot.api.edits[0], ("Hello", ""))
+        self.assertEqual(bot.api.edits[-1], ("Hello, *world*", "Markdown"))
+
+    def test_reply_stream_markdown_fallback(self):
+        bot = FakeBot(TelegramConfig(botToken="", parseMode="Markdown", streaming=True, streamInterval=3600, chatRate=1000))
+        chat = TgChat(bot, "tg-1", 2)
+
+        answer = chat.replyStream(iter(["2 * 3", " = 6"]), "tg-10")
+
+        self.assertEqual(answer, "2 * 3 = 6")
+        self.assertEqual(bot.api.edits, [("2 * 3", ""), ("2 * 3 = 6", "")])
+
+    def test_reply_stream_async(self):
+        bot = FakeBot(TelegramConfig(botToken="", parseMode="Markdown", streaming=True, streamInterval=0, chatRate=1000))
+        bot.api = FakeAsyncApi()
+        bot.outbox = AsyncOutbox(bot.config, Stats())
+        chat = AsyncTgChat(bot, "tg-1", 2)
+
+        async def deltas():
+            for d in ["Hello", ", ", "*world*"]:
+                yield d
+
+        answer = asyncio.run(chat.replyStream(deltas(), "tg-10"))
+
+        self.assertEqual(answer, "Hello, *world*")
+        self.assertEqual(bot.api.sent, [streamPlaceholder])
+        self.assertEqual(bot.api.edits[-1], ("Hello, *world*", "Markdown"))
         
 
+def floodError(retryAfter):
+    return telebot.apihelper.ApiTelegramException("sendMessage", None, {
+        "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retryAfter}})
+
+
+class FloodApi(FakeApi):
+    # answers the first markdown send with a flood error
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def send_message(self, chat_id, text, parse_mode=None, reply_to_message_id=None):
+        self.calls.append((time.monotonic(), text, parse_mode))
+        if len(self.calls) == 1:
+            raise floodError(0.2)
+        if parse_mode == "Markdown" and text.count("*") % 2 == 1:
+            raise Exception("can't parse entities")
+        return FakeApi.send_message(self, chat_id, text, parse_mode, reply_to_message_id)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def test_flood_wait_is_retried_not_sent_plain(self):
+        bot = FakeBot(TelegramConfig(botToken="", parseMode="Markdown", chatRate=1000))
+        bot.api = FloodApi()
+        chat = TgChat(bot, "tg-1", 2)
+
+        start = time.monotonic()
+        chat.replyMessage("*hello*", "tg-10")
+        chat.replyMessage("2 * 3", "tg-11")
+        self.assertLess(time.monotonic() - start, 0.1) # the worker is not held up
+        placeholder = bot.outbox.submit(1, lambda: "done").result(timeout=5)
+
+        self.assertEqual(placeholder, "done")
+        # the flood error waits retry_after and keeps markdown, only the parse error falls back to plain text
+        self.assertEqual(bot.api.sent, ["*hello*", "2 * 3"])
+        self.assertEqual([c[2] for c in bot.api.calls], ["Markdown", "Markdown", "Markdown", ""])
+        self.assertGreaterEqual(bot.api.calls[1][0] - bot.api.calls[0][0], 0.2)
+        self.assertEqual(bot.outbox.stats.get("send.flood"), 1)
+
+    def test_private_first_within_limits(self):
+        schedule = SendSchedule(TelegramConfig(botToken="", sendRate=3, groupRate=2), Stats())
+        for i in range(3):
+            schedule.push(Send(-100, lambda: None, queued=i))
+        schedule.push(Send(7, lambda: None, queued=5))
+        schedule.push(Send(8, lambda: None, queued=6))
+
+        now = time.monotonic()
+        order = []
+        for _ in range(3):
+            send, wait = schedule.pop(now)
+            order.append(send.chat)
+            schedule.done(send)
+        self.assertEqual(order, [7, 8, -100])
+
+        # global limit of 3 a second
+        send, wait = schedule.pop(now)
+        self.assertIsNone(send)
+        self.assertAlmostEqual(wait, 1 / 3, delta=0.05)
+
+        # the group got 2 a minute
+        send, wait = schedule.pop(now + 1)
+        self.assertEqual(send.chat, -100)
+        schedule.done(send)
+        send, wait = schedule.pop(now + 2)
+        self.assertIsNone(send)
+        self.assertGreater(wait, 20)
+
+    def test_async_outbox_keeps_chat_order(self):
+        outbox = AsyncOutbox(TelegramConfig(botToken="", chatRate=1000), Stats())
+        sent = []
+
+        async def send(text, delay):
+            await asyncio.sleep(delay)
+            sent.append(text)
+            return text
+
+        async def run():
+            first = outbox.submit(1, lambda: send("a", 0.05))
+            second = outbox.submit(1, lambda: send("b", 0))
+            other = outbox.submit(2, lambda: send("c", 0))
+            return await asyncio.gather(first, second, other)
+
+        self.assertEqual(asyncio.run(run()), ["a", "b", "c"])
+        self.assertEqual(sent, ["c", "a", "b"])
+
+
+class FakeBotApi:
+    # local Bot API answering the few methods the bot calls
+    def __init__(self):
+        self.calls = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                api.calls.append((method, params))
+                data = json.dumps({"ok": True, "result": api.result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 99, "is_bot": True, "first_name": "Chloe", "username": "chloe_bot"}
+        if method == "getChatMemberCount":
+            return 2
+        if method == "sendMessage":
+            return {"message_id": len(self.calls), "date": 0, "chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params["text"]}
+        return True
+
+    def called(self, method, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            found = [p for m, p in self.calls if m == method]
+            if len(found) > 0:
+                return found
+            time.sleep(0.01)
+        return []
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def postUpdate(port, update, secret):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/telegram", data=json.dumps(update).encode(),
+                                     headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret})
+    with urllib.request.urlopen(request, timeout=5) as resp:
+        return resp.status
+
+
+class TestWebhook(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeBotApi()
+        self.addCleanup(self.api.close)
+        patcher = mock.patch.object(telebot.apihelper, "API_URL", self.api.url + "/bot{0}/{1}")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.bot = self.startBot("s3cret")
+
+    def startBot(self, secret):
+        bot = TgBot(TelegramConfig(botToken="123:abc", chatRate=1000, webhookUrl="https://bot.example.com/telegram",
+                                   webhookListen="127.0.0.1", webhookPort=0, webhookSecret=secret))
+        self.addCleanup(bot.webhook.close)
+        return bot
+
+    def update(self, uid, text):
+        return {"update_id": uid, "message": {"message_id": uid, "date": 0, "chat": {"id": 42, "type": "private"},
+                                              "from": {"id": 42, "is_bot": False, "first_name": "Ann"}, "text": text}}
+
+    def test_update_reaches_pipeline_and_reply_goes_out(self):
+        self.assertIsNone(self.bot.task) # no polling
+        hook = self.api.called("setWebhook")[0]
+        self.assertEqual(hook["url"], "https://bot.example.com/telegram")
+        self.assertEqual(hook["secret_token"], "s3cret")
+
+        self.assertEqual(postUpdate(self.bot.webhook.port, self.update(1, "hello"), "s3cret"), 200)
+        msg = self.bot.downloads.ready.get(timeout=5)
+        self.assertEqual(msg.getMedia().getText(), ["hello"])
+        self.assertEqual(msg.getChatID(), "tg-42")
+
+        msg.getChat().replyMessage("hi Ann", msg.getID())
+        sent = self.api.called("sendMessage")
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]["chat_id"], "42")
+        self.assertEqual(sent[0]["text"], "hi Ann")
+        self.assertEqual(json.loads(sent[0]["reply_parameters"])["message_id"], 1)
+
+    def test_wrong_secret_rejected(self):
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            postUpdate(self.bot.webhook.port, self.update(2, "let me in"), "guess")
+        self.assertEqual(ctx.exception.code, 403)
+        time.sleep(0.1)
+        self.assertTrue(self.bot.downloads.ready.empty())
+        self.assertEqual(self.bot.stats.get("webhook.rejected"), 1)
+
+    def test_empty_secret_registers_a_random_one(self):
+        bot = self.startBot("")
+        registered = self.api.called("setWebhook")[-1]["secret_token"]
+        self.assertGreaterEqual(len(registered), 32)
+        self.assertEqual(registered, bot.webhook.secret)
+
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            postUpdate(bot.webhook.port, self.update(3, "forged"), "")
+        self.assertEqual(ctx.exception.code, 403)
+        self.assertEqual(postUpdate(bot.webhook.port, self.update(4, "hello"), registered), 200)
+        self.assertEqual(bot.downloads.ready.get(timeout=5).getMedia().getText(), ["hello"])
+        self.assertTrue(bot.downloads.ready.empty())
+
+
+class TestChatCache(unittest.TestCase):
+
+    def test_lru_capacity(self):
+        cache = ChatCache(capacity=16, ttl=60)
+        for i in range(100):
+            cache.cacheChat(f"tg-{i}", i)
+        self.assertLessEqual(cache.chats.size(), 16)
+        self.assertEqual(cache.getChat("tg-99"), 99)
+        self.assertIsNone(cache.getChat("tg-0"))
+
+    def test_concurrent_miss_loads_once(self):
+        cache = ChatCache(capacity=16, ttl=60)
+        calls = []
+        gate = threading.Event()
+
+        def load():
+            calls.append(1)
+            gate.wait(5)
+            return "chat"
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(cache.loadChat, "tg-1", load) for _ in range(8)]
+            time.sleep(0.05)
+            gate.set()
+            results = [f.result() for f in futures]
+
+        self.assertEqual(results, ["chat"] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.loadChat("tg-1", load), "chat")
+        self.assertGreater(cache.hitRate()["chat"], 0)
+
+    def test_stale_refresh_in_background(self):
+        cache = ChatCache(capacity=16, ttl=0.5)
+        counts = iter([2, 3])
+        refreshed = threading.Event()
+
+        def load():
+            cnt = next(counts)
+            if cnt == 3:
+                refreshed.set()
+            return cnt
+
+        self.assertEqual(cache.loadChat("tg-1", load), 2)
+        time.sleep(0.6)
+        # stale value is served at once, the new member count comes from the background refresh
+        self.assertEqual(cache.loadChat("tg-1", load), 2)
+        self.assertTrue(refreshed.wait(5))
+        time.sleep(0.01)
+        self.assertEqual(cache.loadChat("tg-1", load), 3)
+
+    def test_async_stale_refresh_on_the_loop(self):
+        bot = AsyncTgBot(TelegramConfig(botToken="123:abc", cacheTTL=0.5))
+        counts = iter([2, 3])
+        calls = []
+        gate = asyncio.Event()
+
+        async def memberCount(chatId):
+            calls.append(chatId)
+            if len(calls) == 2:
+                await gate.wait()
+            return next(counts)
+        bot.api.get_chat_member_count = memberCount
+
+        async def run():
+            self.assertEqual((await bot.lookupChat("tg-1")).getMemberCount(), 2)
+            await asyncio.sleep(0.6)
+            # the stale chat is served at once, one refresh runs on the loop however many lookups see it
+            stale = await asyncio.gather(*[bot.lookupChat("tg-1") for _ in range(4)])
+            self.assertEqual([c.getMemberCount() for c in stale], [2] * 4)
+            self.assertEqual(len(calls), 2)
+            gate.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual((await bot.lookupChat("tg-1")).getMemberCount(), 3)
+            self.assertEqual(len(calls), 2)
+        asyncio.run(run())
+        self.assertEqual(bot.cache.stats.get("chat.refresh"), 1)
+
+
+class TestPickPhoto(unittest.TestCase):
+
+    def setUp(self):
+        # telegram's usual thumbnails of a 4:3 photo, smallest first
+        self.sizes = [SimpleNamespace(file_id=f"p{w}", width=w, height=w * 3 // 4) for w in (90, 320, 800, 1280, 2560)]
+
+    def test_smallest_that_fits(self):
+        self.assertEqual(pickPhoto(self.sizes, 768).file_id, "p1280")
+        self.assertEqual(pickPhoto(self.sizes, 512).file_id, "p800")
+        # portrait photos are judged by their short side as well
+        portrait = [SimpleNamespace(file_id=p.file_id, width=p.height, height=p.width) for p in self.sizes]
+        self.assertEqual(pickPhoto(portrait, 512).file_id, "p800")
+
+    def test_low_detail_judged_by_long_side(self):
+        # a 16:9 photo, low detail fits its long side in 512 px
+        wide = [SimpleNamespace(file_id=f"p{w}", width=w, height=w * 9 // 16) for w in (90, 320, 800, 1280, 2560)]
+        self.assertEqual(pickPhoto(wide, 512).file_id, "p1280")
+        self.assertEqual(pickPhoto(wide, 512, longSide=True).file_id, "p800")
+        self.assertEqual(pickPhoto(self.sizes, 320, longSide=True).file_id, "p320")
+
+    def test_largest_when_none_fits(self):
+        self.assertEqual(pickPhoto(self.sizes, 4000).file_id, "p2560")
+        self.assertEqual(pickPhoto(self.sizes, 0).file_id, "p2560")
+
+
+class TestOrderedPipeline(unittest.TestCase):
+
+    def test_slow_media_holds_back_only_its_chat(self):
+        stats = Stats()
+        pipeline = OrderedPipeline("download", 4, stats)
+        gate = threading.Event()
+
+        def slow():
+            gate.wait(5)
+            return "a-voice"
+
+        pipeline.submit("a", slow)
+        pipeline.submit("a", lambda: "a-text", inline=True)
+        pipeline.submit("b", lambda: "b-photo")
+        pipeline.submit("b", lambda: "b-text", inline=True)
+
+        self.assertEqual([pipeline.get(), pipeline.get()], ["b-photo", "b-text"])
+        gate.set()
+        self.assertEqual([pipeline.get(), pipeline.get()], ["a-voice", "a-text"])
+        self.assertEqual(pipeline.pending, {})
+        self.assertEqual(stats.get("download.inflight"), 0)
+
+    def test_failed_job_is_skipped(self):
+        stats = Stats()
+        pipeline = OrderedPipeline("download", 2, stats)
+
+        def fail():
+            raise IOError("download failed")
+
+        pipeline.submit("a", fail)
+        pipeline.submit("a", lambda: "a-text", inline=True)
+        self.assertEqual(pipeline.get(), "a-text")
+        self.assertEqual(stats.get("download.failed"), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
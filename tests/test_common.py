@@ -1,6 +1,9 @@
+import os
 import unittest
 
+import definition
 from common import Defer
+from definition import MediaBuffer
 
 class TestCommon(unittest.TestCase):
     
@@ -31,6 +34,26 @@ class TestCommon(unittest.TestCase):
 
         self.assertEqual(self.c, 22)
 
+    def test_media_buffer(self):
+        buf = MediaBuffer("voice.OGA", b"abc")
+        buf.write(b"def")
+        self.assertEqual(buf.getValue(), b"abcdef")
+        self.assertEqual(buf.size, 6)
+        self.assertEqual(buf.ext(), ".oga")
+        # small media never touches the disk
+        self.assertFalse(buf.file._rolled)
+
+        path = buf.path()
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdef")
+        buf.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_media_buffer_spill(self):
+        big = MediaBuffer("photo.jpg", b"x" * (definition.spillSize + 1))
+        self.assertTrue(big.file._rolled)
+        self.assertEqual(len(big.reader().read()), definition.spillSize + 1)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,8 +1,17 @@
 import unittest
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import telebot
+from types import SimpleNamespace
 
-from common import getConfig, getAcl
+from common import getConfig, getAcl, ACL
+from definition import MediaBuffer
+from im.tgchat import TgMessage, TgMedia, TgUser, mentionsOf
+from service.botservice import SmartBot, splitSentences, splitSpeech
+from service.mailbox import MailboxScheduler, AsyncMailboxScheduler
     
 
 class TestBot(unittest.TestCase):
@@ -29,7 +38,221 @@ class TestBot(unittest.TestCase):
         pass
 
 
-            
+
+def waitIdle(mailbox: MailboxScheduler, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while mailbox.activeKeys() > 0 and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+class TestMailbox(unittest.TestCase):
+
+    def test_order_per_key(self):
+        pool = ThreadPoolExecutor(max_workers=4)
+        mailbox = MailboxScheduler(pool)
+        lock = threading.Lock()
+        done = {"a": [], "b": []}
+        running = {"a": 0, "b": 0}
+        overlap = []
+
+        def job(key, i):
+            def inner():
+                with lock:
+                    running[key] += 1
+                    if running[key] > 1:
+                        overlap.append(key)
+                time.sleep(0.001)
+                with lock:
+                    running[key] -= 1
+                    done[key].append(i)
+            return inner
+
+        for i in range(50):
+            mailbox.submit("a", job("a", i))
+            mailbox.submit("b", job("b", i))
+        waitIdle(mailbox)
+
+        self.assertEqual(done["a"], list(range(50)))
+        self.assertEqual(done["b"], list(range(50)))
+        self.assertEqual(overlap, [])
+        # idle mailboxes are reclaimed
+        self.assertEqual(mailbox.activeKeys(), 0)
+
+    def test_busy_key_does_not_block_others(self):
+        pool = ThreadPoolExecutor(max_workers=1)
+        mailbox = MailboxScheduler(pool)
+        done = []
+        submitted = threading.Event()
+
+        def busy(i):
+            submitted.wait(5)
+            done.append(("busy", i))
+
+        for i in range(3):
+            mailbox.submit("busy", lambda i=i: busy(i))
+        mailbox.submit("quiet", lambda: done.append(("quiet", 0)))
+        submitted.set()
+        waitIdle(mailbox)
+
+        # with one worker the quiet chat is served before the busy one is drained
+        self.assertLess(done.index(("quiet", 0)), done.index(("busy", 2)))
+
+    def test_async_order_per_key(self):
+        done = []
+
+        async def job(key, i):
+            await asyncio.sleep(0)
+            done.append((key, i))
+
+        async def main():
+            mailbox = AsyncMailboxScheduler(2)
+            for i in range(10):
+                mailbox.submit("a", lambda i=i: job("a", i))
+                mailbox.submit("b", lambda i=i: job("b", i))
+            while mailbox.activeKeys() > 0:
+                await asyncio.sleep(0.001)
+
+        asyncio.run(main())
+        self.assertEqual([i for k, i in done if k == "a"], list(range(10)))
+        self.assertEqual([i for k, i in done if k == "b"], list(range(10)))
+
+
+class FakeGroup:
+    def __init__(self):
+        self.replies = []
+
+    def getID(self):
+        return "tg-1"
+
+    def getMemberCount(self):
+        return 5
+
+    def replyMessage(self, message, replyTo):
+        self.replies.append(message)
+
+    def quoteMessage(self, message, replyTo, quote):
+        self.replies.append(message)
+
+    def replyStream(self, deltas, replyTo):
+        return "".join(deltas)
+
+    def replyVoice(self, audio, message):
+        pass
+
+    def getSelf(self):
+        return TgUser("tg-42", "tg-1", "chloebot", "Chloe")
+
+
+class FakeTalk:
+    def __init__(self):
+        self.questions = []
+        self.images = []
+
+    def prepareImages(self, images):
+        self.images.extend(images)
+
+    def ask(self, question):
+        self.questions.append(question)
+        return "answer"
+
+
+class TestLazyMedia(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = FakeGroup()
+        self.talk = FakeTalk()
+        self.fetched = []
+        self.bot = SimpleNamespace(
+            api=SimpleNamespace(user=SimpleNamespace(id=42)),
+            lookupUser=lambda uid, cid: TgUser(uid, cid, "alice", "Alice"),
+            lookupChat=lambda cid: self.chat,
+        )
+        self.service = SmartBot.__new__(SmartBot)
+        self.service.botName = "chloe"
+        self.service.acl = ACL({"allowedChatID": {"tg-1": True}})
+        self.service.talkFactory = SimpleNamespace(getTalk=lambda cid: self.talk)
+        self.service.s2t = SimpleNamespace(convert=lambda f: "what time is it")
+        self.service.t2s = SimpleNamespace(convert=lambda text: (None, None))
+        self.service.streamReply = False
+        self.service.groupVoicePolicy = "reply"
+
+    def fetch(self, fd):
+        self.fetched.append(fd)
+        return MediaBuffer(fd + ".jpg", fd.encode())
+
+    def message(self, text=None, photo=None, voice=None, replyTo=None, mentions=[]):
+        msg = TgMessage(self.bot, "tg-7", "tg-5", "tg-1", TgMedia(self.fetch))
+        msg.withText(text)
+        msg.replyTo = replyTo
+        msg.mentions = mentions
+        if photo is not None:
+            msg.media.referPhoto(photo)
+        if voice is not None:
+            msg.media.referVoice(voice)
+        return msg
+
+    def test_ignored_group_media_is_not_fetched(self):
+        self.service.handleMessage(self.message(text="nice picture", photo="p1"))
+        self.service.handleMessage(self.message(voice="v1"))
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(self.talk.questions, [])
+
+    def test_addressed_media_is_fetched(self):
+        self.service.handleMessage(self.message(text="@ChloeBot what is this", photo="p1", mentions=["@ChloeBot"]))
+        self.assertEqual(self.fetched, ["p1"])
+        self.assertEqual([img.getValue() for img in self.talk.images], [b"p1"])
+
+        self.service.handleMessage(self.message(voice="v1", replyTo=42))
+        self.assertEqual(self.fetched, ["p1", "v1"])
+        self.assertEqual(self.talk.questions, ["@ChloeBot what is this", "what time is it"])
+
+    def test_mentions_use_utf16_offsets(self):
+        text = "😀 @chloebot hi"
+        entities = [telebot.types.MessageEntity("mention", 3, 9)]
+        self.assertEqual(mentionsOf(text, entities), ["@chloebot"])
+
+
+class TestSpeechParts(unittest.TestCase):
+
+    def test_split_sentences(self):
+        self.assertEqual(splitSentences("Pi is 3.14. Really?Yes! 好的。再见"),
+                         ["Pi is 3.14.", "Really?Yes!", "好的。", "再见"])
+
+    def test_first_part_is_one_sentence(self):
+        answer = "Sure. " + "This is a longer sentence that keeps going for a while. " * 10
+        parts = splitSpeech(answer)
+        self.assertEqual(parts[0], "Sure.")
+        self.assertGreater(len(parts), 2)
+        self.assertEqual(" ".join(parts), answer.strip())
+
+    def test_parts_synthesized_in_parallel_and_sent_in_order(self):
+        service = SmartBot.__new__(SmartBot)
+        service.ttsPool = ThreadPoolExecutor(max_workers=3)
+        lock = threading.Lock()
+        running = [0, 0] # now, max
+
+        def convert(text):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            # the first part is the slowest, the others must still be sent after it
+            time.sleep(0.2 if text.startswith("One") else 0.05)
+            with lock:
+                running[0] -= 1
+            return None if text.startswith("Four") else MediaBuffer("speech.ogg", text.encode())
+
+        service.t2s = SimpleNamespace(convert=convert)
+        chat = SimpleNamespace(voices=[])
+        chat.replyVoice = lambda audio, mid: chat.voices.append(audio.getValue())
+
+        answer = "One. " + " ".join(f"{n} {'word ' * 60}." for n in ["Two", "Three", "Four", "Five"])
+        sent = service.replySpeech(chat, answer, "tg-1")
+
+        self.assertEqual(sent, 4)
+        self.assertEqual([v.split()[0] for v in chat.voices], [b"One.", b"Two", b"Three", b"Five"])
+        self.assertGreater(running[1], 1)
+        self.assertLessEqual(running[1], 3)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file